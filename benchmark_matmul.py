@@ -0,0 +1,79 @@
+import argparse
+import random
+import time
+
+from matrix_calculator import Matrix, ParallelBackend, matmul_kernel, strassen_kernel, calibrate_strassen_crossover, get_strassen_crossover
+
+
+def naive_multiply(m1, m2):
+    # The original r1/c2/c1 loop through get_element, kept as the baseline for comparison
+    result = Matrix(m1.rows, m2.cols)
+    for r1 in range(m1.rows):
+        for c2 in range(m2.cols):
+            _sum = 0.0
+            for c1 in range(m1.cols):
+                _sum += m1.get_element(r1, c1) * m2.get_element(c1, c2)
+            result.set_element(r1, c2, _sum)
+    return result
+
+
+def random_matrix(size, rng):
+    return Matrix(size, size, [[rng.uniform(-1.0, 1.0) for _ in range(size)] for _ in range(size)])
+
+
+def time_call(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the naive, blocked and Strassen matrix multiplication kernels.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[256, 512, 1024])
+    parser.add_argument("--block-size", type=int, default=None)
+    parser.add_argument("--skip-naive", action="store_true", help="Only time the blocked kernel.")
+    parser.add_argument("--crossover", type=int, default=None, help="Strassen crossover (the configured default when omitted).")
+    parser.add_argument("--workers", type=int, default=None, help="Also time the parallel backend with this many processes.")
+    parser.add_argument("--calibrate", action="store_true", help="Only run the Strassen crossover calibration.")
+    args = parser.parse_args()
+
+    if args.calibrate:
+        print(f"Strassen crossover: {calibrate_strassen_crossover()}")
+        return
+    crossover = args.crossover or get_strassen_crossover()
+
+    rng = random.Random(0)
+    backend = ParallelBackend(workers=args.workers, min_flops=0) if args.workers else None
+    print(f"Strassen crossover: {crossover}")
+    print(f"{'size':>6} {'naive (s)':>12} {'kernel (s)':>12} {'strassen (s)':>13} {'parallel (s)':>13} {'speedup':>9}")
+    for size in args.sizes:
+        a = random_matrix(size, rng)
+        b = random_matrix(size, rng)
+        kernel_time, kernel_result = time_call(matmul_kernel, a.data, b.data, size, size, size, args.block_size)
+        strassen_time, strassen_result = time_call(strassen_kernel, a.data, b.data, size, crossover)
+        error = max(abs(x - y) for x, y in zip(kernel_result, strassen_result))
+        if error > 1e-9 * size:
+            raise SystemExit(f"Strassen result differs from the kernel result by {error} at size {size}.")
+        times = [kernel_time, strassen_time]
+        parallel_column = f"{'-':>13}"
+        if backend is not None:
+            parallel_time, parallel_result = time_call(backend.matmul, a.data, b.data, size, size, size)
+            if list(parallel_result) != list(kernel_result):
+                raise SystemExit(f"Parallel result differs from the kernel result at size {size}.")
+            times.append(parallel_time)
+            parallel_column = f"{parallel_time:>13.3f}"
+
+        if args.skip_naive:
+            # Without the naive baseline the speedup is the best kernel against the blocked one
+            print(f"{size:>6} {'-':>12} {kernel_time:>12.3f} {strassen_time:>13.3f} {parallel_column} {kernel_time / min(times):>8.1f}x")
+            continue
+        naive_time, naive_result = time_call(naive_multiply, a, b)
+        error = max(abs(x - y) for x, y in zip(kernel_result, naive_result.data))
+        if error > 1e-9 * size:
+            raise SystemExit(f"Kernel result differs from the naive result by {error} at size {size}.")
+        print(f"{size:>6} {naive_time:>12.3f} {kernel_time:>12.3f} {strassen_time:>13.3f} {parallel_column} {naive_time / min(times):>8.1f}x")
+    if backend is not None:
+        backend.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from matrix_calculator import (Matrix, SquareMatrix, LowerTriangularMatrix, UpperTriangularMatrix, DiagonalMatrix, SparseMatrix,
+                               create_matrix_from_data, read_matrix_file, write_session, SessionFile, get_backend, set_backend)
+
+MATRIX_TYPES = {cls.__name__: cls for cls in (Matrix, SquareMatrix, LowerTriangularMatrix, UpperTriangularMatrix, DiagonalMatrix, SparseMatrix)}
+OPERATIONS = ("construct", "create_matrix_from_data", "add", "subtract", "scale", "matmul", "transpose", "trace",
+              "determinant", "to_string", "load_text", "save_session", "load_session")
+# Operations that need the trace/determinant methods only the square classes have
+SQUARE_OPERATIONS = ("trace", "determinant")
+SPARSE_DENSITY = 0.02
+
+
+def random_rows(matrix_type, size, rng):
+    # Random data with the structure matrix_type expects: zeros above/below/off the diagonal, or mostly zero
+    def element(r, c):
+        if matrix_type is LowerTriangularMatrix and c > r:
+            return 0.0
+        if matrix_type is UpperTriangularMatrix and c < r:
+            return 0.0
+        if matrix_type is DiagonalMatrix and c != r:
+            return 0.0
+        if matrix_type is SparseMatrix and rng.random() >= SPARSE_DENSITY:
+            return 0.0
+        return rng.uniform(-1.0, 1.0)
+    return [[element(r, c) for c in range(size)] for r in range(size)]
+
+
+def prepare(matrix_type, size, directory, rng):
+    # Builds the operands once; each closure then runs one operation on them
+    rows = random_rows(matrix_type, size, rng)
+    a = matrix_type(size, size, rows)
+    b = matrix_type(size, size, random_rows(matrix_type, size, rng))
+    text_path = os.path.join(directory, f"{matrix_type.__name__}_{size}.txt")
+    with open(text_path, "w") as f:
+        f.write("".join(" ".join(repr(value) for value in row) + "\n" for row in rows))
+    session_path = os.path.join(directory, f"{matrix_type.__name__}_{size}.mtx")
+    write_session(session_path, [(1, "a", a)])
+
+    def load_session():
+        session = SessionFile(session_path)
+        matrix = session.records[0].load()
+        session.close()
+        return matrix
+
+    # Derived results are cached until the matrix changes, so the uncached cost is measured by
+    # invalidating the cache before every call
+    def uncached(method):
+        def run():
+            a._mutated()
+            return method()
+        return run
+
+    return {
+        "construct": lambda: matrix_type(size, size, rows),
+        "create_matrix_from_data": lambda: create_matrix_from_data(size, size, rows),
+        "add": lambda: a + b,
+        "subtract": lambda: a - b,
+        "scale": lambda: a * 1.5,
+        "matmul": lambda: a * b,
+        "transpose": a.transpose,
+        "trace": uncached(getattr(a, "trace", None)),
+        "determinant": uncached(getattr(a, "determinant", None)),
+        "to_string": a.to_string,
+        "load_text": lambda: read_matrix_file(text_path),
+        "save_session": lambda: write_session(os.path.join(directory, "save.mtx"), [(1, "a", a)]),
+        "load_session": load_session,
+    }
+
+
+def operations_per_second(func, min_time, repeat):
+    # Best of repeat runs, each doubling its iteration count until it lasts at least min_time
+    func()
+    best = 0.0
+    for _ in range(repeat):
+        iterations = 1
+        while True:
+            start = time.perf_counter()
+            for _ in range(iterations):
+                func()
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+            iterations *= 2
+        best = max(best, iterations / elapsed)
+    return best, iterations
+
+
+def memory_profile(func):
+    # Peak and retained traced memory of one call (retained includes the result), and the net change
+    # in allocated blocks
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    blocks = sys.getallocatedblocks()
+    result = func()
+    current, peak = tracemalloc.get_traced_memory()
+    allocated_blocks = sys.getallocatedblocks() - blocks
+    tracemalloc.stop()
+    del result
+    return peak - before, current - before, allocated_blocks
+
+
+def run_suite(types, operations, sizes, min_time, repeat):
+    rng = random.Random(0)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            for type_name in types:
+                matrix_type = MATRIX_TYPES[type_name]
+                cases = prepare(matrix_type, size, directory, rng)
+                for operation in operations:
+                    if operation in SQUARE_OPERATIONS and not hasattr(matrix_type, operation):
+                        continue
+                    func = cases[operation]
+                    ops, iterations = operations_per_second(func, min_time, repeat)
+                    peak, retained, blocks = memory_profile(func)
+                    results.append({"operation": operation, "type": type_name, "size": size, "ops_per_sec": ops,
+                                    "seconds_per_op": 1.0 / ops, "iterations": iterations, "peak_bytes": peak,
+                                    "allocated_bytes": retained, "allocated_blocks": blocks})
+                    print(f"{operation:>24} {type_name:>22} {size:>6} {ops:>14.1f} ops/s {peak:>12} B peak", file=sys.stderr)
+    return results
+
+
+def compare(baseline, current, threshold):
+    # Cases present in both runs whose throughput fell, or whose peak memory grew, by more than threshold
+    reference = {(r["operation"], r["type"], r["size"]): r for r in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        key = (result["operation"], result["type"], result["size"])
+        if key not in reference:
+            continue
+        base = reference[key]
+        speed = result["ops_per_sec"] / base["ops_per_sec"]
+        if speed < 1.0 - threshold:
+            regressions.append((key, "speed", speed))
+        if base["peak_bytes"] > 0 and result["peak_bytes"] > base["peak_bytes"] * (1.0 + threshold):
+            regressions.append((key, "peak memory", result["peak_bytes"] / base["peak_bytes"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time every matrix operation across matrix types and sizes, or compare against a baseline.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[16, 64, 128])
+    parser.add_argument("--types", nargs="+", choices=list(MATRIX_TYPES), default=list(MATRIX_TYPES))
+    parser.add_argument("--operations", nargs="+", choices=OPERATIONS, default=list(OPERATIONS))
+    parser.add_argument("--min-time", type=float, default=0.1, help="Seconds each timed run lasts at least.")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per case; the best is kept.")
+    parser.add_argument("--backend", default=None, help="Backend to benchmark (default: the active one).")
+    parser.add_argument("--output", help="Write the JSON results here instead of stdout.")
+    parser.add_argument("--compare", metavar="BASELINE", help="Flag regressions against this earlier JSON result.")
+    parser.add_argument("--current", help="With --compare, compare this JSON result instead of running the suite.")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative slowdown (or memory growth) that counts as a regression.")
+    args = parser.parse_args()
+
+    if args.current:
+        with open(args.current) as f:
+            current = json.load(f)
+    else:
+        if args.backend:
+            set_backend(args.backend)
+        current = {
+            "meta": {"python": platform.python_version(), "platform": platform.platform(), "backend": type(get_backend()).__name__,
+                     "min_time": args.min_time, "repeat": args.repeat, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")},
+            "results": run_suite(args.types, args.operations, args.sizes, args.min_time, args.repeat),
+        }
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(current, f, indent=2)
+        elif not args.compare:
+            json.dump(current, sys.stdout, indent=2)
+            print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, current, args.threshold)
+        for (operation, type_name, size), kind, ratio in regressions:
+            print(f"REGRESSION {operation} {type_name} {size}: {kind} {ratio:.2f}x of baseline")
+        print(f"{len(regressions)} regression(s) above {args.threshold:.0%}.")
+        if regressions:
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
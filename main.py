@@ -1,30 +1,300 @@
-from matrix_calculator import Matrix, SquareMatrix, LowerTriangularMatrix, UpperTriangularMatrix, DiagonalMatrix, create_matrix_from_data
+from matrix_calculator import (Matrix, SquareMatrix, LowerTriangularMatrix, UpperTriangularMatrix, DiagonalMatrix, SparseMatrix, MappedMatrix,
+                               create_matrix_from_data, read_matrix_file, FILE_PROGRESS_INTERVAL, plan_chain, multiply_chain,
+                               SessionFile, write_session, SESSION_MAGIC, SESSION_LOWER, SESSION_UPPER, SessionJournal, read_journal,
+                               enable_profiling, disable_profiling, is_profiling, reset_profile, format_profile, export_profile)
+from array import array
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import argparse
+import cProfile
+import heapq
+import json
 import os
 import pickle
+import shlex
+import sys
+import threading
+
+# When set, the menu keeps its matrices in this session file plus an append-only journal beside it
+JOURNAL_ENV_VAR = "MATRIX_JOURNAL"
+# A journal that grows past this many bytes is compacted into a new snapshot in the background
+JOURNAL_COMPACT_BYTES = 64 << 20
+
+
+class _SessionEntry(dict):
+    # Registry entry backed by a session file record; the matrix is read from the file the first
+    # time entry["matrix"] is looked up
+    def __init__(self, matrix_id, record):
+        super().__init__(id=matrix_id, name=record.name)
+        self.record = record
+
+    def __missing__(self, key):
+        if key != "matrix":
+            raise KeyError(key)
+        matrix = self["matrix"] = self.record.load()
+        return matrix
+
 
 class MatrixManager:
-    def __init__(self):
-        self.matrices = []
+    def __init__(self, journal_path=None):
+        # Entries are indexed by ID, name, class and shape; dicts keep insertion order, so listings stay stable
+        self._by_id = {}
+        self._by_name = {}
+        self._by_type = {}
+        self._by_shape = {}
+        self.next_id = 1
+        self._journal = None
+        self._compaction = None
+        # Session files that lazily loaded entries still read from
+        self._sessions = []
+        self.compact_bytes = JOURNAL_COMPACT_BYTES
+        if journal_path is not None:
+            self.open_journal(journal_path)
+
+    @property
+    def matrices(self):
+        # A live, read-only view of the entries in the order they were added
+        return self._by_id.values()
+
+    @staticmethod
+    def _entry_keys(entry):
+        if "matrix" not in entry:
+            # Entries from a session file are indexed from its header without loading the matrix
+            record = entry.record
+            return record.matrix_type, (record.rows, record.cols)
+        matrix = entry["matrix"]
+        return type(matrix), (matrix.rows, matrix.cols)
+
+    def _index(self, entry):
+        matrix_type, shape = self._entry_keys(entry)
+        self._by_id[entry["id"]] = entry
+        self._by_name.setdefault(entry["name"], {})[entry["id"]] = entry
+        self._by_type.setdefault(matrix_type, {})[entry["id"]] = entry
+        self._by_shape.setdefault(shape, {})[entry["id"]] = entry
+
+    def _unindex(self, entry):
+        matrix_type, shape = self._entry_keys(entry)
+        for index, key in ((self._by_name, entry["name"]), (self._by_type, matrix_type), (self._by_shape, shape)):
+            bucket = index[key]
+            del bucket[entry["id"]]
+            if not bucket:
+                del index[key]
+
+    def _reset(self):
+        # Every entry goes, so nothing reads from the open session files any more
+        self._wait_for_compaction()
+        for session in self._sessions:
+            session.close()
+        self._sessions = []
+        self._by_id = {}
+        self._by_name = {}
+        self._by_type = {}
+        self._by_shape = {}
         self.next_id = 1
 
     def add_matrix(self, matrix, name=None):
         if name is None:
             name = f"Matrix_{self.next_id}"
-        self.matrices.append({"id": self.next_id, "name": name, "matrix": matrix})
+        if name in self._by_name:
+            # Names may repeat; lookups by name resolve to the earliest matrix still registered under it
+            print(f"Note: another matrix is already named '{name}'.")
+        matrix_id = self._register(matrix, name)
+        print(f"Matrix '{name}' added with ID {matrix_id}.")
+        return matrix_id
+
+    def _register(self, matrix, name):
+        matrix_id = self.next_id
+        self._index({"id": matrix_id, "name": name, "matrix": matrix})
         self.next_id += 1
-        print(f"Matrix '{name}' added with ID {self.next_id - 1}.")
+        self._log("add", matrix_id, name, matrix)
+        return matrix_id
 
     def get_matrix_by_id(self, matrix_id):
-        for m in self.matrices:
-            if m["id"] == matrix_id:
-                return m["matrix"]
-        return None
+        entry = self._by_id.get(matrix_id)
+        return entry["matrix"] if entry is not None else None
 
     def get_matrix_by_name(self, name):
-        for m in self.matrices:
-            if m["name"] == name:
-                return m["matrix"]
-        return None
+        bucket = self._by_name.get(name)
+        return next(iter(bucket.values()))["matrix"] if bucket else None
+
+    def get_matrices_by_name(self, name):
+        return [entry["matrix"] for entry in self._by_name.get(name, {}).values()]
+
+    def remove_matrix_by_id(self, matrix_id):
+        entry = self._by_id.pop(matrix_id, None)
+        if entry is None:
+            return False
+        self._unindex(entry)
+        self._log("remove", matrix_id)
+        return True
+
+    def alter_element(self, matrix_id, row, col, value):
+        entry = self._by_id.get(matrix_id)
+        if entry is None:
+            return False
+        entry["matrix"].set_element(row, col, value)
+        self._log("alter", matrix_id, row, col, value)
+        return True
+
+    def clear(self):
+        self._reset()
+        self._log("clear")
+
+    def _log(self, change, *args):
+        if self._journal is None:
+            return
+        getattr(self._journal, change)(*args)
+        if self._journal.size() >= self.compact_bytes:
+            self.compact()
+
+    def open_journal(self, path):
+        # Restores the registry from the snapshot session file at path and the journal next to it, then
+        # records every later change in that journal. A compaction cut short by a crash is finished first.
+        self.close_journal()
+        self._reset()
+        self._snapshot_path = path
+        journal_path = path + ".journal"
+        old_path = journal_path + ".old"
+        if os.path.exists(path):
+            session = SessionFile(path)
+            self._sessions.append(session)
+            for record in session.records:
+                self._index(_SessionEntry(record.id, record))
+            self.next_id = max(self._by_id, default=0) + 1
+        for replay_path in (old_path, journal_path):
+            if os.path.exists(replay_path):
+                changes, valid_length = read_journal(replay_path)
+                self._replay(changes)
+                if valid_length < os.path.getsize(replay_path):
+                    # Drops a record cut short by a crash, so appending continues after the last good one
+                    os.truncate(replay_path, valid_length)
+        self._journal = SessionJournal(journal_path)
+        if os.path.exists(old_path):
+            self.compact(wait=True)
+
+    def _replay(self, changes):
+        for change in changes:
+            kind = change[0]
+            if kind == "add":
+                _, matrix_id, name, matrix = change
+                if matrix_id in self._by_id:
+                    self._unindex(self._by_id.pop(matrix_id))
+                self._index({"id": matrix_id, "name": name, "matrix": matrix})
+                self.next_id = max(self.next_id, matrix_id + 1)
+            elif kind == "remove":
+                entry = self._by_id.pop(change[1], None)
+                if entry is not None:
+                    self._unindex(entry)
+            elif kind == "alter":
+                _, matrix_id, row, col, value = change
+                if matrix_id in self._by_id:
+                    self._by_id[matrix_id]["matrix"].set_element(row, col, value)
+            elif kind == "clear":
+                self._reset()
+            elif kind == "next_id":
+                self.next_id = change[1]
+
+    def compact(self, wait=False):
+        # Moves the journal aside, starts a fresh one and writes a snapshot of the current registry in a
+        # background thread; the old journal is deleted once the snapshot is in place. Until then both
+        # are replayed on startup, which is safe because replaying a change twice has no further effect.
+        if self._journal is None:
+            return
+        self._wait_for_compaction()
+        journal_path = self._journal.path
+        old_path = journal_path + ".old"
+        self._journal.close()
+        if os.path.exists(old_path):
+            # An earlier snapshot was not completed, so its journal is kept ahead of the current one
+            old_journal = SessionJournal(old_path)
+            old_journal.extend_from(journal_path)
+            old_journal.close()
+            os.remove(journal_path)
+        else:
+            os.replace(journal_path, old_path)
+        self._journal = SessionJournal(journal_path)
+        self._journal.set_next_id(self.next_id)
+        entries = [(m["id"], m["name"], self._snapshot_source(m)) for m in self.matrices]
+        self._compaction = threading.Thread(target=self._write_snapshot, args=(entries, old_path))
+        self._compaction.start()
+        if wait:
+            self._wait_for_compaction()
+
+    @staticmethod
+    def _snapshot_source(entry):
+        # What the background snapshot writes for an entry. Records, and matrices unchanged since they
+        # were loaded, are copied from their session file. Only a SparseMatrix is copied here, because
+        # set_element may resize the CSR arrays the writer is reading. Other storage changes element by
+        # element in place, and every change made after the journal switch is replayed over the
+        # snapshot anyway.
+        if "matrix" not in entry:
+            return entry.record
+        matrix = entry["matrix"]
+        if isinstance(entry, _SessionEntry) and matrix._version == 0:
+            return entry.record
+        return matrix.copy() if isinstance(matrix, SparseMatrix) else matrix
+
+    def _write_snapshot(self, entries, old_path):
+        write_session(self._snapshot_path, entries)
+        os.remove(old_path)
+
+    def _wait_for_compaction(self):
+        if self._compaction is not None:
+            self._compaction.join()
+            self._compaction = None
+
+    def close_journal(self):
+        if self._journal is None:
+            return
+        self._wait_for_compaction()
+        self._journal.close()
+        self._journal = None
+
+    def find_matrices(self, matrix_type=None, rows=None, cols=None):
+        # Returns the matching entries in insertion order, e.g. find_matrices(LowerTriangularMatrix, 3, 3)
+        candidates = None
+        if rows is not None and cols is not None:
+            candidates = self._by_shape.get((rows, cols), {})
+        if matrix_type is not None:
+            # Subclasses count as matches, so SquareMatrix also finds the triangular and diagonal matrices
+            typed = {}
+            for cls, bucket in self._by_type.items():
+                if issubclass(cls, matrix_type):
+                    typed.update(bucket)
+            candidates = typed if candidates is None else {i: e for i, e in candidates.items() if i in typed}
+        if candidates is None:
+            candidates = self._by_id
+        matches = []
+        for entry in (self._by_id[i] for i in sorted(candidates)):
+            # Shapes come from the index keys, so entries from a session file are not loaded
+            entry_rows, entry_cols = self._entry_keys(entry)[1]
+            if (rows is None or entry_rows == rows) and (cols is None or entry_cols == cols):
+                matches.append(entry)
+        return matches
+
+    def describe_structure(self, matrix):
+        # The structure checks are cached on each matrix until it changes, so repeated listings are cheap
+        if not matrix.is_square():
+            return "rectangular"
+        if isinstance(matrix, MappedMatrix):
+            # Scanning would read the whole file; a mapped matrix is described by its shape alone
+            return "square"
+        if matrix.is_diagonal():
+            return "diagonal"
+        if matrix.is_lower_triangular():
+            return "lower triangular"
+        if matrix.is_upper_triangular():
+            return "upper triangular"
+        return "square"
+
+    def _entry_summary(self, entry):
+        if "matrix" not in entry:
+            # Listing a lazily loaded session reads only its header
+            record = entry.record
+            structure = "rectangular" if record.rows != record.cols else {
+                SESSION_LOWER | SESSION_UPPER: "diagonal", SESSION_LOWER: "lower triangular", SESSION_UPPER: "upper triangular"}.get(record.structure, "square")
+            return f"ID: {entry['id']}, Name: {entry['name']}, Type: {record.matrix_type.__name__}, Dimensions: {record.rows}x{record.cols}, Structure: {structure}"
+        matrix = entry["matrix"]
+        return f"ID: {entry['id']}, Name: {entry['name']}, Type: {type(matrix).__name__}, Dimensions: {matrix.rows}x{matrix.cols}, Structure: {self.describe_structure(matrix)}"
 
     def print_matrix(self, matrix_id=None):
         if not self.matrices:
@@ -34,14 +304,14 @@ class MatrixManager:
         if matrix_id is None:
             print("\n--- All Matrices ---")
             for m in self.matrices:
-                print(f"ID: {m['id']}, Name: {m['name']}, Type: {type(m['matrix']).__name__}, Dimensions: {m['matrix'].rows}x{m['matrix'].cols}")
+                print(self._entry_summary(m))
                 print(m["matrix"].to_string())
                 print("--------------------")
         else:
             matrix_obj = self.get_matrix_by_id(matrix_id)
             if matrix_obj:
                 print(f"\n--- Matrix ID: {matrix_id} ---")
-                print(f"Type: {type(matrix_obj).__name__}, Dimensions: {matrix_obj.rows}x{matrix_obj.cols}")
+                print(f"Type: {type(matrix_obj).__name__}, Dimensions: {matrix_obj.rows}x{matrix_obj.cols}, Structure: {self.describe_structure(matrix_obj)}")
                 print(matrix_obj.to_string())
                 print("--------------------")
             else:
@@ -83,30 +353,34 @@ class MatrixManager:
             return
 
         try:
-            with open(file_path, 'r') as f:
-                lines = f.readlines()
-            
-            data = []
-            for line in lines:
-                row_elements = [float(x) for x in line.strip().split()]
-                data.append(row_elements)
-            
-            rows = len(data)
-            if rows == 0:
-                print("File is empty or invalid.")
-                return
-            cols = len(data[0])
-            for row in data:
-                if len(row) != cols:
-                    raise ValueError("Irregular matrix shape in file.")
-
+            new_matrix = read_matrix_file(file_path, progress=self._report_progress if os.path.getsize(file_path) >= FILE_PROGRESS_INTERVAL else None)
             name = input("Enter a name for the matrix (optional): ")
-            new_matrix = create_matrix_from_data(rows, cols, data)
             self.add_matrix(new_matrix, name if name else None)
             print("Matrix loaded from file successfully.")
         except Exception as e:
             print(f"Error reading file: {e}")
 
+    @staticmethod
+    def _report_progress(bytes_read, total_bytes):
+        end = "\n" if bytes_read >= total_bytes else ""
+        print(f"\rReading file... {100 * bytes_read // max(total_bytes, 1)}%", end=end, flush=True)
+
+    def insert_mapped_matrix(self):
+        file_path = input("Enter the path to the raw float64 file (row-major): ")
+        if not os.path.exists(file_path):
+            print("File not found.")
+            return
+        try:
+            rows = int(input("Enter number of rows: "))
+            cols = int(input("Enter number of columns: "))
+            # The file stays on disk; changes made through the calculator are written back to it
+            new_matrix = MappedMatrix(rows, cols, file_path, mode='r+')
+        except ValueError as e:
+            print(f"Error mapping file: {e}")
+            return
+        name = input("Enter a name for the matrix (optional): ")
+        self.add_matrix(new_matrix, name if name else None)
+
     def insert_identity_matrix(self):
         while True:
             try:
@@ -133,12 +407,7 @@ class MatrixManager:
             print("Invalid ID. Please enter a number.")
             return
 
-        matrix_entry = None
-        for m in self.matrices:
-            if m["id"] == matrix_id:
-                matrix_entry = m
-                break
-        
+        matrix_entry = self._by_id.get(matrix_id)
         if not matrix_entry:
             print(f"Matrix with ID {matrix_id} not found.")
             return
@@ -153,7 +422,7 @@ class MatrixManager:
                 row = int(input("Enter row of element to change (0-indexed): "))
                 col = int(input("Enter column of element to change (0-indexed): "))
                 value = float(input("Enter new value: "))
-                matrix_obj.set_element(row, col, value)
+                self.alter_element(matrix_id, row, col, value)
                 print("Element updated successfully.")
                 break
             except (IndexError, ValueError) as e:
@@ -172,9 +441,7 @@ class MatrixManager:
             print("Invalid ID. Please enter a number.")
             return
 
-        original_len = len(self.matrices)
-        self.matrices = [m for m in self.matrices if m["id"] != matrix_id]
-        if len(self.matrices) < original_len:
+        if self.remove_matrix_by_id(matrix_id):
             print(f"Matrix with ID {matrix_id} removed successfully.")
         else:
             print(f"Matrix with ID {matrix_id} not found.")
@@ -185,39 +452,105 @@ class MatrixManager:
             return
         print("\n--- Matrix List ---")
         for m in self.matrices:
-            print(f"ID: {m['id']}, Name: {m['name']}, Type: {type(m['matrix']).__name__}, Dimensions: {m['matrix'].rows}x{m['matrix'].cols}")
+            print(self._entry_summary(m))
         print("-------------------")
 
+    def find_matrices_from_input(self):
+        types = {cls.__name__: cls for cls in (Matrix, SquareMatrix, LowerTriangularMatrix, UpperTriangularMatrix, DiagonalMatrix, SparseMatrix)}
+        type_name = input(f"Filter by type ({', '.join(types)}) (optional): ").strip()
+        if type_name and type_name not in types:
+            print("Unknown matrix type.")
+            return
+        try:
+            rows = input("Filter by number of rows (optional): ").strip()
+            cols = input("Filter by number of columns (optional): ").strip()
+            rows = int(rows) if rows else None
+            cols = int(cols) if cols else None
+        except ValueError:
+            print("Invalid dimensions. Please enter integers.")
+            return
+
+        matches = self.find_matrices(types.get(type_name), rows, cols)
+        if not matches:
+            print("No matching matrices.")
+            return
+        print("\n--- Matching Matrices ---")
+        for m in matches:
+            print(self._entry_summary(m))
+        print("-------------------------")
+
+    def profile_operations(self):
+        # Turns operation profiling on or off, or shows, exports or clears what it has recorded
+        state = "on" if is_profiling() else "off"
+        sub_choice = input(f"Profiling is {state}. Toggle (t), show (s), export to JSON (e) or reset (r)? ").lower()
+        if sub_choice == 't':
+            if is_profiling():
+                disable_profiling()
+            else:
+                enable_profiling()
+            print(f"Profiling turned {'on' if is_profiling() else 'off'}.")
+        elif sub_choice == 's':
+            print(format_profile())
+        elif sub_choice == 'e':
+            file_name = input("Enter filename for the profile (e.g., profile.json): ")
+            try:
+                export_profile(file_name)
+                print(f"Profile written to {file_name}.")
+            except OSError as e:
+                print(f"Error writing profile: {e}")
+        elif sub_choice == 'r':
+            reset_profile()
+            print("Profile cleared.")
+        else:
+            print("Invalid choice.")
+
     def save_matrices(self):
         if not self.matrices:
             print("No matrices to save.")
             return
-        file_name = input("Enter filename to save matrices (e.g., my_matrices.pkl): ")
+        file_name = input("Enter filename to save matrices (e.g., my_matrices.mtx): ")
         try:
-            with open(file_name, 'wb') as f:
-                pickle.dump(self.matrices, f)
+            self.save_session(file_name)
             print(f"Matrices saved to {file_name} successfully.")
         except Exception as e:
             print(f"Error saving matrices: {e}")
 
+    def save_session(self, file_name):
+        # Matrices never loaded from an open session are copied across as raw bytes
+        write_session(file_name, [(m["id"], m["name"], m["matrix"] if "matrix" in m else m.record) for m in self.matrices])
+
+    def load_session(self, file_name, append=True):
+        # Returns the IDs given to the loaded matrices; only the index is read until a matrix is used
+        with open(file_name, 'rb') as f:
+            legacy = f.read(len(SESSION_MAGIC)) != SESSION_MAGIC
+        if legacy:
+            # Sessions saved before the binary format are lists of pickled entries
+            with open(file_name, 'rb') as f:
+                loaded_matrices = pickle.load(f)
+            if not append:
+                self.clear()
+            return [self.add_matrix(loaded_m["matrix"], loaded_m["name"]) for loaded_m in loaded_matrices]
+        session = SessionFile(file_name)
+        if not append:
+            self.clear()
+        self._sessions.append(session)
+        ids = []
+        for record in session.records:
+            self._index(_SessionEntry(self.next_id, record))
+            self._log("add", self.next_id, record.name, record)
+            ids.append(self.next_id)
+            self.next_id += 1
+        return ids
+
     def load_matrices(self, append=True):
         file_name = input("Enter filename to load matrices from: ")
         if not os.path.exists(file_name):
             print("File not found.")
             return
         try:
-            with open(file_name, 'rb') as f:
-                loaded_matrices = pickle.load(f)
-            
-            if not append:
-                self.matrices = []
-                self.next_id = 1
-
-            for loaded_m in loaded_matrices:
-                # Ensure loaded matrices are re-instantiated with correct types if needed
-                # For simplicity, assuming pickle handles custom class instances correctly
-                # If not, a custom deserialization logic would be needed here.
-                self.add_matrix(loaded_m["matrix"], loaded_m["name"])
+            ids = self.load_session(file_name, append)
+            if ids:
+                print(f"{len(ids)} matrices loaded from {file_name} with IDs {ids[0]} to {ids[-1]}.")
             print(f"Matrices loaded from {file_name} successfully.")
         except Exception as e:
             print(f"Error loading matrices: {e}")
@@ -225,8 +558,7 @@ class MatrixManager:
     def clear_matrices(self):
         confirm = input("Are you sure you want to clear all matrices? (yes/no): ").lower()
         if confirm == 'yes':
-            self.matrices = []
-            self.next_id = 1
+            self.clear()
             print("All matrices cleared.")
         else:
             print("Operation cancelled.")
@@ -244,7 +576,9 @@ class MatrixManager:
         print("4. Matrix Multiplication (A x B)")
         print("5. Transpose (A^T)")
         print("6. Trace (of A, if square)")
-        print("7. Determinant (of A, if triangular)")
+        print("7. Determinant (of A, if square)")
+        print("8. Inverse (of A, if square)")
+        print("9. Chain Multiplication (A x B x C x ...)")
         print("-------------------------")
 
         choice = input("Enter operation choice: ")
@@ -312,7 +646,7 @@ class MatrixManager:
                     print("Matrix not found.")
                     return
                 
-                if isinstance(matrix_a, SquareMatrix):
+                if isinstance(matrix_a, SquareMatrix) or (isinstance(matrix_a, SparseMatrix) and matrix_a.is_square()):
                     _trace = matrix_a.trace()
                     print(f"\n--- Trace of Matrix ID {id_matrix} ---")
                     print(f"Trace: {_trace:.2f}")
@@ -327,12 +661,53 @@ class MatrixManager:
                     print("Matrix not found.")
                     return
                 
-                if isinstance(matrix_a, (LowerTriangularMatrix, UpperTriangularMatrix, DiagonalMatrix)):
+                if isinstance(matrix_a, SquareMatrix) or (isinstance(matrix_a, SparseMatrix) and matrix_a.is_square()):
                     _determinant = matrix_a.determinant()
                     print(f"\n--- Determinant of Matrix ID {id_matrix} ---")
                     print(f"Determinant: {_determinant:.2f}")
                 else:
-                    print("Determinant (optimized) is only defined for triangular or diagonal matrices.")
+                    print("Determinant is only defined for square matrices.")
+
+            elif choice == '8':
+                id_matrix = int(input("Enter ID of matrix to invert (A): "))
+                matrix_a = self.get_matrix_by_id(id_matrix)
+
+                if not matrix_a:
+                    print("Matrix not found.")
+                    return
+
+                if not (isinstance(matrix_a, SquareMatrix) or (isinstance(matrix_a, SparseMatrix) and matrix_a.is_square())):
+                    print("Inverse is only defined for square matrices.")
+                    return
+
+                try:
+                    result = matrix_a.inverse()
+                except ValueError as e:
+                    print(f"Operation error: {e}")
+                    return
+                print("\n--- Result of Inversion ---")
+                print(result.to_string())
+                name = input("Enter a name for the result matrix (Inverse) (optional): ")
+                self.add_matrix(result, name if name else None)
+
+            elif choice == '9':
+                ids = [int(x) for x in input("Enter IDs of the matrices in order (space-separated): ").split()]
+                if len(ids) < 2:
+                    print("Need at least two matrices for chain multiplication.")
+                    return
+                chain = [self.get_matrix_by_id(matrix_id) for matrix_id in ids]
+                if any(matrix is None for matrix in chain):
+                    print("One or more matrices not found.")
+                    return
+
+                plan = plan_chain(chain)
+                print(f"\nEvaluation order: {plan.describe([f'ID{matrix_id}' for matrix_id in ids])}")
+                print(f"Estimated multiply-adds: {plan.flops} (left to right: {plan.naive_flops})")
+                result = multiply_chain(chain, plan)
+                print("\n--- Result of Chain Multiplication ---")
+                print(result.to_string())
+                name = input("Enter a name for the result matrix (Chain Multiplication) (optional): ")
+                self.add_matrix(result, name if name else None)
 
             else:
                 print("Invalid operation choice.")
@@ -344,8 +719,323 @@ class MatrixManager:
         except Exception as e:
             print(f"An unexpected error occurred: {e}")
 
-def main_menu():
+# Script steps: the fields their positional operands fill in the line syntax ("args*" takes the rest)
+# and whether they bind a result name. open and save act on the whole registry and run on their own.
+SCRIPT_OPERATIONS = {
+    "load": (("path",), True),
+    "map": (("path", "rows", "cols"), True),
+    "identity": (("size",), True),
+    "add": (("args", "args"), True),
+    "subtract": (("args", "args"), True),
+    "multiply": (("args", "args"), True),
+    "transpose": (("args",), True),
+    "inverse": (("args",), True),
+    "chain": (("args*",), True),
+    "trace": (("args",), False),
+    "determinant": (("args",), False),
+    "print": (("args",), False),
+    "write": (("args", "path"), False),
+    "open": (("path",), False),
+    "save": (("path",), False),
+}
+_SCRIPT_BARRIERS = ("open", "save")
+_SCRIPT_OPERATORS = {"+": "add", "-": "subtract", "*": "multiply"}
+
+
+def parse_script(text):
+    # A JSON list of step objects ({"op": "add", "name": "C", "args": ["A", "B"]}, ...), or one step
+    # per line in the short form below, with # comments:
+    #   A = load a.txt          M = map big.f64 5000 5000      I = identity 3
+    #   C = A + B               D = A * 2.5                    T = transpose A
+    #   V = inverse A           P = chain A B C                print C
+    #   trace A                 determinant A                  write C c.txt
+    #   open in.mtx             save out.mtx
+    if text.lstrip().startswith("["):
+        steps = json.loads(text)
+        for number, step in enumerate(steps, 1):
+            if not isinstance(step, dict):
+                raise ValueError(f"Step {number}: each step must be an object.")
+            step.setdefault("line", number)
+    else:
+        steps = []
+        for number, line in enumerate(text.splitlines(), 1):
+            tokens = shlex.split(line, comments=True)
+            if tokens:
+                steps.append(_parse_script_line(tokens, number))
+    for step in steps:
+        _check_script_step(step)
+    return steps
+
+
+def _parse_script_line(tokens, number):
+    step = {"line": number}
+    if len(tokens) >= 2 and tokens[1] == "=":
+        step["name"] = tokens[0]
+        tokens = tokens[2:]
+        if len(tokens) == 3 and tokens[1] in _SCRIPT_OPERATORS:
+            tokens = [_SCRIPT_OPERATORS[tokens[1]], tokens[0], tokens[2]]
+    if not tokens or tokens[0] not in SCRIPT_OPERATIONS:
+        raise ValueError(f"Line {number}: unknown operation '{' '.join(tokens)}'.")
+    step["op"] = tokens[0]
+    fields, _ = SCRIPT_OPERATIONS[step["op"]]
+    operands = tokens[1:]
+    if fields == ("args*",):
+        step["args"] = operands
+    elif len(operands) != len(fields):
+        raise ValueError(f"Line {number}: '{step['op']}' takes {len(fields)} operand(s).")
+    else:
+        for field, operand in zip(fields, operands):
+            if field in ("rows", "cols", "size"):
+                step[field] = int(operand)
+            elif field == "args":
+                step.setdefault("args", []).append(operand)
+            else:
+                step[field] = operand
+    if step["op"] == "multiply":
+        # A numeric right operand is a scalar
+        try:
+            step["args"][1] = float(step["args"][1])
+        except ValueError:
+            pass
+    return step
+
+
+def _check_script_step(step):
+    where = f"Line {step.get('line')}"
+    op = step.get("op")
+    if op not in SCRIPT_OPERATIONS:
+        raise ValueError(f"{where}: unknown operation '{op}'.")
+    fields, named = SCRIPT_OPERATIONS[op]
+    if named and not isinstance(step.get("name"), str):
+        raise ValueError(f"{where}: '{op}' needs a result name.")
+    if not named and step.get("name") is not None:
+        raise ValueError(f"{where}: '{op}' does not produce a matrix to name.")
+    for field in set(fields):
+        if field not in step and not (field == "args*" and "args" in step):
+            raise ValueError(f"{where}: '{op}' needs '{field.rstrip('*')}'.")
+    args = step.get("args", [])
+    expected = fields.count("args")
+    if (expected and len(args) != expected) or ("args*" in fields and len(args) < 2):
+        raise ValueError(f"{where}: '{op}' has the wrong number of matrices.")
+
+
+def _script_keys(step):
+    # (read, written) names a step touches; files count too, so a load waits for the write before it
+    reads = {("matrix", arg) for arg in step.get("args", []) if isinstance(arg, str)}
+    writes = set()
+    if step.get("name") is not None:
+        writes.add(("matrix", step["name"]))
+    if step["op"] in ("load", "map"):
+        reads.add(("file", os.path.abspath(step["path"])))
+    elif step["op"] == "write":
+        writes.add(("file", os.path.abspath(step["path"])))
+    return reads, writes
+
+
+def _script_dependencies(steps):
+    # Step i waits for the last writer of everything it reads and, before writing, for the earlier
+    # readers and writer of that name; everything waits for the barrier steps around it
+    dependencies = []
+    last_writer = {}
+    readers = {}
+    barrier = None
+    for i, step in enumerate(steps):
+        if step["op"] in _SCRIPT_BARRIERS:
+            start = 0 if barrier is None else barrier
+            dependencies.append(set(range(start, i)))
+            barrier = i
+            last_writer = {}
+            readers = {}
+            continue
+        depends = set() if barrier is None else {barrier}
+        reads, writes = _script_keys(step)
+        for key in reads:
+            if key in last_writer:
+                depends.add(last_writer[key])
+            readers.setdefault(key, []).append(i)
+        for key in writes:
+            if key in last_writer:
+                depends.add(last_writer[key])
+            depends.update(reader for reader in readers.pop(key, []) if reader != i)
+            last_writer[key] = i
+        dependencies.append(depends)
+    return dependencies
+
+
+def _run_script_step(step, operands):
+    # Runs on a worker thread; returns (result matrix or None, output text or None)
+    op = step["op"]
+    if op == "load":
+        return read_matrix_file(step["path"]), None
+    if op == "map":
+        return MappedMatrix(step["rows"], step["cols"], step["path"], mode='r'), None
+    if op == "identity":
+        size = step["size"]
+        if not isinstance(size, int) or size <= 0:
+            raise ValueError("Identity size must be a positive integer.")
+        return DiagonalMatrix(size, size, array('d', [1.0]) * size, optimized=True), None
+    if op == "add":
+        return operands[0] + operands[1], None
+    if op == "subtract":
+        return operands[0] - operands[1], None
+    if op == "multiply":
+        return operands[0] * operands[1], None
+    if op == "transpose":
+        return operands[0].transpose(), None
+    if op == "inverse":
+        if not (isinstance(operands[0], SquareMatrix) or (isinstance(operands[0], SparseMatrix) and operands[0].is_square())):
+            raise TypeError("Inverse is only defined for square matrices.")
+        return operands[0].inverse(), None
+    if op == "chain":
+        return multiply_chain(operands), None
+    name = step["args"][0]
+    matrix = operands[0]
+    if op in ("trace", "determinant"):
+        if not matrix.is_square():
+            raise TypeError(f"{op.capitalize()} is only defined for square matrices.")
+        if not hasattr(matrix, op):
+            # Results of generic operations are plain Matrix objects even when square
+            matrix = SquareMatrix(matrix.rows, matrix.cols, array('d', matrix._dense_data()), optimized=True)
+        return None, f"{op} {name} = {getattr(matrix, op)()!r}\n"
+    if op == "print":
+        return None, f"{name} ({type(matrix).__name__}, {matrix.rows}x{matrix.cols}):\n{matrix.to_string()}"
+    # write: one row per line in the format read_matrix_file reads back
+    data = matrix._dense_data()
+    cols = matrix.cols
+    with open(step["path"], 'w') as f:
+        for start in range(0, matrix.rows * cols, cols):
+            f.write(" ".join(repr(value) for value in data[start:start + cols]) + "\n")
+    return None, None
+
+
+def run_script(manager, steps, workers=None, out=None):
+    # Runs parsed steps against manager without prompting. Steps whose inputs are ready run
+    # concurrently on a pool of worker threads; results are registered under their names (a name bound
+    # again replaces its matrix) and step output is written to out in script order as it completes.
+    out = out if out is not None else sys.stdout
+    dependencies = _script_dependencies(steps)
+    dependents = [[] for _ in steps]
+    waiting = [len(depends) for depends in dependencies]
+    for i, depends in enumerate(dependencies):
+        for j in depends:
+            dependents[j].append(i)
+    ready = [i for i, count in enumerate(waiting) if count == 0]
+    heapq.heapify(ready)
+    bindings = {}
+    outputs = {}
+    next_output = 0
+    running = {}
+    failure = None
+
+    def resolve(name):
+        matrix = manager.get_matrix_by_id(bindings[name]) if name in bindings else manager.get_matrix_by_name(name)
+        if matrix is None:
+            raise ValueError(f"Unknown matrix '{name}'.")
+        return matrix
+
+    def finish(i, matrix, text):
+        step = steps[i]
+        if step.get("name") is not None:
+            if step["name"] in bindings:
+                manager.remove_matrix_by_id(bindings[step["name"]])
+            bindings[step["name"]] = manager._register(matrix, step["name"])
+        outputs[i] = text
+        for j in dependents[i]:
+            waiting[j] -= 1
+            if waiting[j] == 0:
+                heapq.heappush(ready, j)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while failure is None and (ready or running):
+            while ready and failure is None:
+                i = heapq.heappop(ready)
+                step = steps[i]
+                try:
+                    if step["op"] == "open":
+                        # The session's matrices take over their names from anything bound before
+                        for matrix_id in manager.load_session(step["path"]):
+                            bindings[manager._by_id[matrix_id]["name"]] = matrix_id
+                        finish(i, None, None)
+                    elif step["op"] == "save":
+                        manager.save_session(step["path"])
+                        finish(i, None, None)
+                    else:
+                        operands = [resolve(arg) if isinstance(arg, str) else arg for arg in step.get("args", [])]
+                        running[pool.submit(_run_script_step, step, operands)] = i
+                except Exception as e:
+                    failure = (i, e)
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                i = running.pop(future)
+                try:
+                    finish(i, *future.result())
+                except Exception as e:
+                    failure = failure or (i, e)
+            while next_output in outputs:
+                if outputs[next_output]:
+                    out.write(outputs[next_output])
+                    out.flush()
+                del outputs[next_output]
+                next_output += 1
+        # Steps already running are allowed to finish before an error is reported
+        wait(running)
+    if failure is not None:
+        i, error = failure
+        raise ValueError(f"Step {i + 1} (line {steps[i].get('line')}, {steps[i]['op']}): {error}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Matrix calculator. Without --script the interactive menu is shown.")
+    parser.add_argument("--script", help="Run the steps in this file (line syntax or a JSON list; - reads stdin) without prompts.")
+    parser.add_argument("--workers", type=int, default=None, help="Worker threads for independent script steps.")
+    parser.add_argument("--journal", default=os.environ.get(JOURNAL_ENV_VAR), help=f"Session file to journal changes to (default: ${JOURNAL_ENV_VAR}).")
+    parser.add_argument("--profile", metavar="PATH", help="Record per-operation statistics and write them to this JSON file on exit.")
+    parser.add_argument("--cprofile", metavar="PATH", help="Run cProfile during matrix operations and dump its stats (pstats format) here on exit.")
+    args = parser.parse_args(argv)
+    profiler = cProfile.Profile() if args.cprofile else None
+    if args.profile or profiler is not None:
+        enable_profiling(profiler)
+    try:
+        return _run(args)
+    finally:
+        if args.profile:
+            export_profile(args.profile)
+        if profiler is not None:
+            profiler.dump_stats(args.cprofile)
+        if args.profile or profiler is not None:
+            disable_profiling()
+
+
+def _run(args):
+    if args.script is None:
+        main_menu(args.journal)
+        return 0
+
+    manager = MatrixManager(args.journal)
+    try:
+        if args.script == "-":
+            text = sys.stdin.read()
+        else:
+            with open(args.script) as f:
+                text = f.read()
+        run_script(manager, parse_script(text), workers=args.workers)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        manager.close_journal()
+    return 0
+
+
+def main_menu(journal_path=None):
     manager = MatrixManager()
+    if journal_path is None:
+        journal_path = os.environ.get(JOURNAL_ENV_VAR)
+    if journal_path:
+        manager.open_journal(journal_path)
+        print(f"Journaling to {journal_path} ({len(manager.matrices)} matrices restored).")
     while True:
         print("\n--- Matrix Calculator Menu ---")
         print("1. Print Matrix(es)")
@@ -360,6 +1050,9 @@ def main_menu():
         print("10. Load Matrices from File (Append)")
         print("11. Load Matrices from File (Replace)")
         print("12. Clear All Matrices")
+        print("13. Find Matrices (by type/dimensions)")
+        print("14. Insert Memory-Mapped Matrix (raw float64 file)")
+        print("15. Operation Profile (toggle/show/export/reset)")
         print("0. Exit")
         print("----------------------------")
 
@@ -402,13 +1095,20 @@ def main_menu():
             manager.load_matrices(append=False)
         elif choice == '12':
             manager.clear_matrices()
+        elif choice == '13':
+            manager.find_matrices_from_input()
+        elif choice == '14':
+            manager.insert_mapped_matrix()
+        elif choice == '15':
+            manager.profile_operations()
         elif choice == '0':
+            manager.close_journal()
             print("Exiting Matrix Calculator. Goodbye!")
             break
         else:
             print("Invalid choice. Please try again.")
 
 if __name__ == "__main__":
-    main_menu()
+    sys.exit(main())
 
 
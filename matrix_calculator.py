@@ -1,13 +1,840 @@
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import functools
+import json
+import mmap
+import operator
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Tile edge used by matmul_kernel; tune per host (larger tiles mean fewer Python-level loops).
+MATMUL_BLOCK_SIZE = 64
+
+
+def _strided_slice(buffer, start, step, count):
+    # count elements of buffer from start, step apart (step may be negative)
+    stop = start + count * step
+    return buffer[start:stop if stop >= 0 else None:step]
+
+
+def _gather_strided(buffer, offset, row_stride, col_stride, rows, cols):
+    # Copies the rows x cols window at offset + r * row_stride + c * col_stride into a row-major buffer
+    if col_stride == 1 and row_stride == cols:
+        return buffer[offset:offset + rows * cols]
+    result = array('d')
+    if isinstance(buffer, memoryview):
+        # array.extend walks a memoryview (e.g. a MappedMatrix) element by element; frombytes copies
+        # each row at C speed, strided rows after packing them with tobytes
+        for r in range(rows):
+            row = _strided_slice(buffer, offset + r * row_stride, col_stride, cols)
+            result.frombytes(row.cast('B') if col_stride == 1 else row.tobytes())
+        return result
+    for r in range(rows):
+        result.extend(_strided_slice(buffer, offset + r * row_stride, col_stride, cols))
+    return result
+
+
+def matmul_kernel(a, b, rows, inner, cols, block_size=None, a_layout=None, b_layout=None):
+    # Multiplies two flat row-major buffers (rows x inner) * (inner x cols) and returns a new buffer.
+    # Loops run in i-k-j order over square tiles, so each step streams a cached row of a tile of b
+    # into the matching row of the result instead of walking down the columns of b.
+    # An (offset, row_stride, col_stride) layout reads an operand in place from a larger or transposed
+    # buffer, e.g. a MatrixView, instead of requiring a row-major copy.
+    if block_size is None:
+        block_size = MATMUL_BLOCK_SIZE
+    if not isinstance(block_size, int) or block_size <= 0:
+        raise ValueError("Block size must be a positive integer.")
+
+    a_offset, a_row_stride, a_col_stride = a_layout or (0, inner, 1)
+    b_offset, b_row_stride, b_col_stride = b_layout or (0, cols, 1)
+
+    result = array('d', bytes(8 * rows * cols))
+    for j0 in range(0, cols, block_size):
+        j1 = min(j0 + block_size, cols)
+        b_start = b_offset + j0 * b_col_stride
+        b_tile = [_strided_slice(b, b_start + k * b_row_stride, b_col_stride, j1 - j0).tolist() for k in range(inner)]
+        for i0 in range(0, rows, block_size):
+            i1 = min(i0 + block_size, rows)
+            for k0 in range(0, inner, block_size):
+                k1 = min(k0 + block_size, inner)
+                for i in range(i0, i1):
+                    a_start = a_offset + i * a_row_stride
+                    out_start = i * cols
+                    acc = result[out_start + j0:out_start + j1].tolist()
+                    for k in range(k0, k1):
+                        a_ik = a[a_start + k * a_col_stride]
+                        if a_ik:
+                            acc = [x + a_ik * y for x, y in zip(acc, b_tile[k])]
+                    result[out_start + j0:out_start + j1] = array('d', acc)
+    return result
+
+
+# Square products at least this large consult the Strassen crossover; smaller ones always use the
+# classical kernel. The crossover is fixed unless set or calibrated explicitly, so products are reproducible.
+STRASSEN_MIN_SIZE = 128
+STRASSEN_DEFAULT_CROSSOVER = 128
+STRASSEN_ENV_VAR = "MATRIX_STRASSEN_CROSSOVER"
+STRASSEN_CALIBRATION_SIZES = (64, 128, 256)
+_strassen_crossover = None
+
+
+def _quadrants(a, n):
+    h = n // 2
+    q11, q12, q21, q22 = array('d'), array('d'), array('d'), array('d')
+    for r in range(h):
+        start = r * n
+        q11.extend(a[start:start + h])
+        q12.extend(a[start + h:start + n])
+    for r in range(h, n):
+        start = r * n
+        q21.extend(a[start:start + h])
+        q22.extend(a[start + h:start + n])
+    return q11, q12, q21, q22
+
+
+def _join_quadrants(c11, c12, c21, c22, h):
+    result = array('d')
+    for top, bottom in ((c11, c12), (c21, c22)):
+        for r in range(h):
+            result.extend(top[r * h:(r + 1) * h])
+            result.extend(bottom[r * h:(r + 1) * h])
+    return result
+
+
+def _resize_square(a, n, size):
+    # Copies the top-left min(n, size) square of an n x n buffer into a zero-filled size x size buffer
+    result = array('d', bytes(8 * size * size))
+    width = min(n, size)
+    for r in range(width):
+        result[r * size:r * size + width] = a[r * n:r * n + width]
+    return result
+
+
+def _winograd(a, b, n, crossover):
+    # Strassen-Winograd: 7 half-size products and 15 block additions per level
+    if n < crossover:
+        return matmul_kernel(a, b, n, n, n)
+    h = n // 2
+    add = lambda x, y: array('d', map(operator.add, x, y))
+    sub = lambda x, y: array('d', map(operator.sub, x, y))
+    a11, a12, a21, a22 = _quadrants(a, n)
+    b11, b12, b21, b22 = _quadrants(b, n)
+    s1 = add(a21, a22)
+    s2 = sub(s1, a11)
+    s3 = sub(a11, a21)
+    s4 = sub(a12, s2)
+    t1 = sub(b12, b11)
+    t2 = sub(b22, t1)
+    t3 = sub(b22, b12)
+    t4 = sub(t2, b21)
+    p1 = _winograd(a11, b11, h, crossover)
+    p2 = _winograd(a12, b21, h, crossover)
+    p3 = _winograd(s4, b22, h, crossover)
+    p4 = _winograd(a22, t4, h, crossover)
+    p5 = _winograd(s1, t1, h, crossover)
+    p6 = _winograd(s2, t2, h, crossover)
+    p7 = _winograd(s3, t3, h, crossover)
+    u2 = add(p1, p6)
+    u3 = add(u2, p7)
+    return _join_quadrants(add(p1, p2), add(add(u2, p5), p3), sub(u3, p4), add(u3, p5), h)
+
+
+def strassen_kernel(a, b, n, crossover=None):
+    # Multiplies two flat row-major n x n buffers with the Strassen-Winograd recursion, switching to
+    # matmul_kernel once a block is smaller than the crossover. Sizes that do not halve evenly down to
+    # the crossover are zero-padded once, up front, to the nearest m * 2**k with m below the crossover.
+    if crossover is None:
+        crossover = get_strassen_crossover()
+    if not isinstance(crossover, int) or crossover < 2:
+        raise ValueError("Strassen crossover must be an integer of at least 2.")
+
+    levels = 0
+    base = n
+    while base >= crossover:
+        base = (base + 1) // 2
+        levels += 1
+    size = base << levels
+    if size == n:
+        return _winograd(a, b, n, crossover)
+    product = _winograd(_resize_square(a, n, size), _resize_square(b, n, size), size, crossover)
+    return _resize_square(product, size, n)
+
+
+def calibrate_strassen_crossover(sizes=None):
+    # Times the classical kernel against one Strassen level at each size and keeps the smallest size
+    # where the split pays off (twice the largest size if it never does)
+    sizes = sorted(sizes or STRASSEN_CALIBRATION_SIZES)
+    crossover = 2 * sizes[-1]
+    for size in sizes:
+        a = array('d', [((i * 7919) % 1009) / 1009.0 - 0.5 for i in range(size * size)])
+        b = array('d', [((i * 104729) % 1013) / 1013.0 - 0.5 for i in range(size * size)])
+        start = time.perf_counter()
+        matmul_kernel(a, b, size, size, size)
+        classical = time.perf_counter() - start
+        start = time.perf_counter()
+        _winograd(a, b, size, size)  # crossover == size: exactly one level of recursion
+        split = time.perf_counter() - start
+        if split < classical:
+            crossover = size
+            break
+    set_strassen_crossover(crossover)
+    return crossover
+
+
+def get_strassen_crossover():
+    # An explicit setting (or calibration) wins, then MATRIX_STRASSEN_CROSSOVER, then the fixed default
+    if _strassen_crossover is not None:
+        return _strassen_crossover
+    value = os.environ.get(STRASSEN_ENV_VAR, "").strip()
+    if value.isdigit() and int(value) >= 2:
+        return int(value)
+    return STRASSEN_DEFAULT_CROSSOVER
+
+
+def set_strassen_crossover(size):
+    global _strassen_crossover
+    if size is not None and (not isinstance(size, int) or size < 2):
+        raise ValueError("Strassen crossover must be an integer of at least 2.")
+    _strassen_crossover = size
+
+
+def _lu_decompose(a, n):
+    # Doolittle LU with partial pivoting on a copy of the flat n x n buffer. Returns the working rows,
+    # holding U on and above the diagonal and the multipliers of the unit lower L below it, the row
+    # permutation (row i of P * A is row perm[i] of A) and the permutation sign.
+    rows = [a[r * n:(r + 1) * n].tolist() for r in range(n)]
+    perm = list(range(n))
+    sign = 1.0
+    for k in range(n):
+        pivot_row = max(range(k, n), key=lambda r: abs(rows[r][k]))
+        if pivot_row != k:
+            rows[k], rows[pivot_row] = rows[pivot_row], rows[k]
+            perm[k], perm[pivot_row] = perm[pivot_row], perm[k]
+            sign = -sign
+        pivot = rows[k][k]
+        if pivot == 0:
+            continue  # The whole column is zero from here down, so the matrix is singular
+        pivot_tail = rows[k][k + 1:]
+        for r in range(k + 1, n):
+            row = rows[r]
+            factor = row[k] / pivot
+            row[k] = factor
+            if factor:
+                row[k + 1:] = [x - factor * y for x, y in zip(row[k + 1:], pivot_tail)]
+    return rows, perm, sign
+
+
+def _determinant_python(a, n):
+    rows, _, _determinant = _lu_decompose(a, n)
+    for i in range(n):
+        _determinant *= rows[i][i]
+    return _determinant
+
+
+class PythonBackend:
+    # Pure-Python kernels over flat row-major array('d') buffers
+    name = "python"
+
+    def add(self, a, b):
+        return array('d', map(operator.add, a, b))
+
+    def subtract(self, a, b):
+        return array('d', map(operator.sub, a, b))
+
+    def scale(self, a, scalar):
+        return array('d', [value * scalar for value in a])
+
+    # The *_into variants write into an existing buffer of the result's length (which may be one of
+    # the operands) instead of returning a new one
+    def add_into(self, a, b, out):
+        out[:] = array('d', map(operator.add, a, b))
+
+    def subtract_into(self, a, b, out):
+        out[:] = array('d', map(operator.sub, a, b))
+
+    def scale_into(self, a, scalar, out):
+        out[:] = array('d', [value * scalar for value in a])
+
+    def matmul_into(self, a, b, rows, inner, cols, out):
+        out[:] = self.matmul(a, b, rows, inner, cols)
+
+    def matmul(self, a, b, rows, inner, cols):
+        if rows == inner == cols and rows >= STRASSEN_MIN_SIZE:
+            crossover = get_strassen_crossover()
+            if rows >= crossover:
+                return strassen_kernel(a, b, rows, crossover)
+        return matmul_kernel(a, b, rows, inner, cols)
+
+    def matmul_strided(self, a, a_layout, b, b_layout, rows, inner, cols):
+        # Operands read in place through (offset, row_stride, col_stride) layouts
+        return matmul_kernel(a, b, rows, inner, cols, a_layout=a_layout, b_layout=b_layout)
+
+    def transpose(self, a, rows, cols):
+        transposed = array('d')
+        for c in range(cols):
+            transposed.extend(a[c::cols])
+        return transposed
+
+    def determinant(self, a, n):
+        return _determinant_python(a, n)
+
+    def linear_combination(self, buffers, coefficients):
+        # sum of coefficients[i] * buffers[i] in one pass with a single output buffer
+        if len(buffers) == 1:
+            c0 = coefficients[0]
+            return array('d', [c0 * x for x in buffers[0]])
+        if len(buffers) == 2:
+            c0, c1 = coefficients
+            return array('d', [c0 * x + c1 * y for x, y in zip(*buffers)])
+        return array('d', [sum(map(operator.mul, coefficients, values)) for values in zip(*buffers)])
+
+    def batch_matmul(self, a, b, count, rows, inner, cols):
+        # count products of rows x inner by inner x cols blocks; a b holding a single block is shared.
+        # With more matrices than columns the loops run across the batch: a[r * inner + k::a_size] is
+        # element (r, k) of every matrix at once, so each step is one pass over count values.
+        a_size = rows * inner
+        b_size = inner * cols
+        shared = len(b) == b_size
+        if count < cols:
+            if shared:
+                return array('d', [x for start in range(0, count * a_size, a_size)
+                                   for x in matmul_kernel(a[start:start + a_size], b, rows, inner, cols)])
+            return array('d', [x for m in range(count)
+                               for x in matmul_kernel(a[m * a_size:(m + 1) * a_size], b[m * b_size:(m + 1) * b_size],
+                                                      rows, inner, cols)])
+
+        out_size = rows * cols
+        result = array('d', bytes(8 * count * out_size))
+        a_columns = [a[i::a_size].tolist() for i in range(a_size)]
+        b_columns = b.tolist() if shared else [b[i::b_size].tolist() for i in range(b_size)]
+        for r in range(rows):
+            a_row = a_columns[r * inner:(r + 1) * inner]
+            for c in range(cols):
+                b_column = b_columns[c::cols]
+                if shared:
+                    acc = [x * b_column[0] for x in a_row[0]]
+                    for a_values, b_value in zip(a_row[1:], b_column[1:]):
+                        acc = [s + x * b_value for s, x in zip(acc, a_values)]
+                else:
+                    acc = list(map(operator.mul, a_row[0], b_column[0]))
+                    for a_values, b_values in zip(a_row[1:], b_column[1:]):
+                        acc = [s + x * y for s, x, y in zip(acc, a_values, b_values)]
+                result[r * cols + c::out_size] = array('d', acc)
+        return result
+
+    def batch_transpose(self, a, count, rows, cols):
+        size = rows * cols
+        transposed = array('d', bytes(8 * count * size))
+        for r in range(rows):
+            for c in range(cols):
+                transposed[c * rows + r::size] = a[r * cols + c::size]
+        return transposed
+
+    def batch_trace(self, a, count, n):
+        size = n * n
+        return list(map(sum, zip(*[a[i * (n + 1)::size] for i in range(n)])))
+
+    def batch_determinant(self, a, count, n):
+        size = n * n
+        if n <= 3:
+            # Closed forms, evaluated across the batch from the strided element slices
+            elements = [a[i::size] for i in range(size)]
+            if n == 1:
+                return elements[0].tolist()
+            if n == 2:
+                return [p * s - q * r for p, q, r, s in zip(*elements)]
+            return [e0 * (e4 * e8 - e5 * e7) - e1 * (e3 * e8 - e5 * e6) + e2 * (e3 * e7 - e4 * e6)
+                    for e0, e1, e2, e3, e4, e5, e6, e7, e8 in zip(*elements)]
+        return [_determinant_python(a[start:start + size], n) for start in range(0, count * size, size)]
+
+
+class NumpyBackend:
+    # Wraps the flat buffers as NumPy arrays without copying and hands the work to NumPy/BLAS
+    name = "numpy"
+
+    def _view(self, a, rows=None, cols=None):
+        view = numpy.frombuffer(a, dtype=numpy.float64)
+        if rows is not None:
+            view = view.reshape(rows, cols)
+        return view
+
+    def add(self, a, b):
+        return array('d', (self._view(a) + self._view(b)).tobytes())
+
+    def subtract(self, a, b):
+        return array('d', (self._view(a) - self._view(b)).tobytes())
+
+    def scale(self, a, scalar):
+        return array('d', (self._view(a) * scalar).tobytes())
+
+    def add_into(self, a, b, out):
+        numpy.add(self._view(a), self._view(b), out=self._view(out))
+
+    def subtract_into(self, a, b, out):
+        numpy.subtract(self._view(a), self._view(b), out=self._view(out))
+
+    def scale_into(self, a, scalar, out):
+        numpy.multiply(self._view(a), scalar, out=self._view(out))
+
+    def matmul_into(self, a, b, rows, inner, cols, out):
+        # NumPy detects the overlap when out is also an operand and buffers as needed
+        numpy.matmul(self._view(a, rows, inner), self._view(b, inner, cols), out=self._view(out, rows, cols))
+
+    def matmul(self, a, b, rows, inner, cols):
+        return array('d', (self._view(a, rows, inner) @ self._view(b, inner, cols)).tobytes())
+
+    def _strided_view(self, a, layout, rows, cols):
+        # Zero-copy NumPy view of an (offset, row_stride, col_stride) window; BLAS takes transposed
+        # operands as they are
+        offset, row_stride, col_stride = layout
+        base = self._view(a)[offset:]
+        return numpy.lib.stride_tricks.as_strided(base, shape=(rows, cols),
+                                                  strides=(base.itemsize * row_stride, base.itemsize * col_stride))
+
+    def matmul_strided(self, a, a_layout, b, b_layout, rows, inner, cols):
+        product = self._strided_view(a, a_layout, rows, inner) @ self._strided_view(b, b_layout, inner, cols)
+        return array('d', product.tobytes())
+
+    def transpose(self, a, rows, cols):
+        return array('d', self._view(a, rows, cols).T.tobytes())
+
+    def determinant(self, a, n):
+        return float(numpy.linalg.det(self._view(a, n, n)))
+
+    def linear_combination(self, buffers, coefficients):
+        result = self._view(buffers[0]) * coefficients[0]
+        for buffer, coefficient in zip(buffers[1:], coefficients[1:]):
+            if coefficient == 1:
+                result += self._view(buffer)
+            elif coefficient == -1:
+                result -= self._view(buffer)
+            else:
+                result += self._view(buffer) * coefficient
+        return array('d', result.tobytes())
+
+    def batch_matmul(self, a, b, count, rows, inner, cols):
+        # A b holding a single block broadcasts against every block of a
+        product = self._view(a).reshape(count, rows, inner) @ self._view(b).reshape(-1, inner, cols)
+        return array('d', product.tobytes())
+
+    def batch_transpose(self, a, count, rows, cols):
+        return array('d', self._view(a).reshape(count, rows, cols).transpose(0, 2, 1).tobytes())
+
+    def batch_trace(self, a, count, n):
+        return numpy.trace(self._view(a).reshape(count, n, n), axis1=1, axis2=2).tolist()
+
+    def batch_determinant(self, a, count, n):
+        return numpy.linalg.det(self._view(a).reshape(count, n, n)).tolist()
+
+
+# Products with fewer multiply-adds (rows * inner * cols) than this stay on the calling process
+PARALLEL_MIN_FLOPS = 128 * 128 * 128
+PARALLEL_WORKERS_ENV_VAR = "MATRIX_WORKERS"
+
+
+def _matmul_rows_worker(a_name, b_name, out_name, inner, cols, r0, r1):
+    # Runs in a pool process: attaches to the shared operands by name and writes rows r0..r1 of the
+    # product straight into the shared output buffer
+    blocks = [shared_memory.SharedMemory(name=name) for name in (a_name, b_name, out_name)]
+    views = [block.buf.cast('d') for block in blocks]
+    try:
+        a_view, b_view, out_view = views
+        product = matmul_kernel(a_view[r0 * inner:r1 * inner], b_view, r1 - r0, inner, cols)
+        out_view[r0 * cols:r1 * cols] = product
+    finally:
+        for view in views:
+            view.release()
+        for block in blocks:
+            block.close()
+
+
+class ParallelBackend(PythonBackend):
+    # Pure-Python kernels, with large products split into row blocks across a process pool. Operands
+    # and result live in shared memory, so the workers only receive block names and row ranges.
+    name = "parallel"
+
+    def __init__(self, workers=None, min_flops=None):
+        self._executor = None
+        self.workers = None
+        self.min_flops = PARALLEL_MIN_FLOPS
+        if workers is None:
+            value = os.environ.get(PARALLEL_WORKERS_ENV_VAR, "").strip()
+            workers = int(value) if value.isdigit() and int(value) > 0 else (os.cpu_count() or 1)
+        self.configure(workers, min_flops)
+
+    def configure(self, workers=None, min_flops=None):
+        if workers is not None:
+            if not isinstance(workers, int) or workers <= 0:
+                raise ValueError("Worker count must be a positive integer.")
+            if workers != self.workers:
+                self.close()
+            self.workers = workers
+        if min_flops is not None:
+            if not isinstance(min_flops, int) or min_flops < 0:
+                raise ValueError("Parallel size threshold must be a non-negative integer.")
+            self.min_flops = min_flops
+        return self
+
+    def matmul_strided(self, a, a_layout, b, b_layout, rows, inner, cols):
+        if self.workers == 1 or rows == 1 or rows * inner * cols < self.min_flops:
+            return super().matmul_strided(a, a_layout, b, b_layout, rows, inner, cols)
+        # The workers read contiguous operands from shared memory, so gather the windows first
+        return self.matmul(_gather_strided(a, *a_layout, rows, inner), _gather_strided(b, *b_layout, inner, cols),
+                           rows, inner, cols)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def matmul(self, a, b, rows, inner, cols):
+        if self.workers == 1 or rows == 1 or rows * inner * cols < self.min_flops:
+            return super().matmul(a, b, rows, inner, cols)
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+
+        item_size = a.itemsize
+        blocks = [shared_memory.SharedMemory(create=True, size=item_size * size)
+                  for size in (rows * inner, inner * cols, rows * cols)]
+        try:
+            a_block, b_block, out_block = blocks
+            a_block.buf[:item_size * rows * inner] = memoryview(a).cast('B')
+            b_block.buf[:item_size * inner * cols] = memoryview(b).cast('B')
+            step = -(-rows // self.workers)
+            futures = [self._executor.submit(_matmul_rows_worker, a_block.name, b_block.name, out_block.name,
+                                             inner, cols, r0, min(r0 + step, rows))
+                       for r0 in range(0, rows, step)]
+            for future in futures:
+                future.result()
+            result = array('d')
+            result.frombytes(out_block.buf[:item_size * rows * cols])
+            return result
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+
+BACKEND_ENV_VAR = "MATRIX_BACKEND"
+
+_backends = {"python": PythonBackend(), "parallel": ParallelBackend()}
+if numpy is not None:
+    _backends["numpy"] = NumpyBackend()
+
+
+def available_backends():
+    return list(_backends)
+
+
+def get_backend(name=None):
+    if name is None:
+        return _active_backend
+    if name == "auto":
+        return _backends.get("numpy", _backends["python"])
+    if name not in _backends:
+        if name == "numpy":
+            raise ValueError("The NumPy backend requires numpy to be installed.")
+        raise ValueError(f"Unknown backend '{name}'. Available backends: {', '.join(_backends)}.")
+    return _backends[name]
+
+
+def set_backend(name):
+    global _active_backend
+    _active_backend = get_backend(name)
+    return _active_backend
+
+
+def _backend_from_environment():
+    # An unavailable or unknown backend in the environment falls back to the pure-Python one
+    try:
+        return get_backend(os.environ.get(BACKEND_ENV_VAR, "auto"))
+    except ValueError:
+        return _backends["python"]
+
+
+_active_backend = _backend_from_environment()
+
+
+def _index_range(key, length):
+    # (start, step, count) selected by an integer or slice index along an axis of the given length
+    if isinstance(key, int):
+        if key < 0:
+            key += length
+        if not 0 <= key < length:
+            raise IndexError("Matrix index out of bounds.")
+        return key, 1, 1
+    if isinstance(key, slice):
+        start, stop, step = key.indices(length)
+        count = len(range(start, stop, step))
+        if count == 0:
+            raise ValueError("Matrix slice selects no elements.")
+        return start, step, count
+    raise TypeError("Matrix indices must be integers or slices.")
+
+
+def _derived(method):
+    # Caches a method's result per matrix (and per arguments) against the matrix's version, so it is
+    # recomputed only after the elements change. Only for immutable results such as numbers and
+    # booleans: a cached Matrix would be shared by every caller.
+    @functools.wraps(method)
+    def cached(self, *args, **kwargs):
+        key = (method.__qualname__, args, tuple(sorted(kwargs.items())))
+        version = self._state_version()
+        entry = self._derived.get(key)
+        if entry is not None and entry[0] == version:
+            if _profiling:
+                _note_cache_hit(method.__qualname__)
+            return entry[1]
+        value = method(self, *args, **kwargs)
+        self._derived[key] = (version, value)
+        return value
+    return cached
+
+
+# Opt-in per-operation profiling. While enabled, every instrumented operation records its call count,
+# wall time, element visits, estimated flops, bytes allocated for its result and the implementation
+# that ran, keyed by (operation, operand types, path, result type). Setting MATRIX_PROFILE enables it
+# at import.
+PROFILE_ENV_VAR = "MATRIX_PROFILE"
+_profiling = bool(os.environ.get(PROFILE_ENV_VAR))
+_profile = {}
+_profile_lock = threading.Lock()
+_profile_state = threading.local()
+_profiler = None
+_profiler_depth = 0
+# Generic dense implementations; a packed operand reaching one of these has fallen back to dense storage
+_DENSE_PATHS = frozenset(("Matrix.add", "Matrix.subtract", "Matrix.multiply", "Matrix.transpose", "Matrix.to_string",
+                          "SquareMatrix.trace", "SquareMatrix.determinant", "SquareMatrix.inverse"))
+
+
+def enable_profiling(profiler=None):
+    # profiler may be a cProfile.Profile (or anything with enable/disable); it is switched on only
+    # while an instrumented operation runs, so its stats cover the matrix operations alone
+    global _profiling, _profiler
+    with _profile_lock:
+        _profiler = profiler
+        _profiling = True
+
+
+def disable_profiling():
+    # Stops recording; what was recorded stays available until reset_profile()
+    global _profiling, _profiler
+    with _profile_lock:
+        _profiling = False
+        _profiler = None
+
+
+def is_profiling():
+    return _profiling
+
+
+def reset_profile():
+    with _profile_lock:
+        _profile.clear()
+
+
+def get_profile():
+    # One dict per (operation, operand types, path, result type), slowest first
+    with _profile_lock:
+        items = [(key, list(entry)) for key, entry in _profile.items()]
+    entries = []
+    for (operation, operands, path, result_type), (calls, seconds, visits, flops, allocated, fallback) in items:
+        entries.append({"operation": operation, "operands": operands, "path": path, "result": result_type,
+                        "fallback": fallback, "calls": calls, "seconds": seconds, "element_visits": visits,
+                        "flops": flops, "bytes_allocated": allocated})
+    entries.sort(key=lambda entry: entry["seconds"], reverse=True)
+    return entries
+
+
+def format_profile(entries=None):
+    if entries is None:
+        entries = get_profile()
+    if not entries:
+        return "No operations recorded."
+    lines = [f"{'operation':<12} {'operands -> result':<60} {'path':<60} {'calls':>7} {'seconds':>10} {'flops':>14} {'bytes':>12}"]
+    for entry in entries:
+        signature = f"{entry['operands']} -> {entry['result']}" if entry["operands"] else f"-> {entry['result']}"
+        path = entry["path"] + (" (dense fallback)" if entry["fallback"] else "")
+        lines.append(f"{entry['operation']:<12} {signature:<60} {path:<60} {entry['calls']:>7} "
+                     f"{entry['seconds']:>10.6f} {entry['flops']:>14} {entry['bytes_allocated']:>12}")
+    return "\n".join(lines)
+
+
+def export_profile(path):
+    with open(path, "w") as f:
+        json.dump({"backend": type(get_backend()).__name__, "operations": get_profile()}, f, indent=2)
+
+
+def _note_path(detail):
+    # Names the kernel an instrumented operation dispatched to, unless an inner call already did
+    if not _profiling:
+        return
+    frame = getattr(_profile_state, "frame", None)
+    if frame is not None and frame[2] is None:
+        frame[2] = detail
+
+
+def _note_cache_hit(implementation):
+    # Marks the instrumented call of implementation as answered by @_derived; cache hits inside some
+    # other operation are part of that operation's work
+    frame = getattr(_profile_state, "frame", None)
+    if frame is not None and frame[1] == implementation and frame[2] is None:
+        frame[2] = "cached result"
+
+
+def _instrumented(operation):
+    # Records calls to a method or function under operation while profiling is enabled. Only the
+    # outermost instrumented call is timed; a nested call of the same operation that lands in a generic
+    # dense implementation (a subclass deferring to Matrix.add, say) becomes the recorded path.
+    def decorate(function):
+        implementation = function.__qualname__
+
+        @functools.wraps(function)
+        def run(*args, **kwargs):
+            if not _profiling:
+                return function(*args, **kwargs)
+            frame = getattr(_profile_state, "frame", None)
+            if frame is not None:
+                if frame[0] == operation and frame[2] is None and implementation in _DENSE_PATHS:
+                    frame[1] = implementation
+                return function(*args, **kwargs)
+            frame = _profile_state.frame = [operation, implementation, None]
+            _start_profiler()
+            start = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                _stop_profiler()
+                _profile_state.frame = None
+            _record_operation(frame, args, kwargs, result, elapsed)
+            return result
+        return run
+    return decorate
+
+
+def _start_profiler():
+    # The profiler runs while any thread is inside an instrumented operation
+    global _profiler_depth
+    with _profile_lock:
+        if _profiler is not None:
+            if _profiler_depth == 0:
+                _profiler.enable()
+            _profiler_depth += 1
+
+
+def _stop_profiler():
+    global _profiler_depth
+    with _profile_lock:
+        if _profiler_depth > 0:
+            _profiler_depth -= 1
+            if _profiler_depth == 0 and _profiler is not None:
+                _profiler.disable()
+
+
+def _operand_label(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return "scalar"
+    return type(value).__name__
+
+
+def _allocated_bytes(value):
+    # Size of the storage a result was given; views share their owner's storage
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, MatrixView) or not isinstance(value, Matrix):
+        return 0
+    buffers = (value.data, value.indices, value.indptr) if isinstance(value, SparseMatrix) else (value.data,)
+    return sum(memoryview(buffer).nbytes for buffer in buffers)
+
+
+def _operation_work(operation, operands, result, detail):
+    # (element visits, estimated flops): the stored elements read and written, and the arithmetic the
+    # path performs, using the same cost model as plan_chain. A cached result costs nothing.
+    if detail == "cached result":
+        return 0, 0
+    described = [_chain_operand(matrix) for matrix in operands]
+    result_stored = _chain_operand(result)[3] if isinstance(result, Matrix) else 0
+    visits = sum(stored for _, _, _, stored in described) + result_stored
+    if not described:
+        return visits, 0
+    kind, n = described[0][0], described[0][1]
+    if operation == "multiply" and len(described) == 2:
+        flops = _chain_product(described[0], described[1])[0]
+    elif operation in ("add", "subtract", "multiply"):
+        flops = result_stored
+    elif operation == "trace" or kind == "diagonal" and operation in ("determinant", "inverse"):
+        flops = n
+    elif operation == "determinant":
+        flops = n if kind in ("lower", "upper") else n ** 3 // 3
+    elif operation == "inverse":
+        flops = n ** 3 // 6 if kind in ("lower", "upper") else n ** 3
+    else:
+        flops = 0
+    return visits, flops
+
+
+def _record_operation(frame, args, kwargs, result, elapsed):
+    operation, implementation, detail = frame
+    # Methods are labelled by the types of self and the other operand; functions by their result alone
+    if args and isinstance(args[0], Matrix):
+        signature = [value for value in args[:2] if isinstance(value, (Matrix, int, float))]
+    else:
+        signature = []
+    operands = [value for value in signature if isinstance(value, Matrix)]
+    path = implementation if detail is None else f"{implementation} via {detail}"
+    # A packed or sparse operand that reached a backend's dense matmul, or a generic dense implementation
+    # without a structure-aware kernel, was densified
+    packed = (LowerTriangularMatrix, UpperTriangularMatrix, DiagonalMatrix, SparseMatrix)
+    dense = detail.endswith(".matmul") if detail is not None else implementation in _DENSE_PATHS
+    fallback = dense and any(isinstance(matrix, packed) for matrix in operands)
+    visits, flops = _operation_work(operation, operands, result, detail)
+    # An out= target is reused, not allocated
+    allocated = 0 if kwargs.get("out") is not None else _allocated_bytes(result)
+    key = (operation, ",".join(map(_operand_label, signature)), path, _operand_label(result))
+    with _profile_lock:
+        entry = _profile.get(key)
+        if entry is None:
+            entry = _profile[key] = [0, 0.0, 0, 0, 0, fallback]
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] += visits
+        entry[3] += flops
+        entry[4] += allocated
+
+
 class Matrix:
-    def __init__(self, rows, cols, data=None):
+    def __init__(self, rows, cols, data=None, optimized=False):
         if not isinstance(rows, int) or rows <= 0:
             raise ValueError("Number of rows must be a positive integer.")
         if not isinstance(cols, int) or cols <= 0:
             raise ValueError("Number of columns must be a positive integer.")
         self.rows = rows
         self.cols = cols
-        if data is None:
-            self.data = [[0.0 for _ in range(cols)] for _ in range(rows)]
+        # Mutation counter bumped by _mutated(), and the results cached against it by @_derived
+        self._version = 0
+        self._derived = {}
+        # Elements live in one flat row-major buffer; element (r, c) is at r * stride + c.
+        self.stride = cols
+        if optimized:
+            # Data is already in the internal storage format, use it directly
+            self.data = data
+        elif data is None:
+            self.data = array('d', bytes(8 * rows * cols))
         else:
             if not isinstance(data, list) or len(data) != rows:
                 raise ValueError("Data must be a list of lists with the correct number of rows.")
@@ -17,121 +844,286 @@ class Matrix:
                 for element in row_data:
                     if not isinstance(element, (int, float)):
                         raise ValueError("All elements in data must be numbers.")
-            self.data = data
+            self.data = self._pack_rows(data, rows, cols)
+
+    @staticmethod
+    def _pack_rows(data, rows, cols):
+        # Converts an already validated list of lists into this class's internal storage
+        buffer = array('d')
+        for row_data in data:
+            buffer.extend(row_data)
+        return buffer
+
+    @classmethod
+    def _from_validated_rows(cls, rows, cols, data):
+        # Skips validation: for callers such as create_matrix_from_data that have already checked the data
+        return cls(rows, cols, cls._pack_rows(data, rows, cols), optimized=True)
 
     def get_element(self, row, col):
         if not (0 <= row < self.rows and 0 <= col < self.cols):
             raise IndexError("Matrix index out of bounds.")
-        return self.data[row][col]
+        return self.data[row * self.stride + col]
 
     def set_element(self, row, col, value):
         if not (0 <= row < self.rows and 0 <= col < self.cols):
             raise IndexError("Matrix index out of bounds.")
         if not isinstance(value, (int, float)):
             raise ValueError("Value must be a number.")
-        self.data[row][col] = float(value)
+        self.data[row * self.stride + col] = float(value)
+        self._mutated()
+
+    def _mutated(self):
+        # Called whenever the stored elements change; subclasses drop anything derived from them
+        self._version += 1
+        self._derived.clear()
+
+    def _state_version(self):
+        return self._version
+
+    def __getstate__(self):
+        # Cached results are cheap to recompute and can be as large as the matrix, so they are not pickled
+        state = self.__dict__.copy()
+        state["_derived"] = {}
+        return state
+
+    def __setstate__(self, state):
+        # Pickles written before the flat array storage hold data as Python lists and lack the
+        # attributes added since; the lists are repacked into this class's storage
+        self.__dict__.update(state)
+        if isinstance(self.data, list):
+            self.data = self._pack_rows(self._legacy_rows(self.data), self.rows, self.cols)
+        self.__dict__.setdefault("stride", self.cols)
+        self.__dict__.setdefault("_version", 0)
+        self.__dict__.setdefault("_derived", {})
+
+    def _legacy_rows(self, data):
+        # Full list of lists from the list-based storage of older pickles: one list per row
+        return data
+
+    def _dense_data(self):
+        # Row-major buffer of all rows * cols elements; subclasses with packed storage expand here.
+        return self.data
 
     def __str__(self):
         return self.to_string()
 
+    @_instrumented("to_string")
     def to_string(self):
-        s = ""
-        for r in range(self.rows):
-            s += "[ "
-            for c in range(self.cols):
-                s += f"{self.data[r][c]:.2f} "
-            s += "]\n"
-        return s
+        data = self._dense_data()
+        cols = self.cols
+        lines = []
+        for start in range(0, self.rows * cols, cols):
+            lines.append("[ " + "".join(f"{value:.2f} " for value in data[start:start + cols]) + "]\n")
+        return "".join(lines)
 
     def is_square(self):
         return self.rows == self.cols
 
+    @_instrumented("is_lower_triangular")
+    @_derived
     def is_lower_triangular(self):
         if not self.is_square():
             return False
-        for r in range(self.rows):
-            for c in range(r + 1, self.cols):
-                if self.get_element(r, c) != 0:
-                    return False
+        data = self._dense_data()
+        n = self.cols
+        for r in range(n):
+            if any(data[r * n + r + 1:(r + 1) * n]):
+                return False
         return True
 
+    @_instrumented("is_upper_triangular")
+    @_derived
     def is_upper_triangular(self):
         if not self.is_square():
             return False
-        for r in range(self.rows):
-            for c in range(r):
-                if self.get_element(r, c) != 0:
-                    return False
+        data = self._dense_data()
+        n = self.cols
+        for r in range(n):
+            if any(data[r * n:r * n + r]):
+                return False
         return True
 
+    @_instrumented("is_diagonal")
+    @_derived
     def is_diagonal(self):
-        if not self.is_square():
-            return False
-        for r in range(self.rows):
-            for c in range(self.cols):
-                if r != c and self.get_element(r, c) != 0:
-                    return False
-        return True
+        return self.is_lower_triangular() and self.is_upper_triangular()
 
-    def transpose(self):
-        transposed_data = [[0.0 for _ in range(self.rows)] for _ in range(self.cols)]
-        for r in range(self.rows):
-            for c in range(self.cols):
-                transposed_data[c][r] = self.get_element(r, c)
-        return Matrix(self.cols, self.rows, transposed_data)
+    @_instrumented("transpose")
+    def transpose(self, backend=None):
+        transposed_data = get_backend(backend).transpose(self._dense_data(), self.rows, self.cols)
+        return Matrix(self.cols, self.rows, transposed_data, optimized=True)
 
-    def __add__(self, other):
+    @staticmethod
+    def _check_out(out, rows, cols, storage=None):
+        # An out= target must hold the result in its own storage: row-major unless a packed class is given
+        if storage is not None:
+            fits = isinstance(out, storage)
+        else:
+            fits = isinstance(out, Matrix) and type(out)._dense_data is Matrix._dense_data
+        if not fits:
+            raise TypeError("out cannot hold the result of this operation.")
+        if out.rows != rows or out.cols != cols:
+            raise ValueError("out must have the dimensions of the result.")
+
+    @_instrumented("add")
+    def add(self, other, backend=None, out=None):
         if not isinstance(other, Matrix):
             raise TypeError("Operand must be a Matrix object.")
         if self.rows != other.rows or self.cols != other.cols:
             raise ValueError("Matrices must have the same dimensions for addition.")
 
-        result_data = [[0.0 for _ in range(self.cols)] for _ in range(self.rows)]
-        for r in range(self.rows):
-            for c in range(self.cols):
-                result_data[r][c] = self.get_element(r, c) + other.get_element(r, c)
-        return Matrix(self.rows, self.cols, result_data)
+        if out is not None:
+            self._check_out(out, self.rows, self.cols)
+            get_backend(backend).add_into(self._dense_data(), other._dense_data(), out.data)
+            out._mutated()
+            return out
+        result_data = get_backend(backend).add(self._dense_data(), other._dense_data())
+        return Matrix(self.rows, self.cols, result_data, optimized=True)
 
-    def __sub__(self, other):
+    @_instrumented("subtract")
+    def subtract(self, other, backend=None, out=None):
         if not isinstance(other, Matrix):
             raise TypeError("Operand must be a Matrix object.")
         if self.rows != other.rows or self.cols != other.cols:
             raise ValueError("Matrices must have the same dimensions for subtraction.")
 
-        result_data = [[0.0 for _ in range(self.cols)] for _ in range(self.rows)]
-        for r in range(self.rows):
-            for c in range(self.cols):
-                result_data[r][c] = self.get_element(r, c) - other.get_element(r, c)
-        return Matrix(self.rows, self.cols, result_data)
+        if out is not None:
+            self._check_out(out, self.rows, self.cols)
+            get_backend(backend).subtract_into(self._dense_data(), other._dense_data(), out.data)
+            out._mutated()
+            return out
+        result_data = get_backend(backend).subtract(self._dense_data(), other._dense_data())
+        return Matrix(self.rows, self.cols, result_data, optimized=True)
 
-    def __mul__(self, other):
+    @_instrumented("multiply")
+    def multiply(self, other, backend=None, out=None):
         if isinstance(other, (int, float)):
             # Scalar multiplication
-            result_data = [[0.0 for _ in range(self.cols)] for _ in range(self.rows)]
-            for r in range(self.rows):
-                for c in range(self.cols):
-                    result_data[r][c] = self.get_element(r, c) * other
-            return Matrix(self.rows, self.cols, result_data)
+            if out is not None:
+                self._check_out(out, self.rows, self.cols)
+                get_backend(backend).scale_into(self._dense_data(), other, out.data)
+                out._mutated()
+                return out
+            result_data = get_backend(backend).scale(self._dense_data(), other)
+            return Matrix(self.rows, self.cols, result_data, optimized=True)
         elif isinstance(other, Matrix):
             # Matrix multiplication
             if self.cols != other.rows:
                 raise ValueError("Number of columns in the first matrix must match number of rows in the second for multiplication.")
+            dense_out = out is not None and type(out)._dense_data is Matrix._dense_data
+            if dense_out:
+                self._check_out(out, self.rows, other.cols)
 
-            result_data = [[0.0 for _ in range(other.cols)] for _ in range(self.rows)]
-            for r1 in range(self.rows):
-                for c2 in range(other.cols):
-                    for c1 in range(self.cols):
-                        result_data[r1][c2] += self.get_element(r1, c1) * other.get_element(c1, c2)
-            return Matrix(self.rows, other.cols, result_data)
+            kernel = _find_product_kernel(type(self), type(other))
+            if _profiling:
+                _note_path(kernel.__name__ if kernel is not None else f"{type(get_backend(backend)).__name__}.matmul")
+            if kernel is not None:
+                result = kernel(self, other, backend)
+                if out is None:
+                    return result
+                if dense_out:
+                    out.data[:] = result._dense_data()
+                elif type(result) is type(out) and not isinstance(out, SparseMatrix):
+                    # A packed out= target takes a product with its own structure, e.g. lower * lower
+                    self._check_out(out, self.rows, other.cols, type(out))
+                    out.data[:] = result.data
+                else:
+                    self._check_out(out, self.rows, other.cols)
+            elif out is not None:
+                self._check_out(out, self.rows, other.cols)
+                get_backend(backend).matmul_into(self._dense_data(), other._dense_data(), self.rows, self.cols, other.cols, out.data)
+            else:
+                result_data = get_backend(backend).matmul(self._dense_data(), other._dense_data(), self.rows, self.cols, other.cols)
+                return Matrix(self.rows, other.cols, result_data, optimized=True)
+            out._mutated()
+            return out
         else:
             raise TypeError("Operand must be a number or a Matrix object.")
 
+    def _scale_rows(self, factors):
+        # Row r multiplied by factors[r], i.e. diag(factors) * self, keeping the storage type
+        data = self._dense_data()
+        cols = self.cols
+        result_data = array('d')
+        for r, factor in enumerate(factors):
+            result_data.extend([value * factor for value in data[r * cols:(r + 1) * cols]])
+        return type(self)(self.rows, self.cols, result_data, optimized=True)
+
+    def _scale_cols(self, factors):
+        # Column c multiplied by factors[c], i.e. self * diag(factors), keeping the storage type
+        data = self._dense_data()
+        cols = self.cols
+        result_data = array('d')
+        for start in range(0, self.rows * cols, cols):
+            result_data.extend(map(operator.mul, data[start:start + cols], factors))
+        return type(self)(self.rows, self.cols, result_data, optimized=True)
+
+    def lazy(self):
+        # Starts a lazily evaluated expression; see MatrixExpression
+        return MatrixExpression("leaf", (self,), self.rows, self.cols)
+
+    def copy(self):
+        return type(self)(self.rows, self.cols, array('d', self.data), optimized=True)
+
+    def _view_source(self):
+        # (owner, offset, row_stride, col_stride) of this matrix in its owner's row-major layout
+        return self, 0, self.cols, 1
+
+    def transpose_view(self):
+        # O(1) transpose sharing this matrix's storage; see MatrixView
+        owner, offset, row_stride, col_stride = self._view_source()
+        return MatrixView(owner, self.cols, self.rows, offset, col_stride, row_stride)
+
+    def __getitem__(self, key):
+        # m[r, c] is an element. Any other key (m[r], m[r0:r1], m[:, c], m[r0:r1, c0:c1], ...) gives a
+        # MatrixView that shares this matrix's storage; an integer keeps its row or column as a 1-wide view.
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        if len(key) != 2:
+            raise IndexError("Matrix index must be a row or a (row, column) pair.")
+        row_start, row_step, rows = _index_range(key[0], self.rows)
+        col_start, col_step, cols = _index_range(key[1], self.cols)
+        if isinstance(key[0], int) and isinstance(key[1], int):
+            return self.get_element(row_start, col_start)
+        owner, offset, row_stride, col_stride = self._view_source()
+        return MatrixView(owner, rows, cols, offset + row_start * row_stride + col_start * col_stride,
+                          row_stride * row_step, col_stride * col_step)
+
+    def __add__(self, other):
+        return self.add(other)
+
+    def __sub__(self, other):
+        return self.subtract(other)
+
+    def __mul__(self, other):
+        return self.multiply(other)
+
+    # In-place operators update this matrix's own storage when it can hold the result; otherwise they
+    # return NotImplemented and Python falls back to the binary operator, rebinding to a new matrix.
+    def __iadd__(self, other):
+        if isinstance(other, Matrix):
+            return self.add(other, out=self)
+        return NotImplemented
+
+    def __isub__(self, other):
+        if isinstance(other, Matrix):
+            return self.subtract(other, out=self)
+        return NotImplemented
+
+    def __imul__(self, other):
+        if isinstance(other, (int, float)):
+            return self.multiply(other, out=self)
+        return NotImplemented
+
 class SquareMatrix(Matrix):
-    def __init__(self, rows, cols, data=None):
-        super().__init__(rows, cols, data)
+    def __init__(self, rows, cols, data=None, optimized=False):
+        super().__init__(rows, cols, data, optimized)
         if not self.is_square():
             raise ValueError("SquareMatrix must be a square matrix.")
+        self._lu = None
 
+    @_instrumented("trace")
+    @_derived
     def trace(self):
         if not self.is_square():
             raise TypeError("Trace is only defined for square matrices.")
@@ -140,9 +1132,96 @@ class SquareMatrix(Matrix):
             _trace += self.get_element(i, i)
         return _trace
 
+    def _mutated(self):
+        super()._mutated()
+        self._lu = None
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.__dict__.setdefault("_lu", None)
+
+    def lu_decomposition(self):
+        # Returns (L, U, perm) with P * A = L * U, L unit lower triangular and row i of P * A being
+        # row perm[i] of A. The factors are cached until the matrix is changed through set_element.
+        if self._lu is None:
+            n = self.rows
+            rows, perm, sign = _lu_decompose(self._dense_data(), n)
+            lower_data = array('d')
+            upper_data = array('d')
+            for c in range(n):
+                lower_data.append(1.0)
+                lower_data.extend([rows[r][c] for r in range(c + 1, n)])
+                upper_data.extend([rows[r][c] for r in range(c + 1)])
+            lower = LowerTriangularMatrix(n, n, lower_data, optimized=True)
+            upper = UpperTriangularMatrix(n, n, upper_data, optimized=True)
+            self._lu = (lower, upper, perm, sign)
+        lower, upper, perm, _ = self._lu
+        return lower, upper, list(perm)
+
+    def _solve_vector(self, values):
+        lower, upper, perm = self.lu_decomposition()
+        return upper._solve_vector(lower._solve_vector([values[p] for p in perm]))
+
+    def solve(self, b):
+        # Solves A x = b. b is either a list of n numbers (a list is returned) or an n x m Matrix of
+        # right-hand sides (an n x m Matrix is returned); every column reuses the same factorization.
+        n = self.rows
+        if isinstance(b, Matrix):
+            if b.rows != n:
+                raise ValueError("Right-hand side must have as many rows as the matrix.")
+            dense = b._dense_data()
+            m = b.cols
+            result_data = array('d', bytes(8 * n * m))
+            for c in range(m):
+                result_data[c::m] = array('d', self._solve_vector(dense[c::m].tolist()))
+            return Matrix(n, m, result_data, optimized=True)
+        if isinstance(b, list):
+            if len(b) != n:
+                raise ValueError("Right-hand side must have as many rows as the matrix.")
+            if not all(isinstance(value, (int, float)) for value in b):
+                raise ValueError("All elements in the right-hand side must be numbers.")
+            return self._solve_vector([float(value) for value in b])
+        raise TypeError("Right-hand side must be a list of numbers or a Matrix object.")
+
+    @_instrumented("inverse")
+    def inverse(self):
+        n = self.rows
+        identity = DiagonalMatrix(n, n, array('d', [1.0]) * n, optimized=True)
+        return SquareMatrix(n, n, self.solve(identity).data, optimized=True)
+
+    @_instrumented("determinant")
+    @_derived
+    def determinant(self, backend=None):
+        selected_backend = get_backend(backend)
+        if self._lu is None and not isinstance(selected_backend, PythonBackend):
+            return selected_backend.determinant(self._dense_data(), self.rows)
+        self.lu_decomposition()
+        _, upper, _, sign = self._lu
+        return sign * upper.determinant()
+
+def _add_diagonal(matrix, diagonal, sign, out, operation):
+    # matrix + sign * diagonal for a packed triangular matrix: only the stored diagonal entries change,
+    # so the result keeps the triangular storage and out= may be matrix itself
+    if matrix.rows != diagonal.rows:
+        raise ValueError(f"Matrices must have the same dimensions for {operation}.")
+    if out is None:
+        out = matrix.copy()
+    else:
+        matrix._check_out(out, matrix.rows, matrix.cols, type(matrix))
+        if out is not matrix:
+            out.data[:] = matrix.data
+    data = out.data
+    for i, value in enumerate(diagonal.data):
+        data[out._index(i, i)] += sign * value
+    out._mutated()
+    return out
+
+
 class LowerTriangularMatrix(SquareMatrix):
+    # Packed storage in the LAPACK 'L' layout: the columns of the lower triangle one after another,
+    # column j holding rows j..n-1, so element (r, c) with c <= r lives at r + c * (2n - c - 1) / 2.
     def __init__(self, rows, cols, data=None, optimized=False):
-        super().__init__(rows, cols, None) # Initialize with None to prevent base class from creating full data
+        super().__init__(rows, cols, None, optimized=True) # Skip the dense buffer, the packed data is set below
         if optimized:
             # If data is already optimized, use it directly
             self.data = data
@@ -159,20 +1238,40 @@ class LowerTriangularMatrix(SquareMatrix):
                     if c_idx > r_idx and element != 0:
                         raise ValueError("Data provided is not a lower triangular matrix (non-zero element above diagonal).")
 
-            optimized_data = []
-            for r in range(self.rows):
-                row_elements = []
-                for c in range(r + 1):
-                    row_elements.append(data[r][c])
-                optimized_data.append(row_elements)
-            self.data = optimized_data
+            self.data = self._pack_rows(data, rows, cols)
+
+    @staticmethod
+    def _pack_rows(data, rows, cols):
+        optimized_data = array('d')
+        for c in range(cols):
+            optimized_data.extend([data[r][c] for r in range(c, rows)])
+        return optimized_data
+
+    def _legacy_rows(self, data):
+        # Row r held columns 0..r
+        return [row + [0.0] * (self.cols - len(row)) for row in data]
+
+    @classmethod
+    def from_packed(cls, n, packed):
+        if not isinstance(n, int) or n <= 0:
+            raise ValueError("Number of rows must be a positive integer.")
+        try:
+            optimized_data = array('d', packed)
+        except TypeError:
+            raise ValueError("All elements in data must be numbers.")
+        if len(optimized_data) != n * (n + 1) // 2:
+            raise ValueError("Packed data must have n * (n + 1) / 2 elements.")
+        return cls(n, n, optimized_data, optimized=True)
+
+    def _index(self, row, col):
+        return row + col * (2 * self.rows - col - 1) // 2
 
     def get_element(self, row, col):
         if not (0 <= row < self.rows and 0 <= col < self.cols):
             raise IndexError("Matrix index out of bounds.")
         if col > row:
             return 0.0  # Elements above the main diagonal are zero
-        return self.data[row][col]
+        return self.data[self._index(row, col)]
 
     def set_element(self, row, col, value):
         if not (0 <= row < self.rows and 0 <= col < self.cols):
@@ -182,69 +1281,149 @@ class LowerTriangularMatrix(SquareMatrix):
         if col > row and value != 0:
             raise ValueError("Cannot set a non-zero value above the main diagonal for a LowerTriangularMatrix.")
         elif col <= row:
-            self.data[row][col] = float(value)
+            self.data[self._index(row, col)] = float(value)
+        self._mutated()
 
-    def determinant(self):
+    @_instrumented("determinant")
+    @_derived
+    def determinant(self, backend=None):
         _determinant = 1.0
         for i in range(self.rows):
-            _determinant *= self.get_element(i, i)
+            _determinant *= self.data[self._index(i, i)]
         return _determinant
 
-    def __add__(self, other):
-        if isinstance(other, LowerTriangularMatrix):
+    def _solve_vector(self, values, start=0):
+        # Forward substitution, column by column; entries before start are known to be zero
+        n = self.rows
+        data = self.data
+        x = list(values)
+        for c in range(start, n):
+            offset = self._index(c, c)
+            pivot = data[offset]
+            if pivot == 0:
+                raise ValueError("Matrix is singular.")
+            x_c = x[c] / pivot
+            x[c] = x_c
+            if x_c:
+                x[c + 1:] = [value - x_c * l for value, l in zip(x[c + 1:], data[offset + 1:offset + n - c])]
+        return x
+
+    @_instrumented("inverse")
+    def inverse(self):
+        # Column c of the inverse solves L x = e_c and is zero above row c, so it is computed from
+        # row c down and packed straight into the result
+        n = self.rows
+        result_optimized_data = array('d')
+        for c in range(n):
+            unit = [0.0] * n
+            unit[c] = 1.0
+            result_optimized_data.extend(self._solve_vector(unit, c)[c:])
+        return LowerTriangularMatrix(n, n, result_optimized_data, optimized=True)
+
+    @_instrumented("add")
+    def add(self, other, backend=None, out=None):
+        if isinstance(other, LowerTriangularMatrix) and (out is None or isinstance(out, LowerTriangularMatrix)):
             if self.rows != other.rows or self.cols != other.cols:
                 raise ValueError("Matrices must have the same dimensions for addition.")
-            result_optimized_data = []
-            for r in range(self.rows):
-                row_elements = []
-                for c in range(r + 1):
-                    row_elements.append(self.get_element(r, c) + other.get_element(r, c))
-                result_optimized_data.append(row_elements)
+            if out is not None:
+                self._check_out(out, self.rows, self.cols, LowerTriangularMatrix)
+                get_backend(backend).add_into(self.data, other.data, out.data)
+                out._mutated()
+                return out
+            result_optimized_data = array('d', map(operator.add, self.data, other.data))
             return LowerTriangularMatrix(self.rows, self.cols, result_optimized_data, optimized=True)
+        elif isinstance(other, DiagonalMatrix) and (out is None or isinstance(out, LowerTriangularMatrix)):
+            return _add_diagonal(self, other, 1.0, out, "addition")
         else:
-            return super().__add__(other)
+            return super().add(other, backend, out)
 
-    def __sub__(self, other):
-        if isinstance(other, LowerTriangularMatrix):
+    @_instrumented("subtract")
+    def subtract(self, other, backend=None, out=None):
+        if isinstance(other, LowerTriangularMatrix) and (out is None or isinstance(out, LowerTriangularMatrix)):
             if self.rows != other.rows or self.cols != other.cols:
                 raise ValueError("Matrices must have the same dimensions for subtraction.")
-            result_optimized_data = []
-            for r in range(self.rows):
-                row_elements = []
-                for c in range(r + 1):
-                    row_elements.append(self.get_element(r, c) - other.get_element(r, c))
-                result_optimized_data.append(row_elements)
+            if out is not None:
+                self._check_out(out, self.rows, self.cols, LowerTriangularMatrix)
+                get_backend(backend).subtract_into(self.data, other.data, out.data)
+                out._mutated()
+                return out
+            result_optimized_data = array('d', map(operator.sub, self.data, other.data))
             return LowerTriangularMatrix(self.rows, self.cols, result_optimized_data, optimized=True)
+        elif isinstance(other, DiagonalMatrix) and (out is None or isinstance(out, LowerTriangularMatrix)):
+            return _add_diagonal(self, other, -1.0, out, "subtraction")
         else:
-            return super().__sub__(other)
+            return super().subtract(other, backend, out)
 
-    def __mul__(self, other):
-        if isinstance(other, (int, float)):
-            result_optimized_data = []
-            for r in range(self.rows):
-                row_elements = []
-                for c in range(r + 1):
-                    row_elements.append(self.get_element(r, c) * other)
-                result_optimized_data.append(row_elements)
+    @_instrumented("multiply")
+    def multiply(self, other, backend=None, out=None):
+        if isinstance(other, (int, float)) and (out is None or isinstance(out, LowerTriangularMatrix)):
+            if out is not None:
+                self._check_out(out, self.rows, self.cols, LowerTriangularMatrix)
+                get_backend(backend).scale_into(self.data, other, out.data)
+                out._mutated()
+                return out
+            result_optimized_data = array('d', [value * other for value in self.data])
             return LowerTriangularMatrix(self.rows, self.cols, result_optimized_data, optimized=True)
         else:
-            return super().__mul__(other)
+            return super().multiply(other, backend, out)
 
-    def to_string(self):
-        s = ""
-        for r in range(self.rows):
-            s += "[ "
-            for c in range(self.cols):
-                s += f"{self.get_element(r, c):.2f} "
-            s += "]\n"
-        return s
+    def __iadd__(self, other):
+        if isinstance(other, (LowerTriangularMatrix, DiagonalMatrix)):
+            return self.add(other, out=self)
+        return NotImplemented
+
+    def __isub__(self, other):
+        if isinstance(other, (LowerTriangularMatrix, DiagonalMatrix)):
+            return self.subtract(other, out=self)
+        return NotImplemented
+
+    def __imul__(self, other):
+        if isinstance(other, (int, float)):
+            return self.multiply(other, out=self)
+        return NotImplemented
 
+    def _columns(self):
+        # (column, start offset, length) of each packed column segment
+        n = self.rows
+        start = 0
+        for c in range(n):
+            yield c, start, n - c
+            start += n - c
 
+    def _dense_data(self):
+        n = self.cols
+        dense = array('d', bytes(8 * n * n))
+        for c, start, length in self._columns():
+            dense[c * n + c::n] = self.data[start:start + length]
+        return dense
+
+    @classmethod
+    def _from_dense(cls, n, dense):
+        optimized_data = array('d')
+        for c in range(n):
+            optimized_data.extend(dense[c * n + c::n])
+        return cls(n, n, optimized_data, optimized=True)
+
+    def _scale_rows(self, factors):
+        factors = list(factors)
+        result_optimized_data = array('d')
+        for c, start, length in self._columns():
+            result_optimized_data.extend(map(operator.mul, self.data[start:start + length], factors[c:]))
+        return LowerTriangularMatrix(self.rows, self.cols, result_optimized_data, optimized=True)
+
+    def _scale_cols(self, factors):
+        result_optimized_data = array('d')
+        for c, start, length in self._columns():
+            factor = factors[c]
+            result_optimized_data.extend([value * factor for value in self.data[start:start + length]])
+        return LowerTriangularMatrix(self.rows, self.cols, result_optimized_data, optimized=True)
 
 
 class UpperTriangularMatrix(SquareMatrix):
+    # Packed storage in the LAPACK 'U' layout: column j holds rows 0..j, so element (r, c) with
+    # r <= c lives at r + c * (c + 1) / 2.
     def __init__(self, rows, cols, data=None, optimized=False):
-        super().__init__(rows, cols, None)
+        super().__init__(rows, cols, None, optimized=True)
         if optimized:
             self.data = data
         else:
@@ -259,20 +1438,40 @@ class UpperTriangularMatrix(SquareMatrix):
                     if c_idx < r_idx and element != 0:
                         raise ValueError("Data provided is not an upper triangular matrix (non-zero element below diagonal).")
 
-            optimized_data = []
-            for r in range(self.rows):
-                row_elements = []
-                for c in range(r, self.cols):
-                    row_elements.append(data[r][c])
-                optimized_data.append(row_elements)
-            self.data = optimized_data
+            self.data = self._pack_rows(data, rows, cols)
+
+    @staticmethod
+    def _pack_rows(data, rows, cols):
+        optimized_data = array('d')
+        for c in range(cols):
+            optimized_data.extend([data[r][c] for r in range(c + 1)])
+        return optimized_data
+
+    def _legacy_rows(self, data):
+        # Row r held columns r..n-1
+        return [[0.0] * r + row for r, row in enumerate(data)]
+
+    @classmethod
+    def from_packed(cls, n, packed):
+        if not isinstance(n, int) or n <= 0:
+            raise ValueError("Number of rows must be a positive integer.")
+        try:
+            optimized_data = array('d', packed)
+        except TypeError:
+            raise ValueError("All elements in data must be numbers.")
+        if len(optimized_data) != n * (n + 1) // 2:
+            raise ValueError("Packed data must have n * (n + 1) / 2 elements.")
+        return cls(n, n, optimized_data, optimized=True)
+
+    def _index(self, row, col):
+        return row + col * (col + 1) // 2
 
     def get_element(self, row, col):
         if not (0 <= row < self.rows and 0 <= col < self.cols):
             raise IndexError("Matrix index out of bounds.")
         if col < row:
             return 0.0  # Elements below the main diagonal are zero
-        return self.data[row][col - row]
+        return self.data[self._index(row, col)]
 
     def set_element(self, row, col, value):
         if not (0 <= row < self.rows and 0 <= col < self.cols):
@@ -282,69 +1481,145 @@ class UpperTriangularMatrix(SquareMatrix):
         if col < row and value != 0:
             raise ValueError("Cannot set a non-zero value below the main diagonal for an UpperTriangularMatrix.")
         elif col >= row:
-            self.data[row][col - row] = float(value)
+            self.data[self._index(row, col)] = float(value)
+        self._mutated()
 
-    def determinant(self):
+    @_instrumented("determinant")
+    @_derived
+    def determinant(self, backend=None):
         _determinant = 1.0
         for i in range(self.rows):
-            _determinant *= self.get_element(i, i)
+            _determinant *= self.data[self._index(i, i)]
         return _determinant
 
-    def __add__(self, other):
-        if isinstance(other, UpperTriangularMatrix):
+    def _solve_vector(self, values, last=None):
+        # Back substitution, column by column; entries after last are known to be zero
+        data = self.data
+        x = list(values)
+        if last is None:
+            last = self.rows - 1
+        for c in range(last, -1, -1):
+            offset = self._index(0, c)
+            pivot = data[offset + c]
+            if pivot == 0:
+                raise ValueError("Matrix is singular.")
+            x_c = x[c] / pivot
+            x[c] = x_c
+            if x_c and c:
+                x[:c] = [value - x_c * u for value, u in zip(x[:c], data[offset:offset + c])]
+        return x
+
+    @_instrumented("inverse")
+    def inverse(self):
+        # Column c of the inverse is zero below row c
+        n = self.rows
+        result_optimized_data = array('d')
+        for c in range(n):
+            unit = [0.0] * n
+            unit[c] = 1.0
+            result_optimized_data.extend(self._solve_vector(unit, c)[:c + 1])
+        return UpperTriangularMatrix(n, n, result_optimized_data, optimized=True)
+
+    @_instrumented("add")
+    def add(self, other, backend=None, out=None):
+        if isinstance(other, UpperTriangularMatrix) and (out is None or isinstance(out, UpperTriangularMatrix)):
             if self.rows != other.rows or self.cols != other.cols:
                 raise ValueError("Matrices must have the same dimensions for addition.")
-            result_optimized_data = []
-            for r in range(self.rows):
-                row_elements = []
-                for c in range(r, self.cols):
-                    row_elements.append(self.get_element(r, c) + other.get_element(r, c))
-                result_optimized_data.append(row_elements)
+            if out is not None:
+                self._check_out(out, self.rows, self.cols, UpperTriangularMatrix)
+                get_backend(backend).add_into(self.data, other.data, out.data)
+                out._mutated()
+                return out
+            result_optimized_data = array('d', map(operator.add, self.data, other.data))
             return UpperTriangularMatrix(self.rows, self.cols, result_optimized_data, optimized=True)
+        elif isinstance(other, DiagonalMatrix) and (out is None or isinstance(out, UpperTriangularMatrix)):
+            return _add_diagonal(self, other, 1.0, out, "addition")
         else:
-            return super().__add__(other)
+            return super().add(other, backend, out)
 
-    def __sub__(self, other):
-        if isinstance(other, UpperTriangularMatrix):
+    @_instrumented("subtract")
+    def subtract(self, other, backend=None, out=None):
+        if isinstance(other, UpperTriangularMatrix) and (out is None or isinstance(out, UpperTriangularMatrix)):
             if self.rows != other.rows or self.cols != other.cols:
                 raise ValueError("Matrices must have the same dimensions for subtraction.")
-            result_optimized_data = []
-            for r in range(self.rows):
-                row_elements = []
-                for c in range(r, self.cols):
-                    row_elements.append(self.get_element(r, c) - other.get_element(r, c))
-                result_optimized_data.append(row_elements)
+            if out is not None:
+                self._check_out(out, self.rows, self.cols, UpperTriangularMatrix)
+                get_backend(backend).subtract_into(self.data, other.data, out.data)
+                out._mutated()
+                return out
+            result_optimized_data = array('d', map(operator.sub, self.data, other.data))
             return UpperTriangularMatrix(self.rows, self.cols, result_optimized_data, optimized=True)
+        elif isinstance(other, DiagonalMatrix) and (out is None or isinstance(out, UpperTriangularMatrix)):
+            return _add_diagonal(self, other, -1.0, out, "subtraction")
         else:
-            return super().__sub__(other)
+            return super().subtract(other, backend, out)
 
-    def __mul__(self, other):
-        if isinstance(other, (int, float)):
-            result_optimized_data = []
-            for r in range(self.rows):
-                row_elements = []
-                for c in range(r, self.cols):
-                    row_elements.append(self.get_element(r, c) * other)
-                result_optimized_data.append(row_elements)
+    @_instrumented("multiply")
+    def multiply(self, other, backend=None, out=None):
+        if isinstance(other, (int, float)) and (out is None or isinstance(out, UpperTriangularMatrix)):
+            if out is not None:
+                self._check_out(out, self.rows, self.cols, UpperTriangularMatrix)
+                get_backend(backend).scale_into(self.data, other, out.data)
+                out._mutated()
+                return out
+            result_optimized_data = array('d', [value * other for value in self.data])
             return UpperTriangularMatrix(self.rows, self.cols, result_optimized_data, optimized=True)
         else:
-            return super().__mul__(other)
+            return super().multiply(other, backend, out)
 
-    def to_string(self):
-        s = ""
-        for r in range(self.rows):
-            s += "[ "
-            for c in range(self.cols):
-                s += f"{self.get_element(r, c):.2f} "
-            s += "]\n"
-        return s
+    def __iadd__(self, other):
+        if isinstance(other, (UpperTriangularMatrix, DiagonalMatrix)):
+            return self.add(other, out=self)
+        return NotImplemented
+
+    def __isub__(self, other):
+        if isinstance(other, (UpperTriangularMatrix, DiagonalMatrix)):
+            return self.subtract(other, out=self)
+        return NotImplemented
+
+    def __imul__(self, other):
+        if isinstance(other, (int, float)):
+            return self.multiply(other, out=self)
+        return NotImplemented
 
+    def _columns(self):
+        # (column, start offset, length) of each packed column segment
+        start = 0
+        for c in range(self.rows):
+            yield c, start, c + 1
+            start += c + 1
 
+    def _dense_data(self):
+        n = self.cols
+        dense = array('d', bytes(8 * n * n))
+        for c, start, length in self._columns():
+            dense[c:c * n + c + 1:n] = self.data[start:start + length]
+        return dense
+
+    @classmethod
+    def _from_dense(cls, n, dense):
+        optimized_data = array('d')
+        for c in range(n):
+            optimized_data.extend(dense[c:c * n + c + 1:n])
+        return cls(n, n, optimized_data, optimized=True)
+
+    def _scale_rows(self, factors):
+        result_optimized_data = array('d')
+        for c, start, length in self._columns():
+            result_optimized_data.extend(map(operator.mul, self.data[start:start + length], factors))
+        return UpperTriangularMatrix(self.rows, self.cols, result_optimized_data, optimized=True)
+
+    def _scale_cols(self, factors):
+        result_optimized_data = array('d')
+        for c, start, length in self._columns():
+            factor = factors[c]
+            result_optimized_data.extend([value * factor for value in self.data[start:start + length]])
+        return UpperTriangularMatrix(self.rows, self.cols, result_optimized_data, optimized=True)
 
 
 class DiagonalMatrix(SquareMatrix):
     def __init__(self, rows, cols, data=None, optimized=False):
-        super().__init__(rows, cols, None)
+        super().__init__(rows, cols, None, optimized=True)
         if optimized:
             self.data = data
         else:
@@ -359,10 +1634,15 @@ class DiagonalMatrix(SquareMatrix):
                     if r_idx != c_idx and element != 0:
                         raise ValueError("Data provided is not a diagonal matrix (non-zero element off-diagonal).")
 
-            optimized_data = []
-            for i in range(self.rows):
-                optimized_data.append(data[i][i])
-            self.data = optimized_data
+            self.data = self._pack_rows(data, rows, cols)
+
+    @staticmethod
+    def _pack_rows(data, rows, cols):
+        return array('d', [data[i][i] for i in range(rows)])
+
+    def _legacy_rows(self, data):
+        # The diagonal was a flat list
+        return [[value if c == r else 0.0 for c in range(self.cols)] for r, value in enumerate(data)]
 
     def get_element(self, row, col):
         if not (0 <= row < self.rows and 0 <= col < self.cols):
@@ -380,100 +1660,1643 @@ class DiagonalMatrix(SquareMatrix):
             self.data[row] = float(value)
         elif value != 0:
             raise ValueError("Cannot set a non-zero value off the main diagonal for a DiagonalMatrix.")
+        self._mutated()
 
-    def determinant(self):
+    @_instrumented("determinant")
+    @_derived
+    def determinant(self, backend=None):
         _determinant = 1.0
         for i in range(self.rows):
             _determinant *= self.data[i]
         return _determinant
 
+    @_instrumented("trace")
+    @_derived
     def trace(self):
         _trace = 0.0
         for i in range(self.rows):
             _trace += self.data[i]
         return _trace
 
-    def __add__(self, other):
-        if isinstance(other, DiagonalMatrix):
-            if self.rows != other.rows or self.cols != other.cols:
+    def _solve_vector(self, values):
+        if 0 in self.data:
+            raise ValueError("Matrix is singular.")
+        return list(map(operator.truediv, values, self.data))
+
+    @_instrumented("inverse")
+    def inverse(self):
+        if 0 in self.data:
+            raise ValueError("Matrix is singular.")
+        result_optimized_data = array('d', [1.0 / value for value in self.data])
+        return DiagonalMatrix(self.rows, self.cols, result_optimized_data, optimized=True)
+
+    @_instrumented("add")
+    def add(self, other, backend=None, out=None):
+        if isinstance(other, DiagonalMatrix) and (out is None or isinstance(out, DiagonalMatrix)):
+            if self.rows != other.rows or self.cols != other.cols:
                 raise ValueError("Matrices must have the same dimensions for addition.")
-            result_optimized_data = []
-            for i in range(self.rows):
-                result_optimized_data.append(self.data[i] + other.data[i])
+            if out is not None:
+                self._check_out(out, self.rows, self.cols, DiagonalMatrix)
+                get_backend(backend).add_into(self.data, other.data, out.data)
+                out._mutated()
+                return out
+            result_optimized_data = array('d', map(operator.add, self.data, other.data))
             return DiagonalMatrix(self.rows, self.cols, result_optimized_data, optimized=True)
+        elif isinstance(other, (LowerTriangularMatrix, UpperTriangularMatrix)) and (out is None or isinstance(out, type(other))):
+            # The sum keeps the triangular operand's structure, whichever side it is on
+            return _add_diagonal(other, self, 1.0, out, "addition")
         else:
-            return super().__add__(other)
+            return super().add(other, backend, out)
 
-    def __sub__(self, other):
-        if isinstance(other, DiagonalMatrix):
+    @_instrumented("subtract")
+    def subtract(self, other, backend=None, out=None):
+        if isinstance(other, DiagonalMatrix) and (out is None or isinstance(out, DiagonalMatrix)):
             if self.rows != other.rows or self.cols != other.cols:
                 raise ValueError("Matrices must have the same dimensions for subtraction.")
-            result_optimized_data = []
-            for i in range(self.rows):
-                result_optimized_data.append(self.data[i] - other.data[i])
+            if out is not None:
+                self._check_out(out, self.rows, self.cols, DiagonalMatrix)
+                get_backend(backend).subtract_into(self.data, other.data, out.data)
+                out._mutated()
+                return out
+            result_optimized_data = array('d', map(operator.sub, self.data, other.data))
             return DiagonalMatrix(self.rows, self.cols, result_optimized_data, optimized=True)
+        elif isinstance(other, (LowerTriangularMatrix, UpperTriangularMatrix)) and (out is None or isinstance(out, type(other))):
+            if self.rows != other.rows:
+                raise ValueError("Matrices must have the same dimensions for subtraction.")
+            negated = other.multiply(-1.0, backend, out)
+            return _add_diagonal(negated, self, 1.0, negated, "subtraction")
         else:
-            return super().__sub__(other)
+            return super().subtract(other, backend, out)
 
-    def __mul__(self, other):
-        if isinstance(other, (int, float)):
-            result_optimized_data = []
-            for i in range(self.rows):
-                result_optimized_data.append(self.data[i] * other)
+    @_instrumented("multiply")
+    def multiply(self, other, backend=None, out=None):
+        if isinstance(other, (int, float)) and (out is None or isinstance(out, DiagonalMatrix)):
+            if out is not None:
+                self._check_out(out, self.rows, self.cols, DiagonalMatrix)
+                get_backend(backend).scale_into(self.data, other, out.data)
+                out._mutated()
+                return out
+            result_optimized_data = array('d', [value * other for value in self.data])
             return DiagonalMatrix(self.rows, self.cols, result_optimized_data, optimized=True)
-        elif isinstance(other, DiagonalMatrix):
+        else:
+            return super().multiply(other, backend, out)
+
+    def __iadd__(self, other):
+        if isinstance(other, DiagonalMatrix):
+            return self.add(other, out=self)
+        return NotImplemented
+
+    def __isub__(self, other):
+        if isinstance(other, DiagonalMatrix):
+            return self.subtract(other, out=self)
+        return NotImplemented
+
+    def __imul__(self, other):
+        if isinstance(other, (int, float)):
+            return self.multiply(other, out=self)
+        return NotImplemented
+
+    def _dense_data(self):
+        n = self.cols
+        dense = array('d', bytes(8 * n * n))
+        dense[::n + 1] = self.data
+        return dense
+
+    def _scale_rows(self, factors):
+        result_optimized_data = array('d', map(operator.mul, self.data, factors))
+        return DiagonalMatrix(self.rows, self.cols, result_optimized_data, optimized=True)
+
+    def _scale_cols(self, factors):
+        return self._scale_rows(factors)
+
+
+class SparseMatrix(Matrix):
+    # Compressed sparse row (CSR) storage: data holds the nonzero values row by row, indices the column
+    # of each value and indptr[r]:indptr[r + 1] the slice belonging to row r.
+    def __init__(self, rows, cols, data=None, optimized=False):
+        super().__init__(rows, cols, None, optimized=True)
+        if optimized:
+            # data is a (values, indices, indptr) triple already in CSR form
+            self.data, self.indices, self.indptr = data
+        elif data is None:
+            self.data = array('d')
+            self.indices = array('q')
+            self.indptr = array('q', bytes(8 * (rows + 1)))
+        else:
+            if not isinstance(data, list) or len(data) != rows:
+                raise ValueError("Data must be a list of lists with the correct number of rows.")
+            for row_data in data:
+                if not isinstance(row_data, list) or len(row_data) != cols:
+                    raise ValueError("Each row in data must be a list with the correct number of columns.")
+                for element in row_data:
+                    if not isinstance(element, (int, float)):
+                        raise ValueError("All elements in data must be numbers.")
+            self.data, self.indices, self.indptr = self._pack_rows(data, rows, cols)
+
+    @staticmethod
+    def _pack_rows(data, rows, cols):
+        values = array('d')
+        indices = array('q')
+        indptr = array('q', [0])
+        for row_data in data:
+            for c, element in enumerate(row_data):
+                if element != 0:
+                    values.append(element)
+                    indices.append(c)
+            indptr.append(len(values))
+        return values, indices, indptr
+
+    @classmethod
+    def _from_rows(cls, rows, cols, row_entries):
+        # Builds a SparseMatrix from one iterable of (col, value) pairs per row, in column order
+        values = array('d')
+        indices = array('q')
+        indptr = array('q', [0])
+        for entries in row_entries:
+            for c, value in entries:
+                if value != 0:
+                    values.append(value)
+                    indices.append(c)
+            indptr.append(len(values))
+        return cls(rows, cols, (values, indices, indptr), optimized=True)
+
+    @classmethod
+    def _from_dense(cls, rows, cols, dense):
+        return cls._from_rows(rows, cols, (enumerate(dense[r * cols:(r + 1) * cols]) for r in range(rows)))
+
+    def _row(self, row):
+        start, end = self.indptr[row], self.indptr[row + 1]
+        return zip(self.indices[start:end], self.data[start:end])
+
+    def copy(self):
+        return SparseMatrix(self.rows, self.cols, (array('d', self.data), array('q', self.indices), array('q', self.indptr)), optimized=True)
+
+    def nnz(self):
+        return len(self.data)
+
+    def density(self):
+        return len(self.data) / (self.rows * self.cols)
+
+    def _find(self, row, col):
+        start, end = self.indptr[row], self.indptr[row + 1]
+        return bisect_left(self.indices, col, start, end), end
+
+    def get_element(self, row, col):
+        if not (0 <= row < self.rows and 0 <= col < self.cols):
+            raise IndexError("Matrix index out of bounds.")
+        position, end = self._find(row, col)
+        if position < end and self.indices[position] == col:
+            return self.data[position]
+        return 0.0
+
+    def set_element(self, row, col, value):
+        if not (0 <= row < self.rows and 0 <= col < self.cols):
+            raise IndexError("Matrix index out of bounds.")
+        if not isinstance(value, (int, float)):
+            raise ValueError("Value must be a number.")
+        position, end = self._find(row, col)
+        stored = position < end and self.indices[position] == col
+        if value != 0 and stored:
+            self.data[position] = float(value)
+        elif value != 0:
+            self.data.insert(position, float(value))
+            self.indices.insert(position, col)
+            for r in range(row + 1, self.rows + 1):
+                self.indptr[r] += 1
+        elif stored:
+            # Writing a zero removes the entry so the storage stays proportional to the nonzeros
+            del self.data[position]
+            del self.indices[position]
+            for r in range(row + 1, self.rows + 1):
+                self.indptr[r] -= 1
+        self._mutated()
+
+    def _dense_data(self):
+        cols = self.cols
+        dense = array('d', bytes(8 * self.rows * cols))
+        for r in range(self.rows):
+            offset = r * cols
+            for c, value in self._row(r):
+                dense[offset + c] = value
+        return dense
+
+    @_instrumented("trace")
+    @_derived
+    def trace(self):
+        if not self.is_square():
+            raise TypeError("Trace is only defined for square matrices.")
+        _trace = 0.0
+        for i in range(self.rows):
+            _trace += self.get_element(i, i)
+        return _trace
+
+    @_instrumented("determinant")
+    @_derived
+    def determinant(self, backend=None):
+        if not self.is_square():
+            raise TypeError("Determinant is only defined for square matrices.")
+        return SquareMatrix(self.rows, self.cols, self._dense_data(), optimized=True).determinant(backend)
+
+    def solve(self, b):
+        if not self.is_square():
+            raise TypeError("Solve is only defined for square matrices.")
+        return SquareMatrix(self.rows, self.cols, self._dense_data(), optimized=True).solve(b)
+
+    @_instrumented("inverse")
+    def inverse(self):
+        # The inverse of a sparse matrix is generally dense
+        if not self.is_square():
+            raise TypeError("Inverse is only defined for square matrices.")
+        return SquareMatrix(self.rows, self.cols, self._dense_data(), optimized=True).inverse()
+
+    @_instrumented("transpose")
+    def transpose(self, backend=None):
+        # Counting sort of the entries by column: O(nnz + cols)
+        rows, cols = self.rows, self.cols
+        counts = [0] * (cols + 1)
+        for c in self.indices:
+            counts[c + 1] += 1
+        for c in range(cols):
+            counts[c + 1] += counts[c]
+        indptr = array('q', counts)
+        next_slot = counts[:cols]
+        values = array('d', bytes(8 * len(self.data)))
+        indices = array('q', bytes(8 * len(self.data)))
+        for r in range(rows):
+            for c, value in self._row(r):
+                slot = next_slot[c]
+                values[slot] = value
+                indices[slot] = r
+                next_slot[c] = slot + 1
+        return SparseMatrix(cols, rows, (values, indices, indptr), optimized=True)
+
+    def _merge(self, other, op):
+        row_entries = []
+        for r in range(self.rows):
+            merged = dict(self._row(r))
+            for c, value in other._row(r):
+                merged[c] = op(merged.get(c, 0.0), value)
+            row_entries.append([(c, merged[c]) for c in sorted(merged)])
+        return SparseMatrix._from_rows(self.rows, self.cols, row_entries)
+
+    def _scatter_into(self, dense, sign=1.0):
+        cols = self.cols
+        for r in range(self.rows):
+            offset = r * cols
+            for c, value in self._row(r):
+                dense[offset + c] += sign * value
+        return dense
+
+    @_instrumented("add")
+    def add(self, other, backend=None, out=None):
+        if out is not None:
+            # out= targets are dense, so the sparse structure is no help here
+            return super().add(other, backend, out)
+        if not isinstance(other, Matrix):
+            raise TypeError("Operand must be a Matrix object.")
+        if self.rows != other.rows or self.cols != other.cols:
+            raise ValueError("Matrices must have the same dimensions for addition.")
+        if isinstance(other, SparseMatrix):
+            return self._merge(other, operator.add)
+        result_data = self._scatter_into(array('d', other._dense_data()))
+        return Matrix(self.rows, self.cols, result_data, optimized=True)
+
+    @_instrumented("subtract")
+    def subtract(self, other, backend=None, out=None):
+        if out is not None:
+            return super().subtract(other, backend, out)
+        if not isinstance(other, Matrix):
+            raise TypeError("Operand must be a Matrix object.")
+        if self.rows != other.rows or self.cols != other.cols:
+            raise ValueError("Matrices must have the same dimensions for subtraction.")
+        if isinstance(other, SparseMatrix):
+            return self._merge(other, operator.sub)
+        result_data = self._scatter_into(array('d', [-value for value in other._dense_data()]))
+        return Matrix(self.rows, self.cols, result_data, optimized=True)
+
+    @_instrumented("multiply")
+    def multiply(self, other, backend=None, out=None):
+        if isinstance(other, (int, float)) and out is None:
+            if other == 0:
+                return SparseMatrix(self.rows, self.cols)
+            values = array('d', [value * other for value in self.data])
+            return SparseMatrix(self.rows, self.cols, (values, array('q', self.indices), array('q', self.indptr)), optimized=True)
+        else:
+            return super().multiply(other, backend, out)
+
+    def _adopt(self, other):
+        # Takes over another SparseMatrix's CSR arrays. A sum that grows the sparsity pattern is
+        # rebuilt by the in-place operators, which still keep this object.
+        self.data, self.indices, self.indptr = other.data, other.indices, other.indptr
+        self._mutated()
+        return self
+
+    def _update_in_place(self, other, op):
+        # Applies op entry by entry when every nonzero of other is already stored here, so the CSR
+        # arrays keep their size and no new ones are built. Returns False, changing nothing, when the
+        # sparsity pattern would have to grow.
+        indptr, indices = other.indptr, other.indices
+        for r in range(self.rows):
+            for k in range(indptr[r], indptr[r + 1]):
+                position, end = self._find(r, indices[k])
+                if position == end or self.indices[position] != indices[k]:
+                    return False
+        cancelled = False
+        for r in range(self.rows):
+            for k in range(indptr[r], indptr[r + 1]):
+                position, _ = self._find(r, indices[k])
+                value = self.data[position] = op(self.data[position], other.data[k])
+                cancelled = cancelled or value == 0
+        if cancelled:
+            self._drop_zeros()
+        self._mutated()
+        return True
+
+    def _drop_zeros(self):
+        # Removes stored zeros by compacting the CSR arrays in place
+        data, indices, indptr = self.data, self.indices, self.indptr
+        write = start = 0
+        for r in range(self.rows):
+            end = indptr[r + 1]
+            for k in range(start, end):
+                if data[k] != 0:
+                    data[write] = data[k]
+                    indices[write] = indices[k]
+                    write += 1
+            start = end
+            indptr[r + 1] = write
+        del data[write:]
+        del indices[write:]
+
+    def __iadd__(self, other):
+        if isinstance(other, SparseMatrix) and self.rows == other.rows and self.cols == other.cols:
+            if self._update_in_place(other, operator.add):
+                return self
+            return self._adopt(self._merge(other, operator.add))
+        return NotImplemented
+
+    def __isub__(self, other):
+        if isinstance(other, SparseMatrix) and self.rows == other.rows and self.cols == other.cols:
+            if self._update_in_place(other, operator.sub):
+                return self
+            return self._adopt(self._merge(other, operator.sub))
+        return NotImplemented
+
+    def __imul__(self, other):
+        if not isinstance(other, (int, float)):
+            return NotImplemented
+        if other == 0:
+            return self._adopt(SparseMatrix(self.rows, self.cols))
+        self.data[:] = array('d', [value * other for value in self.data])
+        self._mutated()
+        return self
+
+    def _scale_rows(self, factors):
+        return SparseMatrix._from_rows(self.rows, self.cols, ([(c, value * factor) for c, value in self._row(r)] for r, factor in enumerate(factors)))
+
+    def _scale_cols(self, factors):
+        return SparseMatrix._from_rows(self.rows, self.cols, ([(c, value * factors[c]) for c, value in self._row(r)] for r in range(self.rows)))
+
+
+class MatrixView(Matrix):
+    # Window onto another matrix's storage: element (r, c) is element offset + r * stride + c * col_stride
+    # of the owner's row-major layout. Transposes and slices are O(1), share the owner's buffer and see
+    # later writes to it. Writes through a view go through the owner's set_element, so its validation
+    # (and packed-storage rules) still apply. Owners without a row-major buffer (packed, sparse) are
+    # read element by element. copy() materializes a view as a plain Matrix.
+    def __init__(self, owner, rows, cols, offset, row_stride, col_stride):
+        self._shared = type(owner)._dense_data is Matrix._dense_data
+        super().__init__(rows, cols, owner.data if self._shared else None, optimized=True)
+        self.owner = owner
+        self.offset = offset
+        self.stride = row_stride
+        self.col_stride = col_stride
+
+    def _view_source(self):
+        return self.owner, self.offset, self.stride, self.col_stride
+
+    def _state_version(self):
+        # A view's elements are its owner's, so cached results follow the owner's version
+        return self.owner._version
+
+    def _owner_position(self, row, col):
+        if not (0 <= row < self.rows and 0 <= col < self.cols):
+            raise IndexError("Matrix index out of bounds.")
+        return divmod(self.offset + row * self.stride + col * self.col_stride, self.owner.cols)
+
+    def get_element(self, row, col):
+        if self._shared:
+            if not (0 <= row < self.rows and 0 <= col < self.cols):
+                raise IndexError("Matrix index out of bounds.")
+            return self.data[self.offset + row * self.stride + col * self.col_stride]
+        return self.owner.get_element(*self._owner_position(row, col))
+
+    def set_element(self, row, col, value):
+        self.owner.set_element(*self._owner_position(row, col), value)
+
+    def _dense_data(self):
+        base = self.data if self._shared else self.owner._dense_data()
+        return _gather_strided(base, self.offset, self.stride, self.col_stride, self.rows, self.cols)
+
+    def copy(self):
+        return Matrix(self.rows, self.cols, array('d', self._dense_data()), optimized=True)
+
+    def _assign(self, data):
+        # Writes a row-major buffer of this view's shape back through the view
+        cols = self.cols
+        if not self._shared:
+            for r in range(self.rows):
+                for c in range(cols):
+                    self.set_element(r, c, data[r * cols + c])
+            return self
+        for r in range(self.rows):
+            start = self.offset + r * self.stride
+            stop = start + cols * self.col_stride
+            self.data[start:stop if stop >= 0 else None:self.col_stride] = data[r * cols:(r + 1) * cols]
+        self.owner._mutated()
+        return self
+
+    def __iadd__(self, other):
+        if isinstance(other, Matrix):
+            return self._assign(self.add(other).data)
+        return NotImplemented
+
+    def __isub__(self, other):
+        if isinstance(other, Matrix):
+            return self._assign(self.subtract(other).data)
+        return NotImplemented
+
+    def __imul__(self, other):
+        if isinstance(other, (int, float)):
+            return self._assign(self.multiply(other).data)
+        return NotImplemented
+
+    def _scale_rows(self, factors):
+        return self.copy()._scale_rows(factors)
+
+    def _scale_cols(self, factors):
+        return self.copy()._scale_cols(factors)
+
+
+# Edge of the square tiles MappedMatrix streams through; row-wise passes take about this squared
+# many elements per block, so each operand keeps roughly 2 MiB resident at a time.
+MAPPED_TILE_SIZE = 512
+_MAPPED_ACCESS = {'r': mmap.ACCESS_READ, 'r+': mmap.ACCESS_WRITE, 'c': mmap.ACCESS_COPY, 'w+': mmap.ACCESS_WRITE}
+
+
+class MappedMatrix(Matrix):
+    # Row-major matrix stored as raw native float64 values in a memory-mapped file, starting at offset,
+    # so only the pages being used are resident. path may be a file name, an open binary file or None
+    # for an anonymous temporary file. mode follows numpy.memmap: 'r' read-only, 'r+' writes go to the
+    # file, 'c' copy-on-write (writes stay in memory) and 'w+' creates or truncates a zero-filled file.
+    # Element access and the generic operations read the mapping in place; add, subtract, scalar and
+    # matrix products and transpose stream tile by tile into a new mapped result (path= names its file).
+    def __init__(self, rows, cols, path=None, offset=0, mode='r+'):
+        super().__init__(rows, cols, None, optimized=True)
+        if mode not in _MAPPED_ACCESS:
+            raise ValueError("Mode must be one of 'r', 'r+', 'c' or 'w+'.")
+        if offset < 0 or offset % 8:
+            raise ValueError("Offset must be a non-negative multiple of 8.")
+        size = 8 * rows * cols
+        if path is None:
+            f, mode, offset = tempfile.TemporaryFile(), 'w+', 0
+        elif hasattr(path, 'fileno'):
+            f = open(os.dup(path.fileno()), 'rb' if mode in ('r', 'c') else 'r+b')
+        else:
+            f = open(path, {'r': 'rb', 'c': 'rb', 'r+': 'r+b', 'w+': 'w+b'}[mode])
+        with f:
+            if mode == 'w+':
+                f.truncate(offset + size)
+            elif os.fstat(f.fileno()).st_size < offset + size:
+                raise ValueError("File is too small for a matrix of these dimensions.")
+            # The mapping has to start on an allocation boundary, so any slack before offset is skipped
+            start = offset - offset % mmap.ALLOCATIONGRANULARITY
+            self._map = mmap.mmap(f.fileno(), offset + size - start, access=_MAPPED_ACCESS[mode], offset=start)
+        self.data = memoryview(self._map)[offset - start:offset - start + size].cast('d')
+        self.path = path if isinstance(path, str) else None
+        self.offset = offset
+        self.mode = mode
+
+    @classmethod
+    def from_matrix(cls, matrix, path=None):
+        result = cls(matrix.rows, matrix.cols, path, mode='w+')
+        return _stream_row_blocks(result, (matrix,), lambda r0, r1, block: block)
+
+    def set_element(self, row, col, value):
+        if self.mode == 'r':
+            raise ValueError("Matrix is mapped read-only.")
+        super().set_element(row, col, value)
+
+    def flush(self):
+        self._map.flush()
+
+    def copy(self, path=None):
+        return MappedMatrix.from_matrix(self, path)
+
+    def _elementwise(self, other, operation, backend, out, path):
+        if out is None:
+            out = MappedMatrix(self.rows, self.cols, path, mode='w+')
+        else:
+            self._check_out(out, self.rows, self.cols)
+        selected_backend = get_backend(backend)
+        sources = (self,) if other is None else (self, other)
+        return _stream_row_blocks(out, sources, lambda r0, r1, *blocks: operation(selected_backend, *blocks))
+
+    @_instrumented("add")
+    def add(self, other, backend=None, out=None, path=None):
+        if not isinstance(other, Matrix):
+            raise TypeError("Operand must be a Matrix object.")
+        if self.rows != other.rows or self.cols != other.cols:
+            raise ValueError("Matrices must have the same dimensions for addition.")
+        return self._elementwise(other, lambda selected, a, b: selected.add(a, b), backend, out, path)
+
+    @_instrumented("subtract")
+    def subtract(self, other, backend=None, out=None, path=None):
+        if not isinstance(other, Matrix):
+            raise TypeError("Operand must be a Matrix object.")
+        if self.rows != other.rows or self.cols != other.cols:
+            raise ValueError("Matrices must have the same dimensions for subtraction.")
+        return self._elementwise(other, lambda selected, a, b: selected.subtract(a, b), backend, out, path)
+
+    @_instrumented("multiply")
+    def multiply(self, other, backend=None, out=None, path=None):
+        if isinstance(other, (int, float)):
+            return self._elementwise(None, lambda selected, a: selected.scale(a, other), backend, out, path)
+        elif isinstance(other, Matrix):
             if self.cols != other.rows:
                 raise ValueError("Number of columns in the first matrix must match number of rows in the second for multiplication.")
-            result_optimized_data = []
-            for i in range(self.rows):
-                result_optimized_data.append(self.data[i] * other.data[i])
-            return DiagonalMatrix(self.rows, self.cols, result_optimized_data, optimized=True)
+            if out is not None:
+                self._check_out(out, self.rows, other.cols)
+            if isinstance(other, DiagonalMatrix) and out is None:
+                return self._scale_cols(other.data, path)
+            return _multiply_mapped(self, other, backend, out, path)
         else:
-            return super().__mul__(other)
+            raise TypeError("Operand must be a number or a Matrix object.")
 
-    def to_string(self):
-        s = ""
-        for r in range(self.rows):
-            s += "[ "
-            for c in range(self.cols):
-                s += f"{self.get_element(r, c):.2f} "
-            s += "]\n"
-        return s
+    @_instrumented("transpose")
+    def transpose(self, backend=None, path=None):
+        # Square tiles are transposed in memory and written out column block by column block
+        selected_backend = get_backend(backend)
+        rows, cols, tile = self.rows, self.cols, MAPPED_TILE_SIZE
+        result = MappedMatrix(cols, rows, path, mode='w+')
+        for r0 in range(0, rows, tile):
+            r1 = min(r0 + tile, rows)
+            for c0 in range(0, cols, tile):
+                c1 = min(c0 + tile, cols)
+                block = selected_backend.transpose(_gather_strided(self.data, r0 * cols + c0, cols, 1, r1 - r0, c1 - c0), r1 - r0, c1 - c0)
+                for c in range(c0, c1):
+                    result.data[c * rows + r0:c * rows + r1] = block[(c - c0) * (r1 - r0):(c - c0 + 1) * (r1 - r0)]
+        return result
 
+    def _scale_rows(self, factors, path=None):
+        factors = list(factors)
+        result = MappedMatrix(self.rows, self.cols, path, mode='w+')
+        cols = self.cols
 
+        def scale(r0, r1, block):
+            scaled = array('d')
+            for r in range(r0, r1):
+                factor = factors[r]
+                scaled.extend([value * factor for value in block[(r - r0) * cols:(r - r0 + 1) * cols]])
+            return scaled
+        return _stream_row_blocks(result, (self,), scale)
 
+    def _scale_cols(self, factors, path=None):
+        factors = array('d', factors) * (MAPPED_TILE_SIZE * MAPPED_TILE_SIZE // self.cols or 1)
+        result = MappedMatrix(self.rows, self.cols, path, mode='w+')
+        return _stream_row_blocks(result, (self,), lambda r0, r1, block: array('d', map(operator.mul, block, factors)))
 
-def create_matrix_from_data(rows, cols, data):
-    # First, try to create a DiagonalMatrix
-    try:
-        temp_matrix = DiagonalMatrix(rows, cols, data)
-        return temp_matrix
-    except ValueError:
-        pass
 
-    # Then, try to create a LowerTriangularMatrix
-    try:
-        temp_matrix = LowerTriangularMatrix(rows, cols, data)
-        return temp_matrix
-    except ValueError:
-        pass
+def _stream_row_blocks(out, sources, function):
+    # Writes function(r0, r1, *blocks) into rows r0..r1 of out for consecutive blocks of rows, each
+    # block being those rows of every source as a row-major buffer. In-memory operands without a
+    # row-major buffer (packed, sparse) are expanded once up front.
+    cols = out.cols
+    step = max(1, MAPPED_TILE_SIZE * MAPPED_TILE_SIZE // cols)
+    layouts = [_strided_operand(source) for source in sources]
+    for r0 in range(0, out.rows, step):
+        r1 = min(r0 + step, out.rows)
+        blocks = [_gather_strided(buffer, offset + r0 * row_stride, row_stride, col_stride, r1 - r0, cols)
+                  for buffer, (offset, row_stride, col_stride) in layouts]
+        out.data[r0 * cols:r1 * cols] = function(r0, r1, *blocks)
+    out._mutated()
+    return out
 
-    # Then, try to create an UpperTriangularMatrix
-    try:
-        temp_matrix = UpperTriangularMatrix(rows, cols, data)
-        return temp_matrix
-    except ValueError:
-        pass
 
-    # If none of the specialized types fit, check for SquareMatrix
-    if rows == cols:
+def _multiply_diagonal_left(left, right, backend):
+    # diag(d) * B scales row r of B by d[r]: O(n^2) and B keeps its type
+    return right._scale_rows(left.data)
+
+
+def _multiply_diagonal_right(left, right, backend):
+    # A * diag(d) scales column c of A by d[c]
+    return left._scale_cols(right.data)
+
+
+def _multiply_lower_lower(left, right, backend):
+    n = left.rows
+    selected_backend = get_backend(backend)
+    if not isinstance(selected_backend, PythonBackend):
+        # Let the accelerated backend do the dense product and pack the result back
+        return LowerTriangularMatrix._from_dense(n, selected_backend.matmul(left._dense_data(), right._dense_data(), n, n, n))
+
+    # Column j of C is the sum of B[k][j] * (column k of A) for j <= k, and column k of A covers
+    # rows k..n-1, which sits inside column j of C: about n^3 / 6 multiply-adds on packed columns.
+    a, b = left.data, right.data
+    a_columns = [a[start:start + length].tolist() for _, start, length in left._columns()]
+    result_optimized_data = array('d')
+    for j, start, length in right._columns():
+        b_column = b[start:start + length]
+        acc = [0.0] * length
+        for offset in range(length):
+            b_kj = b_column[offset]
+            if b_kj:
+                acc[offset:] = [x + b_kj * y for x, y in zip(acc[offset:], a_columns[j + offset])]
+        result_optimized_data.extend(acc)
+    return LowerTriangularMatrix(n, n, result_optimized_data, optimized=True)
+
+
+def _multiply_upper_upper(left, right, backend):
+    n = left.rows
+    selected_backend = get_backend(backend)
+    if not isinstance(selected_backend, PythonBackend):
+        return UpperTriangularMatrix._from_dense(n, selected_backend.matmul(left._dense_data(), right._dense_data(), n, n, n))
+
+    # Column j of C is the sum of B[k][j] * (column k of A) for k <= j, column k of A covering rows 0..k
+    a, b = left.data, right.data
+    a_columns = [a[start:start + length].tolist() for _, start, length in left._columns()]
+    result_optimized_data = array('d')
+    for j, start, length in right._columns():
+        b_column = b[start:start + length]
+        acc = [0.0] * length
+        for k in range(length):
+            b_kj = b_column[k]
+            if b_kj:
+                acc[:k + 1] = [x + b_kj * y for x, y in zip(acc, a_columns[k])]
+        result_optimized_data.extend(acc)
+    return UpperTriangularMatrix(n, n, result_optimized_data, optimized=True)
+
+
+def _multiply_sparse_sparse(left, right, backend):
+    # Row-by-row accumulation (Gustavson): work is proportional to the products of matching nonzeros
+    row_entries = []
+    for r in range(left.rows):
+        acc = {}
+        for k, a_rk in left._row(r):
+            for c, b_kc in right._row(k):
+                acc[c] = acc.get(c, 0.0) + a_rk * b_kc
+        row_entries.append([(c, acc[c]) for c in sorted(acc)])
+    return SparseMatrix._from_rows(left.rows, right.cols, row_entries)
+
+
+def _multiply_sparse_dense(left, right, backend):
+    # Each nonzero A[r][k] adds A[r][k] * (row k of B) to row r of the dense result
+    b = right._dense_data()
+    cols = right.cols
+    result_data = array('d', bytes(8 * left.rows * cols))
+    for r in range(left.rows):
+        acc = None
+        for k, a_rk in left._row(r):
+            b_row = b[k * cols:(k + 1) * cols]
+            if acc is None:
+                acc = [a_rk * y for y in b_row]
+            else:
+                acc = [x + a_rk * y for x, y in zip(acc, b_row)]
+        if acc is not None:
+            result_data[r * cols:(r + 1) * cols] = array('d', acc)
+    return Matrix(left.rows, cols, result_data, optimized=True)
+
+
+def _multiply_dense_sparse(left, right, backend):
+    # Row r of the result gathers A[r][k] * (row k of B) for every nonzero A[r][k]
+    a = left._dense_data()
+    inner, cols = left.cols, right.cols
+    result_data = array('d', bytes(8 * left.rows * cols))
+    for r in range(left.rows):
+        offset = r * cols
+        for k, a_rk in enumerate(a[r * inner:(r + 1) * inner]):
+            if a_rk:
+                for c, b_kc in right._row(k):
+                    result_data[offset + c] += a_rk * b_kc
+    return Matrix(left.rows, cols, result_data, optimized=True)
+
+
+def _strided_operand(matrix):
+    # Buffer and (offset, row_stride, col_stride) layout to read a product operand in place
+    owner, offset, row_stride, col_stride = matrix._view_source()
+    if type(owner)._dense_data is Matrix._dense_data:
+        return owner.data, (offset, row_stride, col_stride)
+    return matrix._dense_data(), (0, matrix.cols, 1)
+
+
+def _multiply_strided(left, right, backend):
+    # Products involving a MatrixView read the operands through their strides, so A.transpose_view() * B
+    # and products of slices never build a row-major copy first
+    a, a_layout = _strided_operand(left)
+    b, b_layout = _strided_operand(right)
+    result_data = get_backend(backend).matmul_strided(a, a_layout, b, b_layout, left.rows, left.cols, right.cols)
+    return Matrix(left.rows, right.cols, result_data, optimized=True)
+
+
+def _multiply_mapped(left, right, backend, out=None, path=None):
+    # Blocked i-j-k product over MAPPED_TILE_SIZE tiles: each result tile accumulates the products of
+    # a row of tiles of left with a column of tiles of right and is written out once, so only a few
+    # tiles are resident however large the operands are. The result is a new MappedMatrix unless out
+    # is given.
+    rows, inner, cols, tile = left.rows, left.cols, right.cols, MAPPED_TILE_SIZE
+    selected_backend = get_backend(backend)
+    a, (a_offset, a_row_stride, a_col_stride) = _strided_operand(left)
+    b, (b_offset, b_row_stride, b_col_stride) = _strided_operand(right)
+    target = out
+    if out is None or out.data is a or out.data is b:
+        # An operand is still being read while the result is written, so overlapping output goes
+        # through a scratch mapping first
+        target = MappedMatrix(rows, cols, path if out is None else None, mode='w+')
+    for i0 in range(0, rows, tile):
+        i1 = min(i0 + tile, rows)
+        for j0 in range(0, cols, tile):
+            j1 = min(j0 + tile, cols)
+            accumulated = None
+            for k0 in range(0, inner, tile):
+                k1 = min(k0 + tile, inner)
+                a_tile = _gather_strided(a, a_offset + i0 * a_row_stride + k0 * a_col_stride, a_row_stride, a_col_stride, i1 - i0, k1 - k0)
+                b_tile = _gather_strided(b, b_offset + k0 * b_row_stride + j0 * b_col_stride, b_row_stride, b_col_stride, k1 - k0, j1 - j0)
+                product = selected_backend.matmul(a_tile, b_tile, i1 - i0, k1 - k0, j1 - j0)
+                accumulated = product if accumulated is None else selected_backend.add(accumulated, product)
+            width = j1 - j0
+            for r in range(i0, i1):
+                target.data[r * cols + j0:r * cols + j1] = accumulated[(r - i0) * width:(r - i0 + 1) * width]
+    if target is out:
+        out._mutated()
+        return out
+    if out is not None:
+        return _stream_row_blocks(out, (target,), lambda r0, r1, block: array('d', block))
+    return target
+
+
+# Structure-aware product kernels keyed by (left type, right type); looked up along both MROs,
+# so the most specific pair wins and anything without an entry uses the dense backend matmul.
+_PRODUCT_KERNELS = {
+    (DiagonalMatrix, Matrix): _multiply_diagonal_left,
+    (Matrix, DiagonalMatrix): _multiply_diagonal_right,
+    (LowerTriangularMatrix, LowerTriangularMatrix): _multiply_lower_lower,
+    (UpperTriangularMatrix, UpperTriangularMatrix): _multiply_upper_upper,
+    (SparseMatrix, DiagonalMatrix): _multiply_diagonal_right,
+    (SparseMatrix, SparseMatrix): _multiply_sparse_sparse,
+    (SparseMatrix, Matrix): _multiply_sparse_dense,
+    (Matrix, SparseMatrix): _multiply_dense_sparse,
+    (MatrixView, DiagonalMatrix): _multiply_diagonal_right,
+    (MatrixView, SparseMatrix): _multiply_dense_sparse,
+    (MatrixView, Matrix): _multiply_strided,
+    (Matrix, MatrixView): _multiply_strided,
+    (Matrix, MappedMatrix): _multiply_mapped,
+    (MatrixView, MappedMatrix): _multiply_mapped,
+}
+
+_product_kernel_cache = {}
+
+
+def _find_product_kernel(left_type, right_type):
+    key = (left_type, right_type)
+    if key not in _product_kernel_cache:
+        kernel = None
+        for left_cls in left_type.__mro__:
+            for right_cls in right_type.__mro__:
+                kernel = _PRODUCT_KERNELS.get((left_cls, right_cls))
+                if kernel is not None:
+                    break
+            if kernel is not None:
+                break
+        _product_kernel_cache[key] = kernel
+    return _product_kernel_cache[key]
+
+
+def _chain_operand(matrix):
+    # (kind, rows, cols, stored elements) used by the chain cost model
+    if isinstance(matrix, DiagonalMatrix):
+        return ("diagonal", matrix.rows, matrix.cols, matrix.rows)
+    if isinstance(matrix, LowerTriangularMatrix):
+        return ("lower", matrix.rows, matrix.cols, len(matrix.data))
+    if isinstance(matrix, UpperTriangularMatrix):
+        return ("upper", matrix.rows, matrix.cols, len(matrix.data))
+    if isinstance(matrix, SparseMatrix):
+        return ("sparse", matrix.rows, matrix.cols, matrix.nnz())
+    return ("dense", matrix.rows, matrix.cols, matrix.rows * matrix.cols)
+
+
+def _chain_product(left, right):
+    # Estimated multiply-adds of left * right and the operand describing the result, mirroring
+    # the kernels registered in _PRODUCT_KERNELS
+    left_kind, p, q, left_stored = left
+    right_kind, _, r, right_stored = right
+    if left_kind == "diagonal":
+        return right_stored, (right_kind, p, r, right_stored)
+    if right_kind == "diagonal":
+        return left_stored, (left_kind, p, r, left_stored)
+    if left_kind == right_kind and left_kind in ("lower", "upper"):
+        return p * q * r // 6 + 1, (left_kind, p, r, left_stored)
+    if left_kind == "sparse" and right_kind == "sparse":
+        cost = left_stored * max(1, right_stored // q)
+        return cost, ("sparse", p, r, min(p * r, cost))
+    if left_kind == "sparse":
+        return left_stored * r, ("dense", p, r, p * r)
+    if right_kind == "sparse":
+        return p * right_stored, ("dense", p, r, p * r)
+    return p * q * r, ("dense", p, r, p * r)
+
+
+class ChainPlan:
+    # Evaluation order chosen by plan_chain. order is a nested tuple of operand indices, e.g.
+    # ((0, 1), 2); flops counts estimated multiply-adds, naive_flops the same for left-to-right order.
+    def __init__(self, order, flops, naive_flops):
+        self.order = order
+        self.flops = flops
+        self.naive_flops = naive_flops
+
+    def describe(self, names=None):
+        def render(node):
+            if isinstance(node, int):
+                return names[node] if names else f"M{node + 1}"
+            return f"({render(node[0])} x {render(node[1])})"
+        return render(self.order)
+
+
+def plan_chain(matrices):
+    # Classic O(k^3) matrix-chain dynamic programme over the operand shapes and structure types
+    if not matrices:
+        raise ValueError("At least one matrix is required.")
+    for matrix in matrices:
+        if not isinstance(matrix, Matrix):
+            raise TypeError("Operand must be a Matrix object.")
+    for left, right in zip(matrices, matrices[1:]):
+        if left.cols != right.rows:
+            raise ValueError("Number of columns in the first matrix must match number of rows in the second for multiplication.")
+
+    count = len(matrices)
+    operands = [_chain_operand(matrix) for matrix in matrices]
+    best = {(i, i): (0, i, operands[i]) for i in range(count)}
+    for length in range(2, count + 1):
+        for i in range(count - length + 1):
+            j = i + length - 1
+            for split in range(i, j):
+                left_cost, left_order, left_operand = best[(i, split)]
+                right_cost, right_order, right_operand = best[(split + 1, j)]
+                step_cost, operand = _chain_product(left_operand, right_operand)
+                cost = left_cost + right_cost + step_cost
+                if (i, j) not in best or cost < best[(i, j)][0]:
+                    best[(i, j)] = (cost, (left_order, right_order), operand)
+
+    naive_flops = 0
+    naive_operand = operands[0]
+    naive_order = 0
+    for i in range(1, count):
+        step_cost, naive_operand = _chain_product(naive_operand, operands[i])
+        naive_flops += step_cost
+        naive_order = (naive_order, i)
+    flops, order, _ = best[(0, count - 1)]
+    if naive_flops <= flops:
+        order, flops = naive_order, naive_flops
+    return ChainPlan(order, flops, naive_flops)
+
+
+def multiply_chain(matrices, plan=None, backend=None):
+    # Multiplies matrices[0] * matrices[1] * ... in the order chosen by plan_chain (or a given plan)
+    if plan is None:
+        plan = plan_chain(matrices)
+
+    def evaluate(node):
+        if isinstance(node, int):
+            return matrices[node]
+        return evaluate(node[0]).multiply(evaluate(node[1]), backend)
+    return evaluate(plan.order)
+
+
+class MatrixExpression:
+    # Node of a lazily evaluated expression. +, - and scalar * only record the operation; evaluate()
+    # folds scalars, cancels double transposes, and computes the whole elementwise chain as one
+    # linear combination of the leaf matrices, in a single pass into a single output buffer.
+    # Matrix products are evaluated eagerly at evaluate() time and then act as leaves.
+    def __init__(self, op, operands, rows, cols, scalar=None):
+        self.op = op
+        self.operands = operands
+        self.rows = rows
+        self.cols = cols
+        self.scalar = scalar
+
+    @staticmethod
+    def _wrap(operand):
+        if isinstance(operand, MatrixExpression):
+            return operand
+        if isinstance(operand, Matrix):
+            return operand.lazy()
+        raise TypeError("Operand must be a Matrix or MatrixExpression object.")
+
+    def __add__(self, other):
+        other = self._wrap(other)
+        if self.rows != other.rows or self.cols != other.cols:
+            raise ValueError("Matrices must have the same dimensions for addition.")
+        return MatrixExpression("add", (self, other), self.rows, self.cols)
+
+    def __sub__(self, other):
+        other = self._wrap(other)
+        if self.rows != other.rows or self.cols != other.cols:
+            raise ValueError("Matrices must have the same dimensions for subtraction.")
+        return MatrixExpression("sub", (self, other), self.rows, self.cols)
+
+    def __mul__(self, other):
+        if isinstance(other, (int, float)):
+            return MatrixExpression("scale", (self,), self.rows, self.cols, scalar=other)
+        other = self._wrap(other)
+        if self.cols != other.rows:
+            raise ValueError("Number of columns in the first matrix must match number of rows in the second for multiplication.")
+        return MatrixExpression("matmul", (self, other), self.rows, other.cols)
+
+    def __rmul__(self, other):
+        if isinstance(other, (int, float)):
+            return self * other
+        return NotImplemented
+
+    def transpose(self):
+        return MatrixExpression("transpose", (self,), self.cols, self.rows)
+
+    def _collect_terms(self, coefficient, transposed, terms, backend):
+        # Flattens the tree into {(id(matrix), transposed): [matrix, transposed, coefficient]}
+        if self.op == "leaf" or self.op == "matmul":
+            if self.op == "leaf":
+                matrix = self.operands[0]
+            else:
+                left, right = self.operands
+                matrix = left.evaluate(backend).multiply(right.evaluate(backend), backend)
+            if transposed and isinstance(matrix, DiagonalMatrix):
+                transposed = False  # A diagonal matrix is its own transpose
+            key = (id(matrix), transposed)
+            if key in terms:
+                terms[key][2] += coefficient
+            else:
+                terms[key] = [matrix, transposed, coefficient]
+        elif self.op == "add":
+            self.operands[0]._collect_terms(coefficient, transposed, terms, backend)
+            self.operands[1]._collect_terms(coefficient, transposed, terms, backend)
+        elif self.op == "sub":
+            self.operands[0]._collect_terms(coefficient, transposed, terms, backend)
+            self.operands[1]._collect_terms(-coefficient, transposed, terms, backend)
+        elif self.op == "scale":
+            self.operands[0]._collect_terms(coefficient * self.scalar, transposed, terms, backend)
+        elif self.op == "transpose":
+            self.operands[0]._collect_terms(coefficient, not transposed, terms, backend)
+
+    def evaluate(self, backend=None):
+        if self.op == "leaf":
+            return self.operands[0]
+        terms = {}
+        self._collect_terms(1.0, False, terms, backend)
+        terms = [term for term in terms.values() if term[2] != 0]
+        if not terms:
+            return Matrix(self.rows, self.cols)
+
+        if len(terms) == 1 and terms[0][1] and terms[0][2] == 1:
+            return terms[0][0].transpose(backend)
+
+        coefficients = [coefficient for _, _, coefficient in terms]
+        untransposed = not any(transposed for _, transposed, _ in terms)
+        for packed_class in (DiagonalMatrix, LowerTriangularMatrix, UpperTriangularMatrix):
+            # Same packed layout everywhere: combine the packed buffers and keep the type
+            if untransposed and all(type(matrix) is packed_class for matrix, _, _ in terms):
+                result_optimized_data = get_backend(backend).linear_combination([matrix.data for matrix, _, _ in terms], coefficients)
+                return packed_class(self.rows, self.cols, result_optimized_data, optimized=True)
+
+        buffers = []
+        for matrix, transposed, _ in terms:
+            buffers.append(matrix.transpose(backend)._dense_data() if transposed else matrix._dense_data())
+        result_data = get_backend(backend).linear_combination(buffers, coefficients)
+        return Matrix(self.rows, self.cols, result_data, optimized=True)
+
+
+def _run_batch_chunk(batch, method, other, backend):
+    # Module-level so process pools can pickle it; runs one chunk of a fanned-out batch operation
+    return getattr(batch, method)(other, backend)
+
+
+class MatrixBatch:
+    # count same-shaped matrices in one contiguous buffer: element (r, c) of matrix m is at
+    # m * rows * cols + r * cols + c. Each batch operation is a single backend call over the whole
+    # buffer instead of one Matrix object and one call per matrix.
+    def __init__(self, count, rows, cols, data=None, optimized=False):
+        if not isinstance(count, int) or count <= 0:
+            raise ValueError("Number of matrices must be a positive integer.")
+        if not isinstance(rows, int) or rows <= 0:
+            raise ValueError("Number of rows must be a positive integer.")
+        if not isinstance(cols, int) or cols <= 0:
+            raise ValueError("Number of columns must be a positive integer.")
+        self.count = count
+        self.rows = rows
+        self.cols = cols
+        if optimized:
+            self.data = data
+        elif data is None:
+            self.data = array('d', bytes(8 * count * rows * cols))
+        else:
+            # One entry per matrix: a Matrix of the batch's shape or a list of lists
+            if not isinstance(data, list) or len(data) != count:
+                raise ValueError("Data must be a list with one entry per matrix.")
+            buffer = array('d')
+            for entry in data:
+                if isinstance(entry, Matrix):
+                    if entry.rows != rows or entry.cols != cols:
+                        raise ValueError("All matrices in a batch must have the same dimensions.")
+                    buffer.extend(entry._dense_data())
+                    continue
+                if not isinstance(entry, list) or len(entry) != rows:
+                    raise ValueError("Data must be a list of lists with the correct number of rows.")
+                for row_data in entry:
+                    if not isinstance(row_data, list) or len(row_data) != cols:
+                        raise ValueError("Each row in data must be a list with the correct number of columns.")
+                    for element in row_data:
+                        if not isinstance(element, (int, float)):
+                            raise ValueError("All elements in data must be numbers.")
+                    buffer.extend(row_data)
+            self.data = buffer
+
+    @classmethod
+    def from_matrices(cls, matrices):
+        if not matrices:
+            raise ValueError("At least one matrix is required.")
+        if not isinstance(matrices[0], Matrix):
+            raise TypeError("Operand must be a Matrix object.")
+        return cls(len(matrices), matrices[0].rows, matrices[0].cols, list(matrices))
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if not isinstance(index, int):
+            raise TypeError("Batch index must be an integer.")
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("Batch index out of range.")
+        size = self.rows * self.cols
+        matrix_class = SquareMatrix if self.rows == self.cols else Matrix
+        return matrix_class(self.rows, self.cols, self.data[index * size:(index + 1) * size], optimized=True)
+
+    def matrices(self):
+        return [self[index] for index in range(self.count)]
+
+    def _slice(self, start, stop):
+        size = self.rows * self.cols
+        return MatrixBatch(stop - start, self.rows, self.cols, self.data[start * size:stop * size], optimized=True)
+
+    def _dispatch(self, method, other, backend, executor):
+        # Without an executor the operation is one call over the whole buffer. With one, the batch is cut
+        # into one chunk per CPU and the chunks run on the executor (threads or processes) and are joined.
+        if executor is None:
+            return getattr(self, method)(other, backend)
+        name = get_backend(backend).name
+        step = -(-self.count // (os.cpu_count() or 1))
+        futures = []
+        for start in range(0, self.count, step):
+            stop = min(start + step, self.count)
+            chunk_other = other._slice(start, stop) if isinstance(other, MatrixBatch) else other
+            futures.append(executor.submit(_run_batch_chunk, self._slice(start, stop), method, chunk_other, name))
+        parts = [future.result() for future in futures]
+        if not isinstance(parts[0], MatrixBatch):
+            return [value for part in parts for value in part]
+        data = array('d')
+        for part in parts:
+            data.extend(part.data)
+        return MatrixBatch(self.count, parts[0].rows, parts[0].cols, data, optimized=True)
+
+    def _check_operand(self, other, operation):
+        if isinstance(other, MatrixBatch):
+            if other.count != self.count:
+                raise ValueError("Batches must hold the same number of matrices.")
+        elif not isinstance(other, Matrix):
+            raise TypeError("Operand must be a Matrix or MatrixBatch object.")
+        if operation != "multiplication" and (self.rows != other.rows or self.cols != other.cols):
+            raise ValueError(f"Matrices must have the same dimensions for {operation}.")
+        if operation == "multiplication" and self.cols != other.rows:
+            raise ValueError("Number of columns in the first matrix must match number of rows in the second for multiplication.")
+
+    def _operand_data(self, other):
+        # A single Matrix applies to every matrix of the batch
+        if isinstance(other, MatrixBatch):
+            return other.data
+        return other._dense_data() * self.count
+
+    def _add(self, other, backend):
+        data = get_backend(backend).add(self.data, self._operand_data(other))
+        return MatrixBatch(self.count, self.rows, self.cols, data, optimized=True)
+
+    def _subtract(self, other, backend):
+        data = get_backend(backend).subtract(self.data, self._operand_data(other))
+        return MatrixBatch(self.count, self.rows, self.cols, data, optimized=True)
+
+    def _scale(self, scalar, backend):
+        return MatrixBatch(self.count, self.rows, self.cols, get_backend(backend).scale(self.data, scalar), optimized=True)
+
+    def _matmul(self, other, backend):
+        other_data = other.data if isinstance(other, MatrixBatch) else other._dense_data()
+        data = get_backend(backend).batch_matmul(self.data, other_data, self.count, self.rows, self.cols, other.cols)
+        return MatrixBatch(self.count, self.rows, other.cols, data, optimized=True)
+
+    def _transpose(self, _, backend):
+        data = get_backend(backend).batch_transpose(self.data, self.count, self.rows, self.cols)
+        return MatrixBatch(self.count, self.cols, self.rows, data, optimized=True)
+
+    def _trace(self, _, backend):
+        return get_backend(backend).batch_trace(self.data, self.count, self.rows)
+
+    def _determinant(self, _, backend):
+        return get_backend(backend).batch_determinant(self.data, self.count, self.rows)
+
+    def add(self, other, backend=None, executor=None):
+        self._check_operand(other, "addition")
+        return self._dispatch("_add", other, backend, executor)
+
+    def subtract(self, other, backend=None, executor=None):
+        self._check_operand(other, "subtraction")
+        return self._dispatch("_subtract", other, backend, executor)
+
+    def multiply(self, other, backend=None, executor=None):
+        if isinstance(other, (int, float)):
+            return self._dispatch("_scale", other, backend, executor)
+        self._check_operand(other, "multiplication")
+        return self._dispatch("_matmul", other, backend, executor)
+
+    def transpose(self, backend=None, executor=None):
+        return self._dispatch("_transpose", None, backend, executor)
+
+    def trace(self, backend=None, executor=None):
+        if self.rows != self.cols:
+            raise TypeError("Trace is only defined for square matrices.")
+        return self._dispatch("_trace", None, backend, executor)
+
+    def determinant(self, backend=None, executor=None):
+        if self.rows != self.cols:
+            raise TypeError("Determinant is only defined for square matrices.")
+        return self._dispatch("_determinant", None, backend, executor)
+
+    def __add__(self, other):
+        return self.add(other)
+
+    def __sub__(self, other):
+        return self.subtract(other)
+
+    def __mul__(self, other):
+        return self.multiply(other)
+
+
+# Data whose fraction of nonzero elements is below this is stored as a SparseMatrix
+SPARSE_DENSITY_THRESHOLD = 0.05
+
+
+def _classify_data(rows, cols, data):
+    # One validating pass over the data that records the nonzero count and whether any nonzero
+    # sits below or above the main diagonal
+    if not isinstance(data, list) or len(data) != rows:
+        raise ValueError("Data must be a list of lists with the correct number of rows.")
+    nonzeros = 0
+    has_lower = False
+    has_upper = False
+    for r, row_data in enumerate(data):
+        if not isinstance(row_data, list) or len(row_data) != cols:
+            raise ValueError("Each row in data must be a list with the correct number of columns.")
+        for c, element in enumerate(row_data):
+            if not isinstance(element, (int, float)):
+                raise ValueError("All elements in data must be numbers.")
+            if element != 0:
+                nonzeros += 1
+                if c < r:
+                    has_lower = True
+                elif c > r:
+                    has_upper = True
+    return nonzeros, has_lower, has_upper
+
+
+@_instrumented("create")
+def create_matrix_from_data(rows, cols, data, sparse_threshold=None):
+    if sparse_threshold is None:
+        sparse_threshold = SPARSE_DENSITY_THRESHOLD
+    if not isinstance(rows, int) or rows <= 0:
+        raise ValueError("Number of rows must be a positive integer.")
+    if not isinstance(cols, int) or cols <= 0:
+        raise ValueError("Number of columns must be a positive integer.")
+
+    nonzeros, has_lower, has_upper = _classify_data(rows, cols, data)
+    matrix_class = _select_matrix_class(rows, cols, nonzeros, has_lower, has_upper, sparse_threshold)
+    return matrix_class._from_validated_rows(rows, cols, data)
+
+
+def _select_matrix_class(rows, cols, nonzeros, has_lower, has_upper, sparse_threshold):
+    square = rows == cols
+    if square and not has_lower and not has_upper:
+        return DiagonalMatrix
+    if nonzeros / (rows * cols) < sparse_threshold:
+        # Mostly-zero data is kept in CSR form
+        return SparseMatrix
+    if square and not has_upper:
+        return LowerTriangularMatrix
+    if square and not has_lower:
+        return UpperTriangularMatrix
+    if square:
+        return SquareMatrix
+    return Matrix
+
+
+# read_matrix_file reports progress after roughly this many bytes of input
+FILE_PROGRESS_INTERVAL = 1 << 24
+FILE_BUFFER_SIZE = 1 << 20
+
+
+@_instrumented("read_file")
+def read_matrix_file(path, sparse_threshold=None, progress=None):
+    # Streams a whitespace-separated text matrix (one row per line) straight into the storage of the
+    # class create_matrix_from_data would pick, without building a list of lists first. Rows are kept
+    # in CSR form while that is the smaller encoding and in a flat dense buffer otherwise, and the
+    # structure is classified on the way. progress(bytes_read, total_bytes) is called periodically.
+    if sparse_threshold is None:
+        sparse_threshold = SPARSE_DENSITY_THRESHOLD
+    total_bytes = os.path.getsize(path)
+    cols = None
+    rows = 0
+    nonzeros = 0
+    has_lower = False
+    has_upper = False
+    values = array('d')
+    indices = array('q')
+    indptr = array('q', [0])
+    dense = None
+    bytes_read = 0
+    next_report = FILE_PROGRESS_INTERVAL
+    with open(path, 'rb', buffering=FILE_BUFFER_SIZE) as f:
+        for line_number, line in enumerate(f, 1):
+            bytes_read += len(line)
+            tokens = line.split()
+            if not tokens:
+                continue
+            try:
+                row = array('d', map(float, tokens))
+            except ValueError:
+                raise ValueError(f"Line {line_number}: all elements must be numbers.") from None
+            if cols is None:
+                cols = len(row)
+            elif len(row) != cols:
+                raise ValueError(f"Line {line_number}: expected {cols} elements, found {len(row)} (irregular matrix shape).")
+
+            # Zero counts over the parts of the row left and right of the diagonal run in C
+            row_nonzeros = cols - row.count(0.0)
+            if row_nonzeros:
+                nonzeros += row_nonzeros
+                left = min(rows, cols)
+                if not has_lower and row[:left].count(0.0) != left:
+                    has_lower = True
+                if not has_upper and rows + 1 < cols and row[rows + 1:].count(0.0) != cols - rows - 1:
+                    has_upper = True
+            rows += 1
+
+            if dense is not None:
+                dense.extend(row)
+            elif 2 * nonzeros > rows * cols:
+                # CSR takes two words per nonzero, so past half full the dense buffer is smaller
+                dense = SparseMatrix(rows - 1, cols, (values, indices, indptr), optimized=True)._dense_data() if rows > 1 else array('d')
+                dense.extend(row)
+                values = indices = indptr = None
+            elif row_nonzeros:
+                for c, value in enumerate(row):
+                    if value != 0:
+                        values.append(value)
+                        indices.append(c)
+                indptr.append(len(values))
+            else:
+                indptr.append(len(values))
+
+            if progress is not None and bytes_read >= next_report:
+                progress(bytes_read, total_bytes)
+                next_report = bytes_read + FILE_PROGRESS_INTERVAL
+    if rows == 0:
+        raise ValueError("File is empty or invalid.")
+    if progress is not None:
+        progress(total_bytes, total_bytes)
+
+    matrix_class = _select_matrix_class(rows, cols, nonzeros, has_lower, has_upper, sparse_threshold)
+    if dense is None:
+        sparse = SparseMatrix(rows, cols, (values, indices, indptr), optimized=True)
+        if matrix_class is SparseMatrix:
+            return sparse
+        if matrix_class is DiagonalMatrix:
+            diagonal = array('d', bytes(8 * rows))
+            for r in range(rows):
+                if indptr[r] != indptr[r + 1]:
+                    diagonal[r] = values[indptr[r]]
+            return DiagonalMatrix(rows, cols, diagonal, optimized=True)
+        dense = sparse._dense_data()
+        del sparse, values, indices, indptr
+    if matrix_class in (Matrix, SquareMatrix):
+        # The row-major buffer is already the internal storage, so it is adopted without a copy
+        return matrix_class(rows, cols, dense, optimized=True)
+    if matrix_class is DiagonalMatrix:
+        return DiagonalMatrix(rows, cols, dense[::cols + 1], optimized=True)
+    if matrix_class is SparseMatrix:
+        return SparseMatrix._from_dense(rows, cols, dense)
+    return matrix_class._from_dense(rows, dense)
+
+
+# Session files: a fixed header, an index with one record (plus UTF-8 name) per matrix, then the raw
+# little-endian storage of every matrix, each payload starting on an 8-byte boundary. Packed classes
+# store only their packed data, so a triangular matrix costs n(n+1)/2 doubles and a diagonal one n.
+SESSION_MAGIC = b"MTXSESS\0"
+SESSION_VERSION = 1
+_SESSION_HEADER = struct.Struct('<8sHHQ')   # magic, version, reserved, matrix count
+_SESSION_RECORD = struct.Struct('<QBBHQQQQ')  # id, type, structure flags, name length, rows, cols, nnz, offset
+_SESSION_TYPES = (Matrix, SquareMatrix, LowerTriangularMatrix, UpperTriangularMatrix, DiagonalMatrix, SparseMatrix, MappedMatrix)
+SESSION_LOWER = 1
+SESSION_UPPER = 2
+_SESSION_WRITE_CHUNK = 1 << 24
+
+
+def _session_layout(matrix_type, rows, cols, nnz):
+    # (typecode, length) of each buffer making up the stored payload
+    if matrix_type is SparseMatrix:
+        return [('d', nnz), ('q', nnz), ('q', rows + 1)]
+    if matrix_type in (LowerTriangularMatrix, UpperTriangularMatrix):
+        return [('d', rows * (rows + 1) // 2)]
+    if matrix_type is DiagonalMatrix:
+        return [('d', rows)]
+    return [('d', rows * cols)]
+
+
+class SessionRecord:
+    # Index entry of one matrix in an open SessionFile; the matrix itself is read only by load()
+    def __init__(self, session, matrix_id, name, matrix_type, structure, rows, cols, nnz, offset):
+        self.session = session
+        self.id = matrix_id
+        self.name = name
+        self.matrix_type = matrix_type
+        self.structure = structure
+        self.rows = rows
+        self.cols = cols
+        self.nnz = nnz
+        self.offset = offset
+
+    def size(self):
+        return sum(8 * length for _, length in _session_layout(self.matrix_type, self.rows, self.cols, self.nnz))
+
+    def load(self):
+        return self.session.load(self)
+
+
+class SessionFile:
+    # Opening maps the file and parses only the index, so the cost does not depend on the payload size.
+    # Each matrix is copied out of the mapping into its own buffers the first time it is loaded, except
+    # MappedMatrix entries, which are mapped copy-on-write straight from the session file.
+    def __init__(self, path):
+        self.path = path
+        # Kept open so mapped matrices attach to this file even if path is later replaced
+        self._file = open(path, 'rb')
         try:
-            temp_matrix = SquareMatrix(rows, cols, data)
-            return temp_matrix
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
         except ValueError:
-            pass
+            self._file.close()
+            raise ValueError("Not a matrix session file.") from None
+        if len(self._map) < _SESSION_HEADER.size or self._map[:len(SESSION_MAGIC)] != SESSION_MAGIC:
+            self.close()
+            raise ValueError("Not a matrix session file.")
+        _, version, _, count = _SESSION_HEADER.unpack_from(self._map, 0)
+        if version != SESSION_VERSION:
+            self.close()
+            raise ValueError(f"Unsupported session file version {version}.")
+        self.records = []
+        position = _SESSION_HEADER.size
+        for _ in range(count):
+            matrix_id, type_code, structure, name_length, rows, cols, nnz, offset = _SESSION_RECORD.unpack_from(self._map, position)
+            position += _SESSION_RECORD.size
+            name = self._map[position:position + name_length].decode('utf-8')
+            position += name_length
+            self.records.append(SessionRecord(self, matrix_id, name, _SESSION_TYPES[type_code], structure, rows, cols, nnz, offset))
+
+    def payload(self, record):
+        return memoryview(self._map)[record.offset:record.offset + record.size()]
+
+    def load(self, record):
+        if record.matrix_type is MappedMatrix:
+            return MappedMatrix(record.rows, record.cols, self._file, offset=record.offset, mode='c')
+        return _read_payload(self._map, record.offset, record.matrix_type, record.rows, record.cols, record.nnz)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
 
-    # Finally, default to a general Matrix
-    return Matrix(rows, cols, data)
 
+def _read_payload(source, position, matrix_type, rows, cols, nnz):
+    # Builds a matrix from its stored payload at source[position:]; a MappedMatrix gets a new anonymous
+    # mapping, filled a chunk at a time
+    if matrix_type is MappedMatrix:
+        matrix = MappedMatrix(rows, cols)
+        target = matrix.data.cast('B')
+        for start in range(0, len(target), _SESSION_WRITE_CHUNK):
+            end = min(start + _SESSION_WRITE_CHUNK, len(target))
+            target[start:end] = source[position + start:position + end]
+        return matrix
+    buffers = []
+    for typecode, length in _session_layout(matrix_type, rows, cols, nnz):
+        buffer = array(typecode)
+        buffer.frombytes(source[position:position + 8 * length])
+        if sys.byteorder != 'little':
+            buffer.byteswap()
+        buffers.append(buffer)
+        position += 8 * length
+    if matrix_type is SparseMatrix:
+        return SparseMatrix(rows, cols, tuple(buffers), optimized=True)
+    return matrix_type(rows, cols, buffers[0], optimized=True)
+
+
+def _session_source(matrix):
+    # (type, structure flags, nnz, buffers) to store for a matrix; views and any other Matrix
+    # subclasses are stored as plain dense matrices
+    matrix_type = type(matrix) if type(matrix) in _SESSION_TYPES else Matrix
+    structure = 0
+    # A mapped matrix is not scanned: that would read the whole file through Python
+    if matrix.is_square() and matrix_type is not MappedMatrix:
+        structure = (SESSION_LOWER if matrix.is_lower_triangular() else 0) | (SESSION_UPPER if matrix.is_upper_triangular() else 0)
+    if matrix_type is SparseMatrix:
+        return matrix_type, structure, len(matrix.data), [matrix.data, matrix.indices, matrix.indptr]
+    if matrix_type in (LowerTriangularMatrix, UpperTriangularMatrix, DiagonalMatrix, MappedMatrix):
+        return matrix_type, structure, 0, [matrix.data]
+    return matrix_type, structure, 0, [matrix._dense_data()]
+
+
+def write_session(path, entries):
+    # entries are (id, name, source) triples, source being a Matrix or a SessionRecord whose payload
+    # is copied across without loading it. The file is written beside path and then renamed over it,
+    # so a session that is still mapped from path keeps reading its old contents.
+    sources = []
+    for matrix_id, name, source in entries:
+        encoded = name.encode('utf-8')
+        if len(encoded) > 0xFFFF:
+            raise ValueError("Matrix names are limited to 65535 bytes in a session file.")
+        if isinstance(source, SessionRecord):
+            sources.append((matrix_id, encoded, source.matrix_type, source.structure, source.rows, source.cols, source.nnz, source))
+        else:
+            matrix_type, structure, nnz, buffers = _session_source(source)
+            sources.append((matrix_id, encoded, matrix_type, structure, source.rows, source.cols, nnz, buffers))
 
+    offset = _SESSION_HEADER.size + sum(_SESSION_RECORD.size + len(source[1]) for source in sources)
+    offsets = []
+    for _, _, matrix_type, _, rows, cols, nnz, _ in sources:
+        offset += -offset % 8
+        offsets.append(offset)
+        offset += sum(8 * length for _, length in _session_layout(matrix_type, rows, cols, nnz))
+
+    temporary_path = path + ".tmp"
+    with open(temporary_path, 'wb') as f:
+        f.write(_SESSION_HEADER.pack(SESSION_MAGIC, SESSION_VERSION, 0, len(sources)))
+        for (matrix_id, encoded, matrix_type, structure, rows, cols, nnz, _), offset in zip(sources, offsets):
+            f.write(_SESSION_RECORD.pack(matrix_id, _SESSION_TYPES.index(matrix_type), structure, len(encoded), rows, cols, nnz, offset))
+            f.write(encoded)
+        for (_, _, _, _, _, _, _, payload), offset in zip(sources, offsets):
+            f.write(bytes(offset - f.tell()))
+            if isinstance(payload, SessionRecord):
+                payload = [payload.session.payload(payload)]
+            for buffer in payload:
+                if sys.byteorder != 'little' and not isinstance(buffer, memoryview):
+                    buffer = array(buffer.typecode, buffer)
+                    buffer.byteswap()
+                # Written in slices, so mapped payloads never have to be resident all at once
+                buffer = memoryview(buffer).cast('B')
+                for start in range(0, len(buffer), _SESSION_WRITE_CHUNK):
+                    f.write(buffer[start:start + _SESSION_WRITE_CHUNK])
+    os.replace(temporary_path, path)
+
+
+# Journal files: a magic/version header, then records of (body length, operation), the body and a
+# CRC-32 of the body. Each record replaces part of the registry state (an entry, an element, the next
+# ID), so replaying a journal on top of a snapshot that already contains some of its changes gives
+# the same result. A record cut short by a crash fails its length or CRC check and ends the replay.
+JOURNAL_MAGIC = b"MTXJRNL\0"
+JOURNAL_VERSION = 1
+_JOURNAL_HEADER = struct.Struct('<8sHHI')  # magic, version, reserved, reserved
+_JOURNAL_RECORD = struct.Struct('<QB')      # body length, operation
+_JOURNAL_CRC = struct.Struct('<I')
+_JOURNAL_ALTER = struct.Struct('<QQQd')     # id, row, column, value
+_JOURNAL_ID = struct.Struct('<Q')
+JOURNAL_ADD, JOURNAL_REMOVE, JOURNAL_ALTER, JOURNAL_CLEAR, JOURNAL_NEXT_ID = range(1, 6)
+
+
+class SessionJournal:
+    # Appends registry changes to path, creating it if needed. Writes are flushed to the OS after every
+    # record; sync() also forces them to disk.
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(_JOURNAL_HEADER.pack(JOURNAL_MAGIC, JOURNAL_VERSION, 0, 0))
+            self._file.flush()
+
+    def _append(self, operation, *parts):
+        length = sum(len(memoryview(part).cast('B')) for part in parts)
+        self._file.write(_JOURNAL_RECORD.pack(length, operation))
+        crc = 0
+        for part in parts:
+            part = memoryview(part).cast('B')
+            for start in range(0, len(part), _SESSION_WRITE_CHUNK):
+                chunk = part[start:start + _SESSION_WRITE_CHUNK]
+                crc = zlib.crc32(chunk, crc)
+                self._file.write(chunk)
+        self._file.write(_JOURNAL_CRC.pack(crc))
+        self._file.flush()
+
+    def add(self, matrix_id, name, source):
+        # source is a Matrix, or a SessionRecord whose payload is copied without loading it
+        encoded = name.encode('utf-8')
+        if len(encoded) > 0xFFFF:
+            raise ValueError("Matrix names are limited to 65535 bytes in a session file.")
+        if isinstance(source, SessionRecord):
+            matrix_type, structure, nnz = source.matrix_type, source.structure, source.nnz
+            buffers = [source.session.payload(source)]
+        else:
+            matrix_type, structure, nnz, buffers = _session_source(source)
+            if sys.byteorder != 'little':
+                buffers = [array(buffer.typecode, buffer) if isinstance(buffer, array) else buffer for buffer in buffers]
+                for buffer in buffers:
+                    if isinstance(buffer, array):
+                        buffer.byteswap()
+        header = _SESSION_RECORD.pack(matrix_id, _SESSION_TYPES.index(matrix_type), structure, len(encoded), source.rows, source.cols, nnz, 0)
+        self._append(JOURNAL_ADD, header, encoded, *buffers)
+
+    def remove(self, matrix_id):
+        self._append(JOURNAL_REMOVE, _JOURNAL_ID.pack(matrix_id))
+
+    def alter(self, matrix_id, row, col, value):
+        self._append(JOURNAL_ALTER, _JOURNAL_ALTER.pack(matrix_id, row, col, value))
+
+    def clear(self):
+        self._append(JOURNAL_CLEAR)
+
+    def set_next_id(self, next_id):
+        self._append(JOURNAL_NEXT_ID, _JOURNAL_ID.pack(next_id))
+
+    def extend_from(self, path):
+        # Appends every record of the journal at path, e.g. to merge an older generation into this one
+        with open(path, 'rb') as f:
+            f.seek(_JOURNAL_HEADER.size)
+            shutil.copyfileobj(f, self._file)
+        self._file.flush()
+
+    def size(self):
+        return self._file.tell()
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def read_journal(path):
+    # Returns (changes, valid_length): changes are ("add", id, name, matrix), ("remove", id),
+    # ("alter", id, row, col, value), ("clear",) and ("next_id", id) tuples in the order they were
+    # written, and valid_length is where the last complete record ends
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < _JOURNAL_HEADER.size:
+            return [], 0
+        source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        magic, version, _, _ = _JOURNAL_HEADER.unpack_from(source, 0)
+        if magic != JOURNAL_MAGIC:
+            raise ValueError("Not a matrix journal file.")
+        if version != JOURNAL_VERSION:
+            raise ValueError(f"Unsupported journal file version {version}.")
+        changes = []
+        position = _JOURNAL_HEADER.size
+        while position + _JOURNAL_RECORD.size <= len(source):
+            length, operation = _JOURNAL_RECORD.unpack_from(source, position)
+            body = position + _JOURNAL_RECORD.size
+            end = body + length + _JOURNAL_CRC.size
+            if end > len(source):
+                break
+            crc = 0
+            for start in range(body, body + length, _SESSION_WRITE_CHUNK):
+                crc = zlib.crc32(source[start:min(start + _SESSION_WRITE_CHUNK, body + length)], crc)
+            if crc != _JOURNAL_CRC.unpack_from(source, body + length)[0]:
+                break
+            if operation == JOURNAL_ADD:
+                matrix_id, type_code, _, name_length, rows, cols, nnz, _ = _SESSION_RECORD.unpack_from(source, body)
+                name_start = body + _SESSION_RECORD.size
+                name = source[name_start:name_start + name_length].decode('utf-8')
+                matrix = _read_payload(source, name_start + name_length, _SESSION_TYPES[type_code], rows, cols, nnz)
+                changes.append(("add", matrix_id, name, matrix))
+            elif operation == JOURNAL_REMOVE:
+                changes.append(("remove",) + _JOURNAL_ID.unpack_from(source, body))
+            elif operation == JOURNAL_ALTER:
+                changes.append(("alter",) + _JOURNAL_ALTER.unpack_from(source, body))
+            elif operation == JOURNAL_CLEAR:
+                changes.append(("clear",))
+            elif operation == JOURNAL_NEXT_ID:
+                changes.append(("next_id",) + _JOURNAL_ID.unpack_from(source, body))
+            else:
+                raise ValueError(f"Unknown journal record type {operation}.")
+            position = end
+        return changes, position
+    finally:
+        source.close()
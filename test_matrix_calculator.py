@@ -1,5 +1,15 @@
 import unittest
-from matrix_calculator import Matrix, SquareMatrix, LowerTriangularMatrix, UpperTriangularMatrix, DiagonalMatrix, create_matrix_from_data
+import cProfile
+import io
+import json
+import os
+import tempfile
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from matrix_calculator import Matrix, SquareMatrix, LowerTriangularMatrix, UpperTriangularMatrix, DiagonalMatrix, SparseMatrix, MappedMatrix, create_matrix_from_data, read_matrix_file, MatrixExpression, MatrixBatch, MatrixView, plan_chain, multiply_chain, matmul_kernel, strassen_kernel, set_strassen_crossover, get_strassen_crossover, STRASSEN_MIN_SIZE, STRASSEN_DEFAULT_CROSSOVER, ParallelBackend, available_backends, get_backend, set_backend, enable_profiling, disable_profiling, get_profile, reset_profile, export_profile
+import matrix_calculator
+from main import MatrixManager, parse_script, run_script
 
 class TestMatrixCalculator(unittest.TestCase):
 
@@ -28,6 +38,24 @@ class TestMatrixCalculator(unittest.TestCase):
         with self.assertRaises(ValueError):
             m.set_element(0, 0, 'abc')
 
+    def test_matrix_contiguous_storage(self):
+        rows_data = [[1, 2, 3], [4, 5, 6]]
+        m = Matrix(2, 3, rows_data)
+        self.assertIsInstance(m.data, array)
+        self.assertEqual(m.data.typecode, 'd')
+        self.assertEqual(m.stride, 3)
+        self.assertEqual(list(m.data), [1.0, 2.0, 3.0, 4.0, 5.0, 6.0])
+
+        # The list-of-lists passed in is copied, not aliased
+        m.set_element(1, 0, 40)
+        self.assertEqual(rows_data[1][0], 4)
+        self.assertEqual(m.data[3], 40.0)
+
+        self.assertEqual(m.to_string(), "[ 1.00 2.00 3.00 ]\n[ 40.00 5.00 6.00 ]\n")
+        m_buffer = Matrix(2, 3, array('d', [1, 2, 3, 4, 5, 6]), optimized=True)
+        self.assertEqual(m_buffer.get_element(1, 2), 6.0)
+        self.assertEqual((m_buffer + m_buffer).get_element(1, 2), 12.0)
+
     def test_matrix_is_type(self):
         m_general = Matrix(2, 3, [[1, 2, 3], [4, 5, 6]])
         self.assertFalse(m_general.is_square())
@@ -103,12 +131,194 @@ class TestMatrixCalculator(unittest.TestCase):
         with self.assertRaises(ValueError):
             Matrix(2, 3) * Matrix(2, 2)
 
+    def test_matmul_kernel_block_sizes(self):
+        m1 = Matrix(3, 4, [[1, 2, 0, 4], [5, 6, 7, 8], [9, 0, 1, 2]])
+        m2 = Matrix(4, 2, [[1, 2], [3, 4], [5, 6], [7, 8]])
+        expected = [35.0, 42.0, 114.0, 140.0, 28.0, 40.0]
+        for block_size in (1, 2, 3, 64):
+            result = matmul_kernel(m1.data, m2.data, 3, 4, 2, block_size)
+            self.assertEqual(list(result), expected)
+        self.assertEqual(list((m1 * m2).data), expected)
+
+        with self.assertRaises(ValueError):
+            matmul_kernel(m1.data, m2.data, 3, 4, 2, 0)
+
+    def test_strassen_kernel(self):
+        # Small integer entries keep every intermediate exact, so results must match the classical kernel
+        for n, crossover in ((8, 2), (7, 2), (13, 4), (33, 8)):
+            a = array('d', [float((i * 7) % 11 - 5) for i in range(n * n)])
+            b = array('d', [float((i * 5) % 13 - 6) for i in range(n * n)])
+            self.assertEqual(list(strassen_kernel(a, b, n, crossover)), list(matmul_kernel(a, b, n, n, n)))
+
+        with self.assertRaises(ValueError):
+            strassen_kernel(a, b, n, 1)
+        with self.assertRaises(ValueError):
+            set_strassen_crossover(0)
+
+        n = STRASSEN_MIN_SIZE + 3
+        m1 = SquareMatrix(n, n, [[float((r + 2 * c) % 5) for c in range(n)] for r in range(n)])
+        m2 = SquareMatrix(n, n, [[float((r * c) % 3 - 1) for c in range(n)] for r in range(n)])
+        expected = matmul_kernel(m1.data, m2.data, n, n, n)
+        set_strassen_crossover(32)
+        try:
+            self.assertEqual(list(m1.multiply(m2, backend="python").data), list(expected))
+        finally:
+            set_strassen_crossover(None)
+
+        # Without a setting the crossover is the fixed default; nothing is timed behind the caller's back
+        saved = os.environ.pop(matrix_calculator.STRASSEN_ENV_VAR, None)
+        try:
+            self.assertEqual(get_strassen_crossover(), STRASSEN_DEFAULT_CROSSOVER)
+            self.assertIsNone(matrix_calculator._strassen_crossover)
+        finally:
+            if saved is not None:
+                os.environ[matrix_calculator.STRASSEN_ENV_VAR] = saved
+
+    def test_parallel_backend(self):
+        backend = ParallelBackend(workers=3, min_flops=0)
+        try:
+            for rows, inner, cols in ((7, 4, 5), (2, 3, 3), (1, 2, 2)):
+                a = array('d', [float(i % 9 - 4) for i in range(rows * inner)])
+                b = array('d', [float(i % 7 - 3) for i in range(inner * cols)])
+                self.assertEqual(list(backend.matmul(a, b, rows, inner, cols)), list(matmul_kernel(a, b, rows, inner, cols)))
+        finally:
+            backend.close()
+
+        self.assertIn("parallel", available_backends())
+        with self.assertRaises(ValueError):
+            backend.configure(workers=0)
+        with self.assertRaises(ValueError):
+            backend.configure(min_flops=-1)
+
+    def test_backends_agree(self):
+        m1 = SquareMatrix(3, 3, [[2, -1, 0], [4, 1, 3], [-2, 5, 1]])
+        m2 = SquareMatrix(3, 3, [[1, 0, 2], [0, 3, 1], [4, 1, 0]])
+        expected_product = [2.0, -3.0, 3.0, 16.0, 6.0, 9.0, 2.0, 16.0, 1.0]
+        for name in available_backends():
+            self.assertEqual(list(m1.add(m2, backend=name).data), [3.0, -1.0, 2.0, 4.0, 4.0, 4.0, 2.0, 6.0, 1.0])
+            self.assertEqual(list(m1.subtract(m2, backend=name).data), [1.0, -1.0, -2.0, 4.0, -2.0, 2.0, -6.0, 4.0, 1.0])
+            self.assertEqual(list(m1.multiply(2, backend=name).data), [4.0, -2.0, 0.0, 8.0, 2.0, 6.0, -4.0, 10.0, 2.0])
+            self.assertEqual(list(m1.multiply(m2, backend=name).data), expected_product)
+            self.assertEqual(list(m1.transpose(backend=name).data), [2.0, 4.0, -2.0, -1.0, 1.0, 5.0, 0.0, 3.0, 1.0])
+            self.assertAlmostEqual(m1.determinant(backend=name), -18.0)
+
+        # Packed types keep their own fast paths and expand to dense only when mixed
+        dm = DiagonalMatrix(3, 3, [[1, 0, 0], [0, 2, 0], [0, 0, 3]])
+        for name in available_backends():
+            self.assertIsInstance(dm.add(dm, backend=name), DiagonalMatrix)
+            self.assertEqual(list(dm.add(m1, backend=name).data), [3.0, -1.0, 0.0, 4.0, 3.0, 3.0, -2.0, 5.0, 4.0])
+
+    def test_backend_selection(self):
+        previous = get_backend()
+        try:
+            self.assertEqual(set_backend("python").name, "python")
+            self.assertIs(get_backend(), get_backend("python"))
+            with self.assertRaises(ValueError):
+                set_backend("fortran")
+            self.assertEqual(get_backend().name, "python")
+            self.assertEqual(get_backend("auto").name, "numpy" if "numpy" in available_backends() else "python")
+        finally:
+            set_backend(previous.name)
+
+    def test_structured_products(self):
+        lower1 = LowerTriangularMatrix(3, 3, [[1, 0, 0], [2, 3, 0], [4, 5, 6]])
+        lower2 = LowerTriangularMatrix(3, 3, [[2, 0, 0], [1, -1, 0], [0, 3, 1]])
+        upper1 = UpperTriangularMatrix(3, 3, [[1, 2, 3], [0, 4, 5], [0, 0, 6]])
+        upper2 = UpperTriangularMatrix(3, 3, [[1, 0, 2], [0, 2, 1], [0, 0, 3]])
+        diagonal = DiagonalMatrix(3, 3, [[2, 0, 0], [0, 3, 0], [0, 0, -1]])
+        square = SquareMatrix(3, 3, [[1, 2, 3], [4, 5, 6], [7, 8, 9]])
+        general = Matrix(3, 2, [[1, 2], [3, 4], [5, 6]])
+
+        cases = [
+            (lower1, lower2, LowerTriangularMatrix),
+            (upper1, upper2, UpperTriangularMatrix),
+            (diagonal, lower1, LowerTriangularMatrix),
+            (upper1, diagonal, UpperTriangularMatrix),
+            (diagonal, square, SquareMatrix),
+            (square, diagonal, SquareMatrix),
+            (diagonal, general, Matrix),
+            (diagonal, diagonal, DiagonalMatrix),
+            (lower1, upper1, Matrix),
+        ]
+        for name in available_backends():
+            for left, right, expected_type in cases:
+                product = left.multiply(right, backend=name)
+                self.assertIs(type(product), expected_type)
+                dense = Matrix(left.rows, left.cols, left._dense_data(), optimized=True) * Matrix(right.rows, right.cols, right._dense_data(), optimized=True)
+                self.assertEqual(list(product._dense_data()), list(dense.data))
+
     def test_square_matrix(self):
         sm = SquareMatrix(2, 2, [[1, 2], [3, 4]])
         self.assertEqual(sm.trace(), 5.0)
         with self.assertRaises(ValueError):
             SquareMatrix(2, 3)
 
+    def test_lu_decomposition(self):
+        sm = SquareMatrix(3, 3, [[0, 2, 1], [4, 1, 3], [2, 5, 1]])
+        lower, upper, perm = sm.lu_decomposition()
+        self.assertIsInstance(lower, LowerTriangularMatrix)
+        self.assertIsInstance(upper, UpperTriangularMatrix)
+        self.assertEqual(perm, [1, 2, 0])
+        for i in range(3):
+            self.assertEqual(lower.get_element(i, i), 1.0)
+
+        product = lower * upper
+        for r in range(3):
+            for c in range(3):
+                self.assertAlmostEqual(product.get_element(r, c), sm.get_element(perm[r], c))
+
+        self.assertAlmostEqual(sm.determinant(), 22.0)
+        self.assertAlmostEqual(sm.determinant(backend="python"), 22.0)
+
+        # The factorization is cached until the matrix changes
+        self.assertIs(sm.lu_decomposition()[1], upper)
+        sm.set_element(0, 0, 1)
+        self.assertIsNot(sm.lu_decomposition()[1], upper)
+        self.assertAlmostEqual(sm.determinant(), 8.0)
+
+        singular = SquareMatrix(2, 2, [[1, 2], [2, 4]])
+        self.assertEqual(singular.determinant(backend="python"), 0.0)
+
+    def test_solve_and_inverse(self):
+        sm = SquareMatrix(3, 3, [[2, 1, 1], [4, -6, 0], [-2, 7, 2]])
+        x = sm.solve([5, -2, 9])
+        for actual, expected in zip(x, [1.0, 1.0, 2.0]):
+            self.assertAlmostEqual(actual, expected)
+
+        # Several right-hand sides at once, one factorization
+        rhs = Matrix(3, 2, [[5, 4], [-2, 4], [9, 3]])
+        solution = sm.solve(rhs)
+        self.assertEqual((solution.rows, solution.cols), (3, 2))
+        check = sm * solution
+        for actual, expected in zip(check.data, rhs.data):
+            self.assertAlmostEqual(actual, expected)
+
+        inverse = sm.inverse()
+        self.assertIsInstance(inverse, SquareMatrix)
+        for r in range(3):
+            for c in range(3):
+                self.assertAlmostEqual((sm * inverse).get_element(r, c), 1.0 if r == c else 0.0)
+
+        ltm = LowerTriangularMatrix(3, 3, [[2, 0, 0], [1, 4, 0], [3, -1, 5]])
+        utm = UpperTriangularMatrix(3, 3, [[2, 1, 3], [0, 4, -1], [0, 0, 5]])
+        dm = DiagonalMatrix(3, 3, [[2, 0, 0], [0, 4, 0], [0, 0, 5]])
+        for structured, inverse_type in ((ltm, LowerTriangularMatrix), (utm, UpperTriangularMatrix), (dm, DiagonalMatrix)):
+            x = structured.solve([2, 9, 10])
+            dense = SquareMatrix(3, 3, structured._dense_data(), optimized=True)
+            for actual, expected in zip(x, dense.solve([2, 9, 10])):
+                self.assertAlmostEqual(actual, expected)
+            inverse = structured.inverse()
+            self.assertIsInstance(inverse, inverse_type)
+            for actual, expected in zip(inverse._dense_data(), dense.inverse().data):
+                self.assertAlmostEqual(actual, expected)
+
+        with self.assertRaises(ValueError):
+            SquareMatrix(2, 2, [[1, 2], [2, 4]]).solve([1, 2])
+        with self.assertRaises(ValueError):
+            sm.solve([1, 2])
+        with self.assertRaises(TypeError):
+            sm.solve("abc")
+
     def test_lower_triangular_matrix(self):
         ltm = LowerTriangularMatrix(3, 3, [[1, 0, 0], [2, 3, 0], [4, 5, 6]])
         self.assertEqual(ltm.get_element(0, 0), 1.0)
@@ -161,6 +371,33 @@ class TestMatrixCalculator(unittest.TestCase):
         self.assertEqual(utm_scaled.get_element(0, 1), 4.0)
         self.assertEqual(utm_scaled.get_element(1, 1), 6.0)
 
+    def test_triangular_packed_storage(self):
+        # LAPACK packed layouts: columns of the triangle stored one after another
+        ltm = LowerTriangularMatrix(3, 3, [[1, 0, 0], [2, 3, 0], [4, 5, 6]])
+        self.assertEqual(list(ltm.data), [1.0, 2.0, 4.0, 3.0, 5.0, 6.0])
+        utm = UpperTriangularMatrix(3, 3, [[1, 2, 3], [0, 4, 5], [0, 0, 6]])
+        self.assertEqual(list(utm.data), [1.0, 2.0, 4.0, 3.0, 5.0, 6.0])
+
+        ltm_packed = LowerTriangularMatrix.from_packed(3, [1, 2, 4, 3, 5, 6])
+        self.assertEqual(ltm_packed.to_string(), ltm.to_string())
+        utm_packed = UpperTriangularMatrix.from_packed(3, [1, 2, 4, 3, 5, 6])
+        self.assertEqual(utm_packed.to_string(), utm.to_string())
+
+        ltm_packed.set_element(2, 1, 50)
+        self.assertEqual(ltm_packed.data[4], 50.0)
+        self.assertEqual(ltm_packed.get_element(2, 1), 50.0)
+        with self.assertRaises(ValueError):
+            utm_packed.set_element(2, 0, 1)
+
+        utm_diff = utm - utm_packed * 2
+        self.assertIsInstance(utm_diff, UpperTriangularMatrix)
+        self.assertEqual(utm_diff.get_element(1, 2), -5.0)
+
+        with self.assertRaises(ValueError):
+            LowerTriangularMatrix.from_packed(3, [1, 2, 3])
+        with self.assertRaises(ValueError):
+            UpperTriangularMatrix.from_packed(2, [1, 'a', 3])
+
     def test_diagonal_matrix(self):
         dm = DiagonalMatrix(3, 3, [[1, 0, 0], [0, 2, 0], [0, 0, 3]])
         self.assertEqual(dm.get_element(0, 0), 1.0)
@@ -192,6 +429,661 @@ class TestMatrixCalculator(unittest.TestCase):
         self.assertEqual(dm_prod.get_element(0, 0), 3.0)
         self.assertEqual(dm_prod.get_element(1, 1), 8.0)
 
+    def test_sparse_matrix(self):
+        sp = SparseMatrix(3, 4, [[0, 2, 0, 0], [0, 0, 0, 0], [5, 0, 0, 7]])
+        self.assertEqual(sp.nnz(), 3)
+        self.assertEqual(list(sp.indptr), [0, 1, 1, 3])
+        self.assertEqual(list(sp.indices), [1, 0, 3])
+        self.assertEqual(sp.get_element(2, 3), 7.0)
+        self.assertEqual(sp.get_element(1, 1), 0.0)
+
+        sp.set_element(1, 2, 4)
+        sp.set_element(0, 1, 0)
+        self.assertEqual(list(sp.indptr), [0, 0, 1, 3])
+        self.assertEqual(sp.to_string(), "[ 0.00 0.00 0.00 0.00 ]\n[ 0.00 0.00 4.00 0.00 ]\n[ 5.00 0.00 0.00 7.00 ]\n")
+
+        other = SparseMatrix(3, 4, [[1, 0, 0, 0], [0, 0, -4, 0], [0, 0, 0, 1]])
+        total = sp + other
+        self.assertIsInstance(total, SparseMatrix)
+        self.assertEqual(total.nnz(), 3)  # The cancelled (1, 2) entry is not stored
+        self.assertEqual(list((sp - other)._dense_data()), [-1.0, 0.0, 0.0, 0.0, 0.0, 0.0, 8.0, 0.0, 5.0, 0.0, 0.0, 6.0])
+        self.assertIsInstance(sp * 2, SparseMatrix)
+        self.assertEqual((sp * 2).get_element(2, 0), 10.0)
+
+        transposed = sp.transpose()
+        self.assertIsInstance(transposed, SparseMatrix)
+        self.assertEqual(list(transposed._dense_data()), list(Matrix(3, 4, sp._dense_data(), optimized=True).transpose().data))
+
+        dense = Matrix(4, 2, [[1, 2], [3, 4], [5, 6], [7, 8]])
+        dense_sp = Matrix(3, 4, sp._dense_data(), optimized=True)
+        cases = [
+            (sp, transposed, SparseMatrix),
+            (sp, dense, Matrix),
+            (dense.transpose(), transposed, Matrix),
+            (DiagonalMatrix(3, 3, [[2, 0, 0], [0, 3, 0], [0, 0, 4]]), sp, SparseMatrix),
+        ]
+        for left, right, expected_type in cases:
+            product = left * right
+            self.assertIs(type(product), expected_type)
+            expected = Matrix(left.rows, left.cols, left._dense_data(), optimized=True) * Matrix(right.rows, right.cols, right._dense_data(), optimized=True)
+            self.assertEqual(list(product._dense_data()), list(expected.data))
+
+        # Mixed elementwise operations fall back to dense results
+        mixed = sp + dense_sp
+        self.assertIs(type(mixed), Matrix)
+        self.assertEqual(list(mixed.data), [2 * value for value in dense_sp.data])
+        self.assertEqual(list((dense_sp - sp).data), [0.0] * 12)
+
+        # Square sparse matrices are solved and inverted through a dense factorization
+        square = SparseMatrix(3, 3, [[2, 0, 0], [0, 0, 4], [0, 1, 0]])
+        for value, expected in zip(square.solve([2, 8, 3]), [1.0, 3.0, 2.0]):
+            self.assertAlmostEqual(value, expected)
+        self.assertEqual(list(square.inverse()._dense_data()), [0.5, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.25, 0.0])
+        with self.assertRaises(TypeError):
+            sp.inverse()
+        manager = MatrixManager()
+        manager.add_matrix(square, "S")
+        out = io.StringIO()
+        run_script(manager, parse_script("J = inverse S\ntrace J"), out=out)
+        self.assertEqual(out.getvalue(), "trace J = 0.5\n")
+
+    def test_lazy_expressions(self):
+        a = Matrix(2, 3, [[1, 2, 3], [4, 5, 6]])
+        b = Matrix(2, 3, [[6, 5, 4], [3, 2, 1]])
+        c = Matrix(2, 3, [[1, 1, 1], [2, 2, 2]])
+        expression = (a.lazy() + b - c) * 2.0
+        self.assertIsInstance(expression, MatrixExpression)
+        expected = (a + b - c) * 2.0
+        for name in available_backends():
+            result = expression.evaluate(backend=name)
+            self.assertIs(type(result), Matrix)
+            self.assertEqual(list(result.data), list(expected.data))
+
+        # Scalars fold, repeated leaves merge and double transposes cancel
+        folded = (3 * (a.lazy() * 2.0) - a * 6.0 + b.lazy().transpose().transpose()).evaluate()
+        self.assertEqual(list(folded.data), list(b.data))
+        zero = (a.lazy() - a).evaluate()
+        self.assertEqual(list(zero.data), [0.0] * 6)
+
+        # Transposes and products inside the expression
+        at = (a.lazy().transpose() + b.transpose()).evaluate()
+        self.assertEqual(list(at.data), list((a + b).transpose().data))
+        product = (a.lazy() * b.transpose() + Matrix(2, 2)).evaluate()
+        self.assertEqual(list(product.data), list((a * b.transpose()).data))
+
+        # Same packed type everywhere keeps the packed result
+        d1 = DiagonalMatrix(2, 2, [[1, 0], [0, 2]])
+        d2 = DiagonalMatrix(2, 2, [[3, 0], [0, 4]])
+        diagonal = (d1.lazy() - d2.lazy().transpose() * 0.5).evaluate()
+        self.assertIsInstance(diagonal, DiagonalMatrix)
+        self.assertEqual(list(diagonal.data), [-0.5, 0.0])
+        lower = (LowerTriangularMatrix(2, 2, [[1, 0], [2, 3]]).lazy() * 2 + LowerTriangularMatrix(2, 2, [[1, 0], [1, 1]])).evaluate()
+        self.assertIsInstance(lower, LowerTriangularMatrix)
+        self.assertEqual(lower.to_string(), "[ 3.00 0.00 ]\n[ 5.00 7.00 ]\n")
+
+        with self.assertRaises(ValueError):
+            a.lazy() + Matrix(3, 2)
+        with self.assertRaises(TypeError):
+            a.lazy() + 1
+
+    def test_multiply_chain(self):
+        a = Matrix(10, 30)
+        b = Matrix(30, 5)
+        c = Matrix(5, 60)
+        plan = plan_chain([a, b, c])
+        self.assertEqual(plan.order, ((0, 1), 2))
+        self.assertEqual(plan.flops, 10 * 30 * 5 + 10 * 5 * 60)
+        self.assertEqual(plan.describe(["A", "B", "C"]), "((A x B) x C)")
+
+        # Left to right costs 50 * 10 * 40 + 50 * 40 * 30; multiplying the last two first is cheaper
+        x = Matrix(50, 10, [[float((r + c) % 7) for c in range(10)] for r in range(50)])
+        y = Matrix(10, 40, [[float((r * c) % 5) for c in range(40)] for r in range(10)])
+        z = Matrix(40, 30, [[float(r - c) for c in range(30)] for r in range(40)])
+        w = Matrix(30, 1, [[1.0] for _ in range(30)])
+        plan = plan_chain([x, y, z, w])
+        self.assertLess(plan.flops, plan.naive_flops)
+        self.assertEqual(plan.describe(), "(M1 x (M2 x (M3 x M4)))")
+        result = multiply_chain([x, y, z, w])
+        self.assertEqual(list(result.data), list((x * y * z * w).data))
+
+        # Structure lowers the estimate: a diagonal factor is a scaling
+        d = DiagonalMatrix(30, 30, [[1.0 if r == c else 0.0 for c in range(30)] for r in range(30)])
+        self.assertEqual(plan_chain([z, d]).flops, 40 * 30)
+
+        with self.assertRaises(ValueError):
+            plan_chain([a, c])
+        with self.assertRaises(ValueError):
+            plan_chain([])
+
+    def test_matrix_views(self):
+        m = Matrix(3, 4, [[1, 2, 3, 4], [5, 6, 7, 8], [9, 10, 11, 12]])
+        self.assertEqual(m[1, 2], 7.0)
+        self.assertEqual(m[-1, -1], 12.0)
+        self.assertEqual(list(m[1].copy().data), [5.0, 6.0, 7.0, 8.0])
+        self.assertEqual(list(m[:, 1].copy().data), [2.0, 6.0, 10.0])
+        block = m[1:3, ::2]
+        self.assertIsInstance(block, MatrixView)
+        self.assertEqual((block.rows, block.cols), (2, 2))
+        self.assertEqual(list(block.copy().data), [5.0, 7.0, 9.0, 11.0])
+
+        # Views share storage in both directions; copies do not
+        t = m.transpose_view()
+        self.assertEqual(list(t.copy().data), list(m.transpose().data))
+        self.assertIs(t.data, m.data)
+        snapshot = block.copy()
+        block.set_element(0, 1, 70)
+        self.assertEqual(m.get_element(1, 2), 70.0)
+        self.assertEqual(t.get_element(2, 1), 70.0)
+        self.assertEqual(snapshot.get_element(0, 1), 7.0)
+        self.assertEqual(t[::-1, 1:].get_element(0, 0), 8.0)
+
+        b = Matrix(3, 2, [[1, 0], [0, 1], [2, -1]])
+        for name in available_backends():
+            self.assertEqual(list(t.multiply(b, backend=name).data), list(m.transpose().multiply(b, backend=name).data))
+            self.assertEqual(list(m[:2, :3].multiply(t[:3, ::-1], backend=name).data),
+                             list(m[:2, :3].copy().multiply(t[:3, ::-1].copy(), backend=name).data))
+        self.assertEqual(list((t[:2] + t[2:]).data), [4.0, 75.0, 20.0, 6.0, 14.0, 22.0])
+
+        # Views of packed storage read and write through the owner
+        lower = LowerTriangularMatrix(3, 3, [[1, 0, 0], [2, 3, 0], [4, 5, 6]])
+        upper_view = lower.transpose_view()
+        self.assertEqual(upper_view.get_element(0, 2), 4.0)
+        upper_view.set_element(1, 2, 50)
+        self.assertEqual(lower.get_element(2, 1), 50.0)
+        with self.assertRaises(ValueError):
+            upper_view.set_element(2, 0, 1)
+
+        with self.assertRaises(IndexError):
+            m[3, 0]
+        with self.assertRaises(ValueError):
+            m[2:2]
+        with self.assertRaises(TypeError):
+            m["row"]
+
+    def test_in_place_operators(self):
+        m = SquareMatrix(2, 2, [[1, 2], [3, 4]])
+        storage = m.data
+        self.assertAlmostEqual(m.determinant(), -2.0)
+        m += Matrix(2, 2, [[1, 1], [1, 1]])
+        m -= DiagonalMatrix(2, 2, [[1, 0], [0, 1]])
+        m *= 2
+        self.assertIs(m.data, storage)
+        self.assertEqual(list(m.data), [2.0, 6.0, 8.0, 8.0])
+        self.assertAlmostEqual(m.determinant(), -32.0)  # The cached LU was dropped
+
+        # Packed and sparse types stay packed; operands they cannot hold fall back to a new matrix
+        lower = LowerTriangularMatrix(2, 2, [[1, 0], [2, 3]])
+        packed = lower.data
+        lower += lower
+        lower *= 0.5
+        self.assertIs(lower.data, packed)
+        self.assertEqual(list(lower.data), [1.0, 2.0, 3.0])
+        original = lower
+        lower += m
+        self.assertNotIsInstance(lower, LowerTriangularMatrix)
+        self.assertEqual(list(original.data), [1.0, 2.0, 3.0])
+
+        # Structure-preserving pairs stay in place too: triangular +/- diagonal, and products that keep
+        # the packed structure written to a packed out= target
+        lower = LowerTriangularMatrix(2, 2, [[1, 0], [2, 3]])
+        upper = UpperTriangularMatrix(2, 2, [[1, 2], [0, 3]])
+        lower_packed, upper_packed = lower.data, upper.data
+        lower += DiagonalMatrix(2, 2, [[1, 0], [0, 1]])
+        upper -= DiagonalMatrix(2, 2, [[1, 0], [0, 1]])
+        self.assertIs(lower.data, lower_packed)
+        self.assertIs(upper.data, upper_packed)
+        self.assertEqual((list(lower.data), list(upper.data)), ([2.0, 2.0, 4.0], [0.0, 2.0, 2.0]))
+        # Triangular and diagonal operands give the triangular type in either order
+        diagonal = DiagonalMatrix(2, 2, [[1, 0], [0, 2]])
+        for left, right, expected_type, expected in ((upper, diagonal, UpperTriangularMatrix, [1.0, 2.0, 0.0, 4.0]),
+                                                     (diagonal, upper, UpperTriangularMatrix, [1.0, 2.0, 0.0, 4.0]),
+                                                     (diagonal, lower, LowerTriangularMatrix, [3.0, 0.0, 2.0, 6.0])):
+            total = left + right
+            self.assertIs(type(total), expected_type)
+            self.assertEqual(list(total._dense_data()), expected)
+        difference = diagonal - upper
+        self.assertIs(type(difference), UpperTriangularMatrix)
+        self.assertEqual(list(difference._dense_data()), [1.0, -2.0, 0.0, 0.0])
+        self.assertEqual(list((upper - diagonal)._dense_data()), [-1.0, 2.0, 0.0, 0.0])
+        diagonal += lower
+        self.assertIs(type(diagonal), LowerTriangularMatrix)
+        self.assertEqual(list(diagonal._dense_data()), [3.0, 0.0, 2.0, 6.0])
+        self.assertIs(lower.multiply(lower, out=lower), lower)
+        self.assertIs(lower.data, lower_packed)
+        self.assertEqual(list(lower._dense_data()), [4.0, 0.0, 12.0, 16.0])
+        with self.assertRaises(TypeError):
+            lower.multiply(upper, out=lower.copy())
+
+        # A sparse sum whose nonzeros are already stored updates the CSR arrays in place
+        sparse = SparseMatrix(3, 3, [[0, 1, 0], [0, 0, 0], [2, 0, 3]])
+        arrays = sparse.data, sparse.indices, sparse.indptr
+        sparse += SparseMatrix(3, 3, [[0, 4, 0], [0, 0, 0], [0, 0, 1]])
+        sparse -= SparseMatrix(3, 3, [[0, 0, 0], [0, 0, 0], [0, 0, 4]])
+        for array_before, array_after in zip(arrays, (sparse.data, sparse.indices, sparse.indptr)):
+            self.assertIs(array_after, array_before)
+        self.assertEqual((list(sparse.data), list(sparse.indices), list(sparse.indptr)), ([5.0, 2.0], [1, 0], [0, 1, 1, 2]))
+
+        sparse = SparseMatrix(3, 3, [[0, 1, 0], [0, 0, 0], [2, 0, 0]])
+        same = sparse
+        sparse -= SparseMatrix(3, 3, [[0, 1, 0], [0, 0, 5], [0, 0, 0]])
+        sparse *= 3
+        self.assertIs(sparse, same)
+        self.assertEqual(sparse.nnz(), 2)
+        self.assertEqual(sparse.get_element(1, 2), -15.0)
+
+        # Views write through to their owner
+        owner = Matrix(2, 3, [[1, 2, 3], [4, 5, 6]])
+        column = owner[:, 1]
+        column += Matrix(2, 1, [[10], [20]])
+        self.assertEqual(list(owner.data), [1.0, 12.0, 3.0, 4.0, 25.0, 6.0])
+
+        for name in available_backends():
+            out = Matrix(2, 2)
+            a = Matrix(2, 2, [[1, 2], [3, 4]])
+            self.assertIs(a.multiply(a, backend=name, out=out), out)
+            self.assertEqual(list(out.data), [7.0, 10.0, 15.0, 22.0])
+            a.multiply(a, backend=name, out=a)
+            self.assertEqual(list(a.data), [7.0, 10.0, 15.0, 22.0])
+            diagonal = DiagonalMatrix(2, 2, [[1, 0], [0, 2]])
+            self.assertEqual(list(diagonal.add(diagonal, backend=name, out=diagonal).data), [2.0, 4.0])
+            self.assertEqual(list(diagonal.multiply(out, backend=name, out=out).data), [14.0, 20.0, 60.0, 88.0])
+
+        with self.assertRaises(ValueError):
+            m.add(m, out=Matrix(3, 3))
+        with self.assertRaises(TypeError):
+            m.add(m, out=LowerTriangularMatrix(2, 2, [[1, 0], [1, 1]]))
+
+    def test_read_matrix_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "matrix.txt")
+            with open(path, "w") as f:
+                f.write("1 0 0 0\n2 3 0 0\n\n4 5 6 0\n7 8 9 10\n")
+            reports = []
+            m = read_matrix_file(path, progress=lambda done, total: reports.append((done, total)))
+            self.assertIsInstance(m, LowerTriangularMatrix)
+            self.assertEqual(m.to_string(), create_matrix_from_data(4, 4, [[1, 0, 0, 0], [2, 3, 0, 0], [4, 5, 6, 0], [7, 8, 9, 10]]).to_string())
+            self.assertEqual(reports[-1], (os.path.getsize(path), os.path.getsize(path)))
+
+            with open(path, "w") as f:
+                f.write("\n".join(" ".join("1" if c == 3 * r else "0" for c in range(30)) for r in range(10)))
+            m = read_matrix_file(path)
+            self.assertIsInstance(m, SparseMatrix)
+            self.assertEqual(m.nnz(), 10)
+            self.assertEqual(m.get_element(9, 27), 1.0)
+
+            with open(path, "w") as f:
+                f.write("1 2 3\n4 5\n" + "6 7 8\n" * 1000)
+            with self.assertRaisesRegex(ValueError, "Line 2"):
+                read_matrix_file(path)
+
+    def test_matrix_manager_registry(self):
+        manager = MatrixManager()
+        lower = LowerTriangularMatrix(3, 3, [[1, 0, 0], [2, 3, 0], [4, 5, 6]])
+        first = manager.add_matrix(lower, "L")
+        second = manager.add_matrix(Matrix(3, 3), "L")
+        third = manager.add_matrix(DiagonalMatrix(3, 3, [[1, 0, 0], [0, 2, 0], [0, 0, 3]]))
+        manager.add_matrix(Matrix(2, 3))
+
+        self.assertIs(manager.get_matrix_by_id(first), lower)
+        self.assertIs(manager.get_matrix_by_name("L"), lower)
+        self.assertEqual(len(manager.get_matrices_by_name("L")), 2)
+        self.assertEqual([m["id"] for m in manager.find_matrices(LowerTriangularMatrix, 3, 3)], [first])
+        self.assertEqual([m["id"] for m in manager.find_matrices(SquareMatrix)], [first, third])
+        self.assertEqual([m["id"] for m in manager.find_matrices(rows=3, cols=3)], [first, second, third])
+
+        # Removal keeps the remaining entries in order and re-points the name index
+        self.assertTrue(manager.remove_matrix_by_id(first))
+        self.assertFalse(manager.remove_matrix_by_id(first))
+        self.assertIsNone(manager.get_matrix_by_id(first))
+        self.assertIs(manager.get_matrix_by_name("L"), manager.get_matrix_by_id(second))
+        self.assertEqual([m["id"] for m in manager.matrices], [second, third, 4])
+        self.assertEqual(manager.find_matrices(LowerTriangularMatrix), [])
+
+    def test_run_script(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "a.txt")
+            with open(path, "w") as f:
+                f.write("1 2\n3 4\n")
+            steps = parse_script(f"""
+                A = load {path}
+                I = identity 2
+                B = A * 2       # reads A before it is bound again below
+                A = A * I
+                C = A + B
+                print C
+                trace C
+                write C {path}
+                D = load {path}
+                T = transpose D
+                trace T
+            """)
+            self.assertEqual(steps[2], {"line": 4, "name": "B", "op": "multiply", "args": ["A", 2.0]})
+            manager = MatrixManager()
+            out = io.StringIO()
+            run_script(manager, steps, workers=4, out=out)
+            self.assertEqual(out.getvalue(), "C (Matrix, 2x2):\n[ 3.00 6.00 ]\n[ 9.00 12.00 ]\ntrace C = 15.0\ntrace T = 15.0\n")
+            # Rebinding a name replaces its matrix in the manager
+            self.assertEqual(sorted(m["name"] for m in manager.matrices), ["A", "B", "C", "D", "I", "T"])
+
+            json_steps = parse_script('[{"op": "identity", "name": "I", "size": 2}, {"op": "inverse", "name": "J", "args": ["X"]}]')
+            with self.assertRaisesRegex(ValueError, "Step 2 .*Unknown matrix 'X'"):
+                run_script(MatrixManager(), json_steps, out=io.StringIO())
+            with self.assertRaisesRegex(ValueError, "Line 1"):
+                parse_script("C = A +")
+            with self.assertRaisesRegex(ValueError, "Line 2: 'trace' does not produce a matrix"):
+                parse_script("A = identity 2\nx = trace A")
+            with self.assertRaisesRegex(ValueError, "Line 1: 'print'"):
+                parse_script('[{"op": "print", "name": "x", "args": ["A"]}]')
+
+    def test_session_journal(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "session.mtx")
+            manager = MatrixManager(path)
+            lower = manager.add_matrix(LowerTriangularMatrix(2, 2, [[1, 0], [2, 3]]), "L")
+            dense = manager.add_matrix(Matrix(50, 50), "big")
+            removed = manager.add_matrix(Matrix(1, 1), "gone")
+            manager.remove_matrix_by_id(removed)
+            size = manager._journal.size()
+            manager.alter_element(dense, 3, 4, 2.5)
+            # One changed element is one small record, however large the matrix
+            self.assertLess(manager._journal.size() - size, 64)
+            manager.close_journal()
+
+            restored = MatrixManager(path)
+            self.assertEqual([m["name"] for m in restored.matrices], ["L", "big"])
+            self.assertEqual(restored.get_matrix_by_id(dense).get_element(3, 4), 2.5)
+            self.assertEqual(restored.next_id, 4)
+
+            # After compaction the snapshot holds everything and the journal starts over
+            restored.compact(wait=True)
+            restored.alter_element(lower, 1, 0, 7)
+            restored.close_journal()
+            self.assertFalse(os.path.exists(path + ".journal.old"))
+            with open(path + ".journal", "ab") as f:
+                f.write(b"\x30\x00") # A record cut short by a crash is ignored
+            restored = MatrixManager(path)
+            self.assertEqual(restored.get_matrix_by_id(lower).get_element(1, 0), 7.0)
+            self.assertEqual(restored.get_matrix_by_id(dense).get_element(3, 4), 2.5)
+            restored.clear()
+            restored.close_journal()
+            restored = MatrixManager(path)
+            self.assertEqual(len(restored.matrices), 0)
+            restored.close_journal()
+
+    def test_journal_compaction_during_changes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "session.mtx")
+            manager = MatrixManager(path)
+            sparse = manager.add_matrix(SparseMatrix(3, 3, [[1, 0, 0], [0, 0, 0], [0, 0, 2]]), "S")
+            mapped = manager.add_matrix(MappedMatrix.from_matrix(Matrix(2, 2, [[1, 2], [3, 4]])), "M")
+            # The snapshot writer is held mid-write, exporting the buffers it was given
+            started, release = threading.Event(), threading.Event()
+            write_snapshot = manager._write_snapshot
+            given = []
+
+            def held_write(entries, old_path):
+                given.extend(entries)
+                views = [memoryview(buffer) for _, _, matrix in entries if isinstance(matrix, SparseMatrix)
+                         for buffer in (matrix.data, matrix.indices, matrix.indptr)]
+                started.set()
+                release.wait()
+                views.clear()
+                write_snapshot(entries, old_path)
+            manager._write_snapshot = held_write
+            manager.compact()
+            started.wait()
+            try:
+                manager.alter_element(sparse, 1, 1, 5)
+                manager.alter_element(mapped, 0, 1, 7)
+            finally:
+                release.set()
+                manager.close_journal()
+            # Only the sparse matrix was copied; the mapped one is written straight from its file
+            self.assertIsNot(given[0][2], manager.get_matrix_by_id(sparse))
+            self.assertIs(given[1][2], manager.get_matrix_by_id(mapped))
+            restored = MatrixManager(path)
+            self.assertEqual(restored.get_matrix_by_id(sparse).get_element(1, 1), 5.0)
+            self.assertEqual(restored.get_matrix_by_id(mapped).get_element(0, 1), 7.0)
+            restored.compact(wait=True)
+            restored.close_journal()
+            restored = MatrixManager(path)
+            self.assertEqual(restored.get_matrix_by_id(sparse).get_element(1, 1), 5.0)
+            # Entries loaded but not changed since are snapshotted from their session record
+            restored.get_matrix_by_id(mapped)
+            self.assertIs(restored._snapshot_source(restored._by_id[mapped]), restored._by_id[mapped].record)
+            restored.close_journal()
+
+    def test_legacy_pickle_session(self):
+        # A session pickled by the original list-of-lists implementation: Matrix A, LowerTriangularMatrix L,
+        # UpperTriangularMatrix U, DiagonalMatrix D and SquareMatrix S
+        legacy = (
+        b'\x80\x04\x95\xa2\x01\x00\x00\x00\x00\x00\x00]\x94(}\x94(\x8c\x02id\x94K\x01\x8c\x04name\x94\x8c\x01A\x94\x8c'
+        b'\x06matrix\x94\x8c\x11matrix_calculator\x94\x8c\x06Matrix\x94\x93\x94)\x81\x94}\x94(\x8c\x04rows\x94K\x02\x8c'
+        b'\x04cols\x94K\x03\x8c\x04data\x94]\x94(]\x94(K\x01K\x02K\x03e]\x94(K\x04K\x05K\x06eeubu}\x94(h\x02K\x02h\x03'
+        b'\x8c\x01L\x94h\x05h\x06\x8c\x15LowerTriangularMatrix\x94\x93\x94)\x81\x94}\x94(h\x0bK\x02h\x0cK\x02h\r]\x94(]'
+        b'\x94K\x01a]\x94(K\x02K\x03eeubu}\x94(h\x02K\x03h\x03\x8c\x01U\x94h\x05h\x06\x8c\x15UpperTriangularMatrix\x94'
+        b'\x93\x94)\x81\x94}\x94(h\x0bK\x02h\x0cK\x02h\r]\x94(]\x94(K\x01K\x02e]\x94K\x03aeubu}\x94(h\x02K\x04h\x03\x8c'
+        b'\x01D\x94h\x05h\x06\x8c\x0eDiagonalMatrix\x94\x93\x94)\x81\x94}\x94(h\x0bK\x02h\x0cK\x02h\r]\x94(K\x04K\x05eub'
+        b'u}\x94(h\x02K\x05h\x03\x8c\x01S\x94h\x05h\x06\x8c\x0cSquareMatrix\x94\x93\x94)\x81\x94}\x94(h\x0bK\x02h\x0cK'
+        b'\x02h\r]\x94(]\x94(K\x01K\x02e]\x94(K\x03K\x04eeubue.')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "legacy.pkl")
+            with open(path, "wb") as f:
+                f.write(legacy)
+            manager = MatrixManager()
+            manager.load_session(path)
+        expected = {"A": [[1, 2, 3], [4, 5, 6]], "L": [[1, 0], [2, 3]], "U": [[1, 2], [0, 3]], "D": [[4, 0], [0, 5]], "S": [[1, 2], [3, 4]]}
+        for name, rows in expected.items():
+            m = manager.get_matrix_by_name(name)
+            self.assertEqual(list(m._dense_data()), [float(value) for row in rows for value in row])
+            self.assertEqual(list((m + m)._dense_data()), [2.0 * value for row in rows for value in row])
+            self.assertEqual(m.to_string().count("\n"), len(rows))
+        self.assertAlmostEqual(manager.get_matrix_by_name("S").determinant(), -2.0)
+        self.assertEqual(manager.get_matrix_by_name("L").inverse().get_element(1, 0), -2.0 / 3.0)
+        manager.alter_element(manager.find_matrices(DiagonalMatrix)[0]["id"], 1, 1, 7)
+        self.assertEqual(manager.get_matrix_by_name("D").trace(), 11.0)
+
+    def test_mapped_matrix(self):
+        tile_size = matrix_calculator.MAPPED_TILE_SIZE
+        matrix_calculator.MAPPED_TILE_SIZE = 2 # Several tiles per dimension even for small matrices
+        try:
+            a = Matrix(3, 5, [[1, 2, 3, 4, 5], [6, 7, 8, 9, 10], [11, 12, 13, 14, 15]])
+            b = Matrix(5, 3, [[1, 0, 2], [0, 1, 0], [3, 0, 1], [0, 2, 0], [1, 1, 1]])
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "a.f64")
+                mapped = MappedMatrix.from_matrix(a, path)
+                self.assertEqual(os.path.getsize(path), 3 * 5 * 8)
+                for result, expected in ((mapped + mapped, a + a), (mapped - a, a - a), (mapped * 2, a * 2),
+                                         (mapped.transpose(), a.transpose()), (mapped * b, a * b),
+                                         (b * mapped, b * a), (mapped * MappedMatrix.from_matrix(b), a * b)):
+                    self.assertIsInstance(result, MappedMatrix)
+                    self.assertEqual(result.to_string(), expected.to_string())
+
+                # Writes go to the file, and in-place operators stream into the existing mapping
+                mapped.set_element(0, 0, 100)
+                mapped *= 2
+                mapped.flush()
+                reopened = MappedMatrix(3, 5, path, mode='r')
+                self.assertEqual(reopened.get_element(0, 0), 200.0)
+                with self.assertRaises(ValueError):
+                    reopened.set_element(0, 0, 1)
+                with self.assertRaises(ValueError):
+                    MappedMatrix(4, 5, path)
+
+                # Sessions store the raw payload and map it back copy-on-write without loading it
+                manager = MatrixManager()
+                manager.add_matrix(reopened, "big")
+                session_path = os.path.join(directory, "session.mtx")
+                manager.save_session(session_path)
+                loaded = MatrixManager()
+                loaded.load_session(session_path)
+                restored = loaded.get_matrix_by_name("big")
+                self.assertIsInstance(restored, MappedMatrix)
+                restored.set_element(2, 4, -1)
+                self.assertEqual(restored.get_element(2, 4), -1.0)
+                self.assertEqual(MappedMatrix(3, 5, path, mode='r').get_element(2, 4), 30.0)
+
+                # Saving and listing a mapped matrix do not scan it for structure
+                square = MappedMatrix.from_matrix(DiagonalMatrix(2, 2, [[1, 0], [0, 2]]))
+                manager.add_matrix(square, "square")
+                manager.save_session(session_path)
+                self.assertEqual(manager.describe_structure(square), "square")
+                self.assertEqual(square._derived, {})
+        finally:
+            matrix_calculator.MAPPED_TILE_SIZE = tile_size
+
+    def test_session_file(self):
+        manager = MatrixManager()
+        manager.add_matrix(LowerTriangularMatrix(3, 3, [[1, 0, 0], [2, 3, 0], [4, 5, 6]]), "L")
+        manager.add_matrix(DiagonalMatrix(2, 2, [[7, 0], [0, 8]]), "D")
+        manager.add_matrix(create_matrix_from_data(2, 30, [[1 if c == 5 * r else 0 for c in range(30)] for r in range(2)]), "S")
+        manager.add_matrix(Matrix(2, 3, [[1, 2, 3], [4, 5, 6]]).transpose_view(), "T")
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "session.mtx")
+            manager.save_session(path)
+
+            loaded = MatrixManager()
+            self.assertEqual(loaded.load_session(path), [1, 2, 3, 4])
+            # Only the header index is read until a matrix is used, and packed storage stays packed
+            self.assertFalse(any("matrix" in m for m in loaded.matrices))
+            self.assertEqual([m.record.size() for m in loaded.matrices], [48, 16, 16 + 16 + 24, 48])
+            self.assertEqual([m["id"] for m in loaded.find_matrices(SquareMatrix)], [1, 2])
+            self.assertEqual([m["id"] for m in loaded.find_matrices(rows=2)], [2, 3])
+            self.assertEqual([m["id"] for m in loaded.find_matrices(cols=2)], [2, 4])
+            self.assertFalse(any("matrix" in m for m in loaded.matrices))
+            lower = loaded.get_matrix_by_name("L")
+            self.assertIsInstance(lower, LowerTriangularMatrix)
+            self.assertEqual(lower.get_element(2, 1), 5.0)
+            self.assertEqual(loaded.get_matrix_by_name("S").nnz(), 2)
+            self.assertEqual(loaded.get_matrix_by_name("T").to_string(), manager.get_matrix_by_name("T").to_string())
+
+            # Saving over the mapped file copies unloaded payloads across unchanged
+            lower.set_element(0, 0, 9)
+            loaded.save_session(path)
+            reloaded = MatrixManager()
+            reloaded.load_session(path, append=False)
+            self.assertEqual(reloaded.get_matrix_by_name("L").get_element(0, 0), 9.0)
+            self.assertEqual(reloaded.get_matrix_by_name("D").get_element(1, 1), 8.0)
+
+            # Replacing or clearing the registry closes the session files it was reading from
+            session = reloaded._sessions[0]
+            reloaded.load_session(path, append=False)
+            self.assertTrue(session._map.closed)
+            self.assertEqual(reloaded.get_matrix_by_name("L").get_element(0, 0), 9.0)
+            reloaded.clear()
+            self.assertEqual(reloaded._sessions, [])
+
+    def test_derived_property_cache(self):
+        m = SquareMatrix(3, 3, [[2, 0, 0], [1, 3, 0], [4, 5, 6]])
+        self.assertTrue(m.is_lower_triangular())
+        self.assertAlmostEqual(m.determinant(), 36.0)
+        self.assertEqual(m.trace(), 11.0)
+        # Matrix results are not cached: every caller gets its own matrix
+        transposed = m.transpose()
+        self.assertIsNot(m.transpose(), transposed)
+        version = m._version
+
+        m.set_element(0, 2, 1)
+        self.assertGreater(m._version, version)
+        self.assertFalse(m.is_lower_triangular())
+        self.assertAlmostEqual(m.determinant(), 29.0)
+        transposed.set_element(0, 0, 100)
+        self.assertEqual(m.transpose().get_element(0, 0), 2.0)
+        expression = m.lazy().transpose()
+        self.assertIsNot(expression.evaluate(), expression.evaluate())
+
+        # Modifying the owner of a view invalidates the view's cached results as well
+        view = m.transpose_view()
+        self.assertFalse(view.is_upper_triangular())
+        m.set_element(0, 2, 0)
+        self.assertTrue(view.is_upper_triangular())
+        m *= 2
+        self.assertEqual(m.trace(), 22.0)
+
+    def test_operation_profile(self):
+        d = DiagonalMatrix(2, 2, [[1, 0], [0, 2]])
+        l = LowerTriangularMatrix(2, 2, [[1, 0], [3, 4]])
+        disable_profiling()
+        reset_profile()
+        d + d
+        self.assertEqual(get_profile(), [])
+
+        profiler = cProfile.Profile()
+        enable_profiling(profiler)
+        try:
+            d + d
+            d + d
+            d + l
+            d + Matrix(2, 2, [[1, 2], [3, 4]])
+            l * l
+            l * UpperTriangularMatrix(2, 2, [[1, 2], [0, 3]])
+            SparseMatrix(2, 2, [[1, 0], [0, 1]]).determinant()
+            # The second call is answered from the cache, and still counted
+            l.trace()
+            l.trace()
+        finally:
+            disable_profiling()
+        d + d
+        entries = {(e["operation"], e["operands"], e["path"]): e for e in get_profile()}
+        fast = entries[("add", "DiagonalMatrix,DiagonalMatrix", "DiagonalMatrix.add")]
+        self.assertEqual((fast["calls"], fast["flops"], fast["bytes_allocated"], fast["fallback"]), (2, 4, 32, False))
+        self.assertEqual(fast["result"], "DiagonalMatrix")
+        self.assertFalse(entries[("add", "DiagonalMatrix,LowerTriangularMatrix", "DiagonalMatrix.add")]["fallback"])
+        self.assertTrue(entries[("add", "DiagonalMatrix,Matrix", "Matrix.add")]["fallback"])
+        self.assertFalse(entries[("multiply", "LowerTriangularMatrix,LowerTriangularMatrix", "Matrix.multiply via _multiply_lower_lower")]["fallback"])
+        backend = type(get_backend()).__name__
+        self.assertTrue(entries[("multiply", "LowerTriangularMatrix,UpperTriangularMatrix", f"Matrix.multiply via {backend}.matmul")]["fallback"])
+        self.assertTrue(entries[("determinant", "SparseMatrix", "SquareMatrix.determinant")]["fallback"])
+        computed = entries[("trace", "LowerTriangularMatrix", "SquareMatrix.trace")]
+        cached = entries[("trace", "LowerTriangularMatrix", "SquareMatrix.trace via cached result")]
+        self.assertEqual((computed["calls"], computed["flops"]), (1, 2))
+        self.assertEqual((cached["calls"], cached["flops"], cached["element_visits"]), (1, 0, 0))
+        self.assertGreater(len(profiler.getstats()), 0)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "profile.json")
+            export_profile(path)
+            with open(path) as f:
+                self.assertEqual(len(json.load(f)["operations"]), len(entries))
+        reset_profile()
+        self.assertEqual(get_profile(), [])
+
+    def test_matrix_batch(self):
+        matrices = [SquareMatrix(2, 2, [[m + 1, 2], [3, m - 1]]) for m in range(20)]
+        batch = MatrixBatch.from_matrices(matrices)
+        self.assertEqual(len(batch), 20)
+        self.assertEqual(list(batch[-1].data), list(matrices[-1].data))
+        transform = Matrix(2, 2, [[0, 1], [1, 0]])
+        for name in available_backends():
+            products = batch.multiply(batch, backend=name)
+            self.assertEqual(list(products[7].data), list((matrices[7] * matrices[7]).data))
+            self.assertEqual(list(batch.multiply(transform, backend=name)[3].data), list((matrices[3] * transform).data))
+            self.assertEqual(list(batch.add(transform, backend=name)[4].data), list((matrices[4] + transform).data))
+            self.assertEqual(list(batch.transpose(backend=name)[5].data), list(matrices[5].transpose().data))
+            self.assertEqual(batch.trace(backend=name), [m.trace() for m in matrices])
+            for value, matrix in zip(batch.determinant(backend=name), matrices):
+                self.assertAlmostEqual(value, matrix.determinant())
+
+        # Fewer matrices than columns goes through the per-matrix kernel
+        wide = MatrixBatch(2, 1, 3, [[[1, 2, 3]], [[4, 5, 6]]])
+        column = Matrix(3, 1, [[1], [1], [1]])
+        self.assertEqual(list((wide * wide.transpose()).data), [14.0, 77.0])
+        self.assertEqual(list((wide * column).data), [6.0, 15.0])
+        self.assertEqual(list((batch * 2 - batch).data), list(batch.data))
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            self.assertEqual(list(batch.multiply(batch, executor=executor).data), list((batch * batch).data))
+            self.assertEqual(batch.trace(executor=executor), batch.trace())
+
+        with self.assertRaises(ValueError):
+            MatrixBatch(2, 2, 2, [[[1, 2], [3, 4]]])
+        with self.assertRaises(ValueError):
+            batch + MatrixBatch(3, 2, 2)
+        with self.assertRaises(ValueError):
+            batch * wide
+        with self.assertRaises(TypeError):
+            wide.trace()
+
     def test_create_matrix_from_data(self):
         # Test Diagonal
         m = create_matrix_from_data(2, 2, [[1, 0], [0, 2]])
@@ -213,6 +1105,38 @@ class TestMatrixCalculator(unittest.TestCase):
         m = create_matrix_from_data(2, 3, [[1, 2, 3], [4, 5, 6]])
         self.assertIsInstance(m, Matrix)
 
+        # Test Sparse, with a configurable density threshold
+        data = [[0.0] * 10 for _ in range(10)]
+        data[0][3] = 1.0
+        data[7][2] = 2.0
+        m = create_matrix_from_data(10, 10, data)
+        self.assertIsInstance(m, SparseMatrix)
+        m = create_matrix_from_data(10, 10, data, sparse_threshold=0.01)
+        self.assertNotIsInstance(m, SparseMatrix)
+        self.assertIsInstance(m, SquareMatrix)
+
+    def test_create_matrix_from_data_single_pass(self):
+        # The classified matrix holds the same values as the input, whatever class was chosen
+        inputs = [
+            [[0, 0], [0, 0]],
+            [[1, 0, 0], [2, 3, 0], [4, 5, 6]],
+            [[1, 2, 3], [0, 4, 5], [0, 0, 6]],
+            [[1, 2], [3, 4]],
+            [[1, 0, 0], [0, 2, 0]],
+        ]
+        for data in inputs:
+            rows, cols = len(data), len(data[0])
+            m = create_matrix_from_data(rows, cols, data, sparse_threshold=0.0)
+            self.assertEqual(list(m._dense_data()), [float(value) for row in data for value in row])
+        self.assertIs(type(create_matrix_from_data(2, 3, [[1, 0, 0], [0, 2, 0]], sparse_threshold=0.0)), Matrix)
+
+        with self.assertRaises(ValueError):
+            create_matrix_from_data(2, 2, [[1, 2], [3]])
+        with self.assertRaises(ValueError):
+            create_matrix_from_data(2, 2, [[1, 'a'], [0, 4]])
+        with self.assertRaises(ValueError):
+            create_matrix_from_data(0, 2, [])
+
 if __name__ == '__main__':
     unittest.main()
 